@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+import sys, os, time, random, optparse, subprocess, tempfile, shutil, json, resource
+from optparse import OptionParser, SUPPRESS_HELP
+from collections import OrderedDict
+import menu
+'''
+Benchmarks for the menu.  Run with python bench.py [benchmark ...] - with no arguments,
+all of them are run.
+
+With -o FILE, the results are also saved as JSON, and with -b FILE they're compared against
+results saved earlier, eg.
+    python bench.py -o baseline.json            # before a change
+    python bench.py -b baseline.json            # after it - exits 1 if anything got slower
+'''
+
+def parse_args():
+    ''' Parse the given options and arguments using optparse'''
+    parser = OptionParser(usage='%%prog [options] [%s]' % '|'.join([ name for (name, function) in BENCHMARKS ]))
+    parser.add_option("-l", "--lines", metavar="N,N,...", dest="lines",
+                        help="sizes of config to generate. Default: 12500,25000,50000,100000",
+                        default='12500,25000,50000,100000')
+    parser.add_option("--fan-out", metavar="N", dest="fan_out", type="int",
+                        help="options under each sub-menu. Default: 20", default=20)
+    parser.add_option("--depth", metavar="N", dest="depth", type="int",
+                        help="sub-menu levels above each command. Default: 2", default=2)
+    parser.add_option("--seed", metavar="N", dest="seed", type="int",
+                        help="random seed. Default: 0", default=0)
+    parser.add_option("--label-length", metavar="N", dest="label_length", type="int",
+                        help="pad menu labels out to N characters. Default: 0 (labels like 'level 0-7')", default=0)
+    parser.add_option("--duplicates", metavar="RATE", dest="duplicates", type="float",
+                        help="fraction of commands that reuse another command's label (and actual command) "
+                             "somewhere else in the menu. Default: 0", default=0.0)
+    parser.add_option("-o", "--output", metavar="FILE", dest="output",
+                        help="save the results to FILE as JSON")
+    parser.add_option("-b", "--baseline", metavar="FILE", dest="baseline",
+                        help="compare the results with those saved in FILE by an earlier -o")
+    parser.add_option("--tolerance", metavar="PERCENT", dest="tolerance", type="float",
+                        help="how much worse than the baseline a result can be before it counts as a regression. "
+                             "Default: 20", default=20.0)
+    parser.add_option("--fragments", metavar="N", dest="fragments", type="int",
+                        help="files the fragments benchmark splits the config into. Default: 16", default=16)
+    parser.add_option("--login", metavar="COMMAND", dest="login",
+                        help="what the commands benchmark logs in with, %%s being the user (eg. 'sh # %%s' where "
+                             "there's no sudo). Default: %s" % menu.LOGIN_COMMAND)
+    parser.add_option("--commands", metavar="N", dest="commands", type="int",
+                        help="commands the commands benchmark runs each way. Default: 50", default=50)
+    # Used by the ops benchmark to run each size in a fresh process
+    parser.add_option("--measure", metavar="N", dest="measure", type="int", help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    return (options,args)
+
+# Padding for long labels
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+
+def synthetic_config(lines, depth=2, fan_out=20, seed=0, label_length=0, duplicate_rate=0.0):
+    '''Returns a list of config lines describing a menu with sub-menus depth levels deep and (up to)
+fan_out options under each one.  The last two fields are the command and the actual command.
+Labels are padded with words out to label_length characters, and a duplicate_rate fraction of the
+commands reuse the label and actual command of an earlier one, the way 'have coffee' turns up in
+more than one person's menu.'''
+    rand = random.Random(seed)
+    padding = {}    # so that a given label is always padded the same way
+    def pad(label):
+        if label not in padding:
+            words = [label]
+            while len(' '.join(words)) < label_length: words.append(rand.choice(WORDS))
+            padding[label] = ' '.join(words)[:max(label_length,len(label))]
+        return padding[label]
+    config = []
+    used = set()    # (levels, command) - a command mustn't appear twice in the same sub-menu
+    for i in range(lines):
+        levels = tuple([ pad('level %d-%d' % (depth_index, rand.randrange(fan_out))) for depth_index in range(depth) ])
+        (command, actual_command) = (pad('command %d' % i), 'actual_command_%d' % i)
+        if i > 0 and rand.random() < duplicate_rate:
+            j = rand.randrange(i)
+            if (levels, pad('command %d' % j)) not in used:
+                (command, actual_command) = (pad('command %d' % j), 'actual_command_%d' % j)
+        used.add((levels, command))
+        config.append('%s, %s, %s\n' % (', '.join(levels), command, actual_command))
+    return config
+
+def options_config(options, lines):
+    '''synthetic_config, as the command line options describe it'''
+    return synthetic_config(lines, options.depth, options.fan_out, options.seed,
+                            options.label_length, options.duplicates)
+
+# name -> dict of measurements, all of which are better when lower, for -o and -b
+results = OrderedDict()
+
+def record(name, **measurements):
+    results.setdefault(name, OrderedDict()).update(measurements)
+
+def time_call(function, *args):
+    '''Returns the best of three wall clock timings of function(*args), in seconds'''
+    timings = []
+    for attempt in range(3):
+        start = time.time()
+        function(*args)
+        timings.append(time.time() - start)
+    return min(timings)
+
+def bench_parse(options):
+    '''parse_config should scale linearly, so the time per line ought to stay flat as the config grows'''
+    print "%10s %10s %12s" % ('lines', 'seconds', 'usec/line')
+    for lines in [ int(n) for n in options.lines.split(',') ]:
+        config = options_config(options, lines)
+        seconds = time_call(menu.parse_config, config)
+        print "%10d %10.3f %12.2f" % (lines, seconds, seconds / lines * 1e6)
+        record('parse/%d' % lines, seconds=seconds)
+    return
+
+def deep_size(obj, seen=None):
+    '''Roughly the number of bytes used by obj and everything it refers to, counting shared objects once'''
+    if seen is None: seen = set()
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (key, value) in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj: size += deep_size(item, seen)
+    elif isinstance(obj, menu.MenuTree):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def bench_memory(options):
+    '''Compares the bytes per menu node used by the menu_dict and by a MenuTree built from it'''
+    print "%10s %10s %14s %14s" % ('lines', 'nodes', 'dict b/node', 'tree b/node')
+    for lines in [ int(n) for n in options.lines.split(',') ]:
+        menu_dict = menu.parse_config(options_config(options, lines))
+        tree = menu.MenuTree(menu_dict)
+        nodes = len(tree.labels) - 1  # not counting the root
+        (dict_size, tree_size) = (deep_size(menu_dict) / float(nodes), deep_size(tree) / float(nodes))
+        print "%10d %10d %14.1f %14.1f" % (lines, nodes, dict_size, tree_size)
+        record('memory/%d' % lines, dict_bytes_per_node=dict_size, tree_bytes_per_node=tree_size)
+    return
+
+def run_time(args, until=None):
+    '''Returns the wall clock time for a fresh python to run args - until it exits or, if until is given,
+until that text turns up in its output (at which point it's killed)'''
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-u'] + args, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if until is None:
+        process.communicate()
+    else:
+        output = ''
+        while until not in output:
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data: raise RuntimeError('%s never printed %r' % (' '.join(args), until))
+            output += data
+        process.kill()
+        process.wait()
+    return time.time() - start
+
+def best_run_time(args, until=None):
+    return min([ run_time(args, until) for attempt in range(3) ])
+
+def set_cache_home(directory):
+    '''Points the menu's config caches (see menu.cache_directory) into directory, so a benchmark starts
+with none and leaves none behind.  Returns the old setting, to be put back the same way.'''
+    old = os.environ.get('XDG_CACHE_HOME')
+    if directory is None: del os.environ['XDG_CACHE_HOME']
+    else: os.environ['XDG_CACHE_HOME'] = directory
+    return old
+
+def bench_startup(options):
+    '''How long each module takes to import and each mode takes to get to its first menu (or answer),
+using the largest config size.  Run it before and after a change to see what it did to startup.'''
+    lines = max([ int(n) for n in options.lines.split(',') ])
+    directory = tempfile.mkdtemp()
+    here = os.path.dirname(os.path.abspath(__file__))
+    menu_py = os.path.join(here, 'menu.py')
+    config = os.path.join(directory, 'menu.cfg')
+    socket_path = os.path.join(directory, 'menu.sock')
+    server = None
+    cache_home = set_cache_home(directory)
+    try:
+        f = open(config, 'w')
+        f.writelines(options_config(options, lines))
+        f.close()
+        python = best_run_time(['-c', 'pass'])
+        print "%-40s %10s" % ('(%d lines, less %.3fs python startup)' % (lines, python), 'seconds')
+        for module in ['menu', 'menu_text', 'menu_server', 'menu_gui']:
+            seconds = best_run_time(['-c', 'import sys; sys.path.insert(0, %r); import %s' % (here, module)]) - python
+            print "%-40s %10.3f" % ('import ' + module, seconds)
+            record('startup/import %s' % module, seconds=seconds)
+        timings = [
+            ('text menu, no cache', [menu_py, '-c', config, '-t', '--rebuild-cache'], '****** Menu'),
+            ('text menu, cached', [menu_py, '-c', config, '-t'], '****** Menu'),
+            ('--list', [menu_py, '-c', config, '--list', ''], None),
+            ('--search', [menu_py, '-c', config, '--search', 'command 1$'], None),
+        ]
+        for (name, args, until) in timings:
+            seconds = best_run_time(args, until) - python
+            print "%-40s %10.3f" % (name, seconds)
+            record('startup/%s' % name, seconds=seconds)
+        server = subprocess.Popen([sys.executable, menu_py, '-c', config, '--serve', socket_path])
+        while not os.path.exists(socket_path):
+            if server.poll() is not None: raise RuntimeError('menu server exited')
+            time.sleep(0.01)
+        seconds = best_run_time([menu_py, '--connect', socket_path, '--list', '']) - python
+        print "%-40s %10.3f" % ('--connect --list', seconds)
+        record('startup/--connect --list', seconds=seconds)
+        if os.environ.get('DISPLAY'):
+            # There's nothing printed when the GUI comes up, so have it draw itself once and quit
+            script = '''import sys; sys.path.insert(0, %r)
+import menu, menu_gui, Tkinter as tk
+root = tk.Tk()
+menu_gui.GUI(root, menu.Menu(menu.load_config(%r)))
+root.update()''' % (here, config)
+            seconds = best_run_time(['-c', script]) - python
+            print "%-40s %10.3f" % ('GUI, cached', seconds)
+            record('startup/GUI, cached', seconds=seconds)
+        else: print "%-40s %10s" % ('GUI', 'no DISPLAY')
+    finally:
+        if server is not None and server.poll() is None:
+            server.terminate()
+            server.wait()
+        set_cache_home(cache_home)
+        shutil.rmtree(directory)
+    return
+
+def bench_fragments(options):
+    '''Times loading the largest config split into a directory of fragments: parsing them one after
+the other and in parallel (the same thing, with only one CPU), from the fragments' caches, after
+editing one fragment and with nothing changed'''
+    lines = max([ int(n) for n in options.lines.split(',') ])
+    config = options_config(options, lines)
+    directory = tempfile.mkdtemp()
+    fragments = os.path.join(directory, 'menu.d')
+    os.mkdir(fragments)
+    paths = [ os.path.join(fragments, '%03d.cfg' % i) for i in range(options.fragments) ]
+    cache_home = set_cache_home(directory)
+    try:
+        for i in range(options.fragments):
+            f = open(paths[i], 'w')
+            f.writelines(config[i::options.fragments])
+            f.close()
+        print "%-40s %10s" % ('(%d lines in %d fragments)' % (lines, options.fragments), 'seconds')
+        def edit_one():
+            # Put a line on the end of one fragment, then load the menu
+            f = open(paths[0], 'a')
+            f.write('Edited, line %f, true\n' % time.time())
+            f.close()
+            menu.load_config(fragments)
+        timings = [
+            ('parsed one after the other', lambda: menu.parse_config(fragments, processes=1)),
+            ('parsed in parallel', lambda: menu.parse_config(fragments)),
+            ('from the fragment caches', lambda: menu.parse_config(fragments, caches=True)),
+            ('one fragment edited', edit_one),
+            ('nothing changed', lambda: menu.load_config(fragments)),
+        ]
+        for (name, function) in timings:
+            seconds = time_call(function)
+            print "%-40s %10.3f" % (name, seconds)
+            record('fragments/%s' % name, seconds=seconds)
+    finally:
+        set_cache_home(cache_home)
+        shutil.rmtree(directory)
+    return
+
+def time_each(function, items):
+    '''Returns the best of three timings of calling function on each of items in turn, per item'''
+    def call_all():
+        for item in items: function(item)
+    return time_call(call_all) / len(items)
+
+class ScriptedInput:
+    '''Stands in for raw_input, giving the text menu each of choices in turn and then quitting'''
+    def __init__(self, choices):
+        self.choices = list(choices)
+        self.redraws = 0
+    def __call__(self, prompt=''):
+        self.redraws += 1
+        if self.choices: return self.choices.pop(0)
+        return 'quit'
+
+def text_menu_choices(rand, options, lines, rounds=20):
+    '''Goes down a couple of sub-menus and back, then searches for a command (and clears the
+results with an empty choice), rounds times over'''
+    choices = []
+    for i in range(rounds):
+        choices += ['1'] * min(2, options.depth) + ['0'] * min(2, options.depth)
+        choices += ['command %d' % rand.randrange(lines), '']
+    return choices
+
+def measure_operations(options, lines):
+    '''Times the core operations of the menu on a config of the given size, in this process.
+Returns a dictionary of name -> (seconds, count) where count is how many operations seconds was
+for, plus the peak memory (in KB) after building the menu and at the end.'''
+    import menu_text
+    rand = random.Random(options.seed)
+    config = options_config(options, lines)
+    measurements = OrderedDict()
+    measurements['parse_config'] = (time_call(menu.parse_config, config), 1)
+    menu_dict = menu.parse_config(config)
+    measurements['Menu.__init__'] = (time_call(menu.Menu, menu_dict), 1)
+    the_menu = menu.Menu(menu_dict)
+    measurements['peak_kb_built'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    measurements['SearchIndex'] = (time_call(menu.SearchIndex, menu_dict), 1)
+    the_menu.search_index = menu.SearchIndex(menu_dict)
+
+    # Different queries one after the other, so this is more like lots of people's first searches
+    # than one person typing (which the plain text narrowing makes quicker still)
+    searches = [
+        ('search literal', [ 'command %d' % rand.randrange(lines) for i in range(20) ]),
+        ('search prefix', [ '^level %d-%d' % (rand.randrange(options.depth), rand.randrange(options.fan_out))
+                            for i in range(20) ]),
+        ('search complex', [ r'(command %d|level \d-%d)\d*$' % (rand.randrange(100), rand.randrange(options.fan_out))
+                             for i in range(20) ]),
+    ]
+    for (name, queries) in searches:
+        measurements[name] = (time_each(the_menu.search, queries), 1)
+        if hasattr(the_menu, 'search_dict'): del(the_menu.search_dict)
+    measurements['FuzzyIndex'] = (time_call(menu.FuzzyIndex, menu_dict, the_menu.node_types), 1)
+    the_menu.fuzzy_index = menu.FuzzyIndex(menu_dict, the_menu.node_types)
+    fuzzy_searches = [
+        ('fuzzy prefix', [ 'command %d' % rand.randrange(lines) for i in range(20) ]),
+        ('fuzzy subsequence', [ 'lvl%dcmd%d' % (rand.randrange(options.fan_out), rand.randrange(100)) for i in range(20) ]),
+    ]
+    for (name, queries) in fuzzy_searches:
+        measurements[name] = (time_each(the_menu.find_fuzzy, queries), 1)
+
+    keys = menu_dict.keys()
+    samples = []
+    for i in range(1000):
+        key = rand.choice(keys)
+        samples.append((key, rand.choice(menu_dict[key])))
+    measurements['categorise'] = (time_each(lambda (position, option): the_menu.categorise(position, option), samples), 1)
+    measurements['get_options'] = (time_each(the_menu.get_options, [ list(key) for (key, option) in samples ]), 1)
+
+    # The text menu, with its output thrown away
+    script = ScriptedInput(text_menu_choices(rand, options, lines))
+    (menu_text.raw_input, stdout, sys.stdout) = (script, sys.stdout, open(os.devnull, 'w'))
+    start = time.time()
+    try:
+        try:
+            menu_text.run_text_menu(the_menu)
+        except SystemExit:
+            pass
+    finally:
+        (sys.stdout, seconds) = (stdout, time.time() - start)
+        del(menu_text.raw_input)
+    measurements['text menu redraw'] = (seconds / script.redraws, 1)
+    measurements['peak_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return measurements
+
+def bench_ops(options):
+    '''Times parse_config, Menu.__init__, regex and fuzzy searches, categorise, get_options and redrawing the text menu,
+each size in a fresh process so that its peak memory is its own'''
+    print "%10s %-20s %12s %12s" % ('lines', 'operation', 'usec', 'per second')
+    for lines in [ int(n) for n in options.lines.split(',') ]:
+        args = [sys.executable, os.path.abspath(__file__), '--measure', str(lines),
+                '--depth', str(options.depth), '--fan-out', str(options.fan_out), '--seed', str(options.seed),
+                '--label-length', str(options.label_length), '--duplicates', str(options.duplicates)]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0: sys.exit('Measuring %d lines failed' % lines)
+        measurements = json.loads(output, object_pairs_hook=OrderedDict)
+        for (name, value) in measurements.items():
+            if name.startswith('peak_kb'): continue
+            (seconds, count) = value
+            print "%10d %-20s %12.1f %12.1f" % (lines, name, seconds / count * 1e6, count / seconds)
+            record('ops/%d/%s' % (lines, name), seconds=seconds / count)
+        print "%10d %-20s %9d KB (%d KB once the menu's built)" % (lines, 'peak memory', measurements['peak_kb'], measurements['peak_kb_built'])
+        record('ops/%d/peak memory' % lines, peak_kb=measurements['peak_kb'], peak_kb_built=measurements['peak_kb_built'])
+    return
+
+def bench_commands(options):
+    '''Times running a command that does nothing, with a new login for every command and with a
+SessionPool, so the difference is the overhead of logging in'''
+    import getpass
+    if options.login: menu.LOGIN_COMMAND = options.login
+    user = getpass.getuser()
+    print "%-20s %12s %12s" % ('', 'msec', 'per second')
+    for (name, sessions) in (('new login', None), ('session pool', menu.SessionPool())):
+        runner = menu.CommandRunner(1, output=lambda job, stream, line: None, sessions=sessions)
+        runner.submit(user, 'true').wait()  # (so the pool's session is already going)
+        start = time.time()
+        for i in range(options.commands):
+            job = runner.submit(user, 'true')
+            job.wait()
+            if job.state != 'finished' or job.returncode != 0:
+                sys.exit("Running a command as %s failed (%s) - try --login" % (user, ''.join(job.stderr).strip()))
+        seconds = (time.time() - start) / options.commands
+        print "%-20s %12.2f %12.1f" % (name, seconds * 1000, 1 / seconds)
+        record('commands/%s' % name, seconds=seconds)
+    return
+
+def compare(baseline, tolerance):
+    '''Prints how the results compare with the baseline ones, returning the number of regressions'''
+    regressions = 0
+    print "\n%-45s %-20s %12s %12s %8s" % ('compared with baseline', '', 'was', 'now', 'change')
+    for (name, measurements) in results.items():
+        for (measurement, value) in measurements.items():
+            old = baseline.get(name, {}).get(measurement)
+            if not old: continue
+            change = (value - old) * 100.0 / old
+            flag = ''
+            if change > tolerance:
+                flag = ' REGRESSION'
+                regressions += 1
+            print "%-45s %-20s %12.6g %12.6g %+7.1f%%%s" % (name, measurement, old, value, change, flag)
+    return regressions
+
+# In the order they're run when none are named
+BENCHMARKS = [
+    ('parse', bench_parse),
+    ('memory', bench_memory),
+    ('ops', bench_ops),
+    ('startup', bench_startup),
+    ('fragments', bench_fragments),
+    ('commands', bench_commands),
+]
+
+def main():
+    options, args = parse_args()
+    if options.measure:
+        # We're one of bench_ops' processes - just hand back the measurements
+        print json.dumps(measure_operations(options, options.measure))
+        return
+    baseline = None
+    if options.baseline:
+        # Read it now rather than finding it's missing after all the benchmarks have run
+        f = open(options.baseline)
+        baseline = json.load(f)
+        f.close()
+    benchmarks = dict(BENCHMARKS)
+    for name in args or [ name for (name, function) in BENCHMARKS ]:
+        if name not in benchmarks: sys.exit('Unknown benchmark %s' % name)
+        print "\n%s:" % name
+        benchmarks[name](options)
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump({'python': sys.version.split()[0],
+                   'options': dict([ (name, getattr(options, name)) for name in
+                                     ('lines', 'depth', 'fan_out', 'seed', 'label_length', 'duplicates') ]),
+                   'results': results}, f, indent=1)
+        f.close()
+    if baseline is not None:
+        if baseline['options'] != dict([ (name, getattr(options, name)) for name in baseline['options'] ]):
+            print "\n(The baseline was run with different options: %s)" % baseline['options']
+        if compare(baseline['results'], options.tolerance): sys.exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
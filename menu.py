@@ -1,55 +1,567 @@
 #!/usr/bin/env python
-import sys, Tkinter as tk, re, csv, optparse, signal, commands, subprocess, getpass
-from optparse import OptionParser
-from functools import partial
-from ConfigParser import SafeConfigParser
+import sys, os, gc, re, threading, Queue, time, heapq
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque, Counter
 # Should also try to import atm.functions here ...
 '''
 Idea is that there are three components.
 We have this file - the core logic,
 the menu.cfg file - the configuration,
 the functions.py file
+
+The front ends live in their own files - menu_text.py, menu_gui.py and (to share one menu between many
+front ends) menu_server.py - and are only imported when they're wanted.  That way, the text menu and the
+--run / --list / --search modes don't pay for importing Tkinter, and work on machines without it.
+Modules only some modes need (csv when there's no up to date cache, subprocess when running a command
+and so on) are imported where they're used, for the same reason.
 '''
 
 def parse_args(options):
     ''' Parse the given options and arguments using optparse'''
+    from optparse import OptionParser
     parser = OptionParser()
     parser.add_option("-c", "--config", metavar="FILE", dest="config",
-                        help="Default: menu.cfg", default='menu.cfg')
+                        help="Default: menu.cfg ('-' reads it from stdin, and a directory means all the *.cfg files in it)",
+                        default='menu.cfg')
     parser.add_option("-f", "--functions", metavar="FILE", dest="functions", 
                         help="Default: functions.py", default='menu.functions')
     parser.add_option("-t", "--text", dest="text", default=False, 
                         action="store_true",help="text mode. Default: False")                    
+    parser.add_option("--compact", dest="compact", default=False, action="store_true",
+                        help="hold the menu in a MenuTree, which uses much less memory for big menus. Default: False")
+    parser.add_option("--search-delay", metavar="MS", dest="search_delay", type="int", default=150,
+                        help="how long typing has to pause before the GUI searches. Default: 150")
+    parser.add_option("-j", "--max-jobs", metavar="N", dest="max_jobs", type="int", default=4,
+                        help="how many commands can run at once. Default: 4")
+    parser.add_option("--max-jobs-per-user", metavar="N", dest="max_jobs_per_user", type="int",
+                        help="how many of those can be run as any one user. Default: the same as --max-jobs")
+    parser.add_option("--run", metavar="PATH", dest="run",
+                        help="run the command at PATH (eg. \"Dad's options/relax/read paper\") and exit with its returncode")
+    parser.add_option("--list", metavar="PATH", dest="list",
+                        help="list the options at PATH ('' or '/' for the top of the menu) and exit")
+    parser.add_option("--search", metavar="REGEX", dest="search",
+                        help="list the menu entries matching REGEX and exit")
+    parser.add_option("--search-mode", metavar="MODE", dest="search_mode", type="choice", choices=['regex','fuzzy'],
+                        default='regex', help="how searches work - 'regex', or 'fuzzy' for the best few matches of what "
+                        "you type, ignoring case (the text menu and GUI can switch between them). Default: regex")
+    parser.add_option("--no-sessions", dest="no_sessions", default=False, action="store_true",
+                        help="start a new sudo su - for every command, rather than keeping one open for each user "
+                             "and sending their commands down it. Default: False")
+    parser.add_option("--session-idle", metavar="SECONDS", dest="session_idle", type="float", default=300,
+                        help="how long a user's shell is kept open without being used. Default: 300")
+    parser.add_option("--refresh", dest="refresh", default=False, action="store_true",
+                        help="with --run, run the command even if its output is cached. Default: False")
+    parser.add_option("--cache-size", metavar="N", dest="cache_size", type="int", default=256,
+                        help="how many results of commands marked cache=... to keep in memory. Default: 256")
+    parser.add_option("--cache-dir", metavar="DIR", dest="cache_dir",
+                        help="also keep cached results in DIR (which must be yours alone), to share them with your other menus")
+    parser.add_option("--audit-dir", metavar="DIR", dest="audit_dir",
+                        help="record every command run (who ran it, as whom, when, how long it took and how it got on) "
+                             "in DIR - see menu_audit.py for reading it")
+    parser.add_option("--audit-max-kb", metavar="KB", dest="audit_max_kb", type="int", default=10240,
+                        help="how big an audit file gets before it's compressed and another started. Default: 10240")
+    parser.add_option("--json", dest="json", default=False, action="store_true",
+                        help="give the output of --run, --list or --search as JSON. Default: False")
+    parser.add_option("--separator", metavar="TEXT", dest="separator", default='/',
+                        help="what separates the levels of a PATH. Default: /")
+    parser.add_option("--serve", metavar="SOCKET", dest="serve",
+                        help="load the menu once and serve it to other menus on the unix socket SOCKET")
+    parser.add_option("--connect", metavar="SOCKET", dest="connect",
+                        help="use the menu served on SOCKET rather than loading the config")
+    parser.add_option("-w", "--watch", dest="watch", default=False, action="store_true",
+                        help="reload the menu whenever the config file changes. Default: False")
+    parser.add_option("--watch-interval", metavar="SECONDS", dest="watch_interval", type="float", default=1.0,
+                        help="how often to check the config for changes. Default: 1")
+    parser.add_option("--rebuild-cache", dest="rebuild_cache", default=False,
+                        action="store_true",help="re-parse the config and rewrite its cache. Default: False")
+    parser.add_option("--profile", dest="profile", default=False, action="store_true",
+                        help="time searches, commands and so on, and print a summary on exit (as does setting "
+                             "MENU_PROFILE=1). Default: False")
+    parser.add_option("--profile-dump", metavar="FILE", dest="profile_dump",
+                        help="--profile, and write cProfile stats to FILE")
+    parser.add_option("--trace", metavar="FILE", dest="trace",
+                        help="--profile, and append each timing to FILE as a line of JSON")
     (options, args) = parser.parse_args()
 
     return (options,args)
 
-def parse_config(config):
-    '''Build a dictionary of the menu from the given config file after having removed empty lines and comments'''
-    f = open(config, 'rt')
-    # Want to ignore comments and then remove all commas on the ends of lines, to ensure consistency
-    lines = f.readlines()
-    f.close()
+def config_rows(lines):
+    '''Generator turning the lines of a config file into lists of fields, one line at a time'''
     # remove comments, subsequent trailing spaces and the final comma (should be at most 1 of these)
-    processed_lines = [ line.split('#')[0].rstrip('\n').rstrip(' ').rstrip(',') for line in lines ]
-    # Now we let the csv module parse what's left, although I'm not sure it's doing anything very clever.   
-    try:
-        reader = csv.reader(processed_lines,skipinitialspace = True)
-    except:
-        sys.exit('Couldn\t open %s' % config)
+    processed_lines = ( line.split('#')[0].rstrip('\n').rstrip(' ').rstrip(',') for line in lines )
+    # Now we let the csv module parse what's left, although I'm not sure it's doing anything very clever.
+    import csv
+    return csv.reader(processed_lines,skipinitialspace = True)
+
+# A trailing field such as cache=30s (or 5m, 1h or just a number of seconds) says the output of the
+# line's actual-command can be reused for that long, rather than running it again
+CACHE_FIELD = re.compile(r'^cache=(\d+(?:\.\d+)?)([smh]?)$')
+TIME_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+
+def strip_cache_fields(rows,cache_ttls):
+    '''Takes the cache=... field (if there is one) off the end of each row, noting the time to live
+in seconds against the row's actual-command in cache_ttls'''
+    for row in rows:
+        if len(row) > 2:
+            match = CACHE_FIELD.match(row[-1])
+            if match:
+                row = row[:-1]
+                cache_ttls[row[-1]] = float(match.group(1)) * TIME_UNITS[match.group(2)]
+        yield row
+
+class MenuDict(dict):
+    '''What parse_config returns - the menu_dict, which also has cache_ttls: actual-command -> the
+number of seconds its output can be reused for (see CACHE_FIELD), and sources: (path, size, mtime)
+of the config and every fragment (and globbed directory) that went into it, if it includes any'''
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.cache_ttls = {}
+        self.sources = []
+
+# A line that's just "include <path or glob>" reads in other config files (fragments) at that point,
+# as if their lines were there.  Relative paths are relative to the file doing the including, and a
+# glob's matches are included in name order.
+INCLUDE = re.compile(r'^include\s+(\S.*)$')
+
+def is_include(row):
+    return len(row) == 1 and INCLUDE.match(row[0]) is not None
+
+def has_includes(lines):
+    '''Whether any of the lines of config are include lines'''
+    return any([ is_include(row) for row in config_rows([ line for line in lines if 'include' in line ]) ])
+
+def parse_fragment(f):
+    '''Parses the lines of one config file, returning its pieces in order: a MenuDict of the lines
+up to each include line, then that include's path or glob, and finally a MenuDict of the lines after
+the last include.  Without any includes, that's just the one MenuDict.'''
+    pieces = []
+    cache_ttls = {}
     # Would like to convert this into a dictionary, where a key is the dictionary 
     # position defined as a tuple, and the value is a list of the options at that point.
     # eg. menu_opts[('level1','level2')] = ['list','of','options','under','level','2']
-    menu_opts = {}
-    
-    for line in reader:
-        line = tuple(line) # Lists can't be keys in dictionaries
-        for i in range(len(line)):
-            if line[:i] not in menu_opts: menu_opts[line[:i]] = [line[i]]
-            else: 
-                if line[i] not in menu_opts[line[:i]]: menu_opts[line[:i]].append(line[i])
-    
-    return menu_opts
+    menu_opts = MenuDict()
+    # Alongside menu_opts I keep a tree of the positions seen so far, so for each line I just walk
+    # down it rather than slicing out every prefix of the line and searching lists of options.
+    # Each node is (key, {option: node for that option}).
+    root = ((), {})
+    # Nothing built here can be part of a reference cycle, but the cyclic garbage collector would
+    # still keep rescanning the ever growing tree, which makes big configs parse in worse than linear time
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for line in strip_cache_fields(config_rows(f),cache_ttls):
+            if len(line) == 1 and line[0].startswith('include') and is_include(line):
+                menu_opts.cache_ttls = dict(cache_ttls)
+                cache_ttls.clear()
+                pieces.extend([menu_opts, INCLUDE.match(line[0]).group(1)])
+                (menu_opts, root) = (MenuDict(), ((), {}))
+                continue
+            (key, children) = root
+            for field in line:
+                if field not in children:
+                    if not children: menu_opts[key] = []
+                    children[field] = (key + (field,), {})
+                    menu_opts[key].append(field)
+                (key, children) = children[field]
+    finally:
+        if gc_was_enabled: gc.enable()
+    menu_opts.cache_ttls = cache_ttls
+    pieces.append(menu_opts)
+    return pieces
+
+def parse_config(config,caches=False,processes=None):
+    '''Build a dictionary of the menu from the given config after having removed empty lines and comments.
+config can be a file name ('-' meaning stdin), a directory (meaning all the *.cfg files in it, in name
+order), an open file or any other iterable of lines.  Any fragments it includes are parsed in parallel -
+see FragmentLoader, which is also what caches and processes are for.'''
+    loader = FragmentLoader(caches,processes)
+    if isinstance(config, basestring) and config != '-' and os.path.isdir(config):
+        return loader.build([os.path.join(config,'*.cfg')],'')
+    if isinstance(config, basestring):
+        try:
+            if config == '-': f = sys.stdin
+            else: f = open(config, 'rt')
+        except IOError:
+            sys.exit('Couldn\'t open %s' % config)
+    else: f = config
+    try:
+        pieces = parse_fragment(f)
+    finally:
+        if f is not config and f is not sys.stdin: f.close()
+    if len(pieces) == 1: return pieces[0]   # No includes, which is the usual case
+    if isinstance(config, basestring) and config != '-':
+        return loader.build(pieces,os.path.dirname(config),os.path.normpath(config))
+    return loader.build(pieces,'')
+
+def parse_fragment_file(path,pooled=False):
+    '''Parses the fragment at path and caches its pieces'''
+    stat = os.stat(path)    # (before reading it, so a change made while we read isn't missed)
+    f = open(path,'rt')
+    try:
+        pieces = parse_fragment(f)
+    finally:
+        f.close()
+    written = write_cache(path, pieces, fragment_cache_path(path), stat)
+    # Pickling the pieces to send them back down a pipe would cost as much again, so one of
+    # FragmentLoader's processes leaves them in the cache it's just written, to be read from there
+    if pooled and written: return None
+    return pieces
+
+def parse_pooled_fragment(path):
+    return parse_fragment_file(path,True)
+
+def merge_options(menu_dict,piece):
+    '''Adds the options in piece (a MenuDict) to menu_dict, after any menu_dict already has.  Merging
+a config's pieces in order gives the same menu as parsing all their lines in that order would.'''
+    for (key, options) in piece.iteritems():
+        if key not in menu_dict: menu_dict[key] = list(options)
+        else:
+            existing = set(menu_dict[key])
+            menu_dict[key].extend([ option for option in options if option not in existing ])
+    menu_dict.cache_ttls.update(piece.cache_ttls)
+
+class FragmentLoader:
+    '''Puts a menu together from a config and the fragments it includes.  The fragments are found a
+round at a time - the ones the config includes, then the ones they include and so on - and each
+round's are parsed in parallel, in a pool of (up to processes) processes.  Every fragment's pieces are
+cached (see cache_directory), and with caches, a fragment whose cache is up to date isn't parsed at
+all, so the time taken depends on how much has been edited rather than on the size of the whole menu.'''
+    def __init__(self,caches=True,processes=None):
+        self.caches = caches
+        self.processes = processes
+        self.pieces = {}                # fragment path -> its pieces
+        self.sources = OrderedDict()    # fragment or globbed directory path -> (size, mtime)
+        self.matches = {}               # (glob, directory) -> the fragments it includes
+
+    def source(self,path):
+        try:
+            stat = os.stat(path)
+            self.sources[path] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            pass    # We'll find out it's missing when we try to read it
+
+    def expand(self,pattern,directory):
+        '''The fragments an include of pattern in a file in directory means'''
+        if (pattern, directory) not in self.matches:
+            import glob
+            path = os.path.normpath(os.path.join(directory,pattern))
+            if not glob.has_magic(path): paths = [path]
+            else:
+                # Watching the directory means we notice fragments being added to it or taken away
+                if not glob.has_magic(os.path.dirname(path)): self.source(os.path.dirname(path) or '.')
+                # (leaving out any caches from when they were kept alongside the fragments)
+                paths = [ os.path.normpath(match) for match in sorted(glob.glob(path))
+                          if not match.endswith('.cache') and os.path.isfile(match) ]
+            self.matches[(pattern, directory)] = paths
+        return self.matches[(pattern, directory)]
+
+    def load(self,paths):
+        '''Gets the pieces of each of the fragments at paths, from their caches or by parsing them'''
+        stale = []
+        for path in paths:
+            if path in self.pieces or path in stale: continue
+            self.source(path)
+            pieces = None
+            if self.caches: pieces = read_cache(path, fragment_cache_path(path))
+            if pieces is None: stale.append(path)
+            else: self.pieces[path] = pieces
+        processes = 1
+        if len(stale) > 1 and self.processes != 1:
+            import multiprocessing
+            processes = min(len(stale), self.processes or multiprocessing.cpu_count())
+        try:
+            if processes > 1:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    # (get() with a timeout, as otherwise Ctrl + c is ignored until the pool finishes)
+                    parsed = pool.map_async(parse_pooled_fragment, stale).get(sys.maxint)
+                finally:
+                    pool.terminate()
+                for i in range(len(stale)):
+                    if parsed[i] is None: parsed[i] = read_cache(stale[i], fragment_cache_path(stale[i]))
+                    # (and if it's changed again already, parse it here)
+                    if parsed[i] is None: parsed[i] = parse_fragment_file(stale[i])
+            else: parsed = map(parse_fragment_file, stale)
+        except (IOError, OSError), error:
+            sys.exit('Couldn\'t open %s' % (error.filename or error))
+        self.pieces.update(zip(stale, parsed))
+
+    def build(self,pieces,directory,config=None):
+        '''Returns the MenuDict for the config (a path, if it's a file) with the given pieces, in directory'''
+        includes = [ (piece, directory) for piece in pieces if isinstance(piece, basestring) ]
+        while includes:
+            paths = []
+            for (pattern, base) in includes: paths.extend(self.expand(pattern,base))
+            new = [ path for path in paths if path not in self.pieces ]
+            self.load(new)
+            includes = [ (piece, os.path.dirname(path)) for path in OrderedDict.fromkeys(new)
+                         for piece in self.pieces[path] if isinstance(piece, basestring) ]
+        if config is not None: self.source(config)
+        menu_dict = MenuDict()
+        gc_was_enabled = gc.isenabled()
+        gc.disable()    # (as in parse_fragment)
+        try:
+            self.merge(menu_dict,pieces,directory,[ config ] if config is not None else [])
+        finally:
+            if gc_was_enabled: gc.enable()
+        menu_dict.sources = [ (path,) + stat for (path, stat) in self.sources.items() ]
+        return menu_dict
+
+    def merge(self,menu_dict,pieces,directory,including):
+        for piece in pieces:
+            if not isinstance(piece, basestring):
+                merge_options(menu_dict,piece)
+                continue
+            for path in self.expand(piece,directory):
+                if path in including: sys.exit('%s includes itself' % path)
+                self.merge(menu_dict,self.pieces[path],os.path.dirname(path),including + [path])
+
+# Bump this whenever the layout of the cache file or of the menu_dict changes
+CACHE_VERSION = 3
+
+def private_directory(directory):
+    '''Returns directory, making it (readable and writable by us alone) if it isn't there, or None if it
+can't be made or isn't ours alone - what's in a cache directory is trusted, so nobody else must be able
+to put anything there'''
+    if not os.path.isdir(directory):
+        try: os.makedirs(directory, 0700)
+        except OSError: pass    # Someone else made it first, or we can't - which we'll find out now
+    try:
+        stat = os.stat(directory)
+    except OSError:
+        return None
+    if stat.st_uid != os.getuid() or stat.st_mode & 022: return None
+    return directory
+
+def cache_directory():
+    '''Where parsed configs are cached - a directory of our own ($XDG_CACHE_HOME/menu, or ~/.cache/menu),
+rather than alongside the configs.  The caches are pickles, and unpickling a file someone else could
+have written would let them run whatever they liked as us, so if the directory isn't ours alone
+(or can't be made) this returns None and nothing is cached.'''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return private_directory(os.path.join(base, 'menu'))
+
+def cache_file(path, suffix):
+    '''The cache file in cache_directory() for the file at path (named after it, and told apart
+from others of the same name by a hash of where it is), or None if there's nowhere to cache it'''
+    import hashlib
+    directory = cache_directory()
+    if directory is None: return None
+    path = os.path.abspath(path)
+    return os.path.join(directory, '%s-%s%s' % (os.path.basename(path), hashlib.md5(path).hexdigest(), suffix))
+
+def cache_path(config):
+    '''The parsed menu is cached in the cache directory'''
+    return cache_file(config, '.cache')
+
+def fragment_cache_path(fragment):
+    '''Each included fragment has its own cache of its pieces, so it's only parsed again when it changes'''
+    return cache_file(fragment, '.fragment.cache')
+
+def config_hash(config):
+    import hashlib
+    f = open(config, 'rb')
+    digest = hashlib.md5(f.read()).hexdigest()
+    f.close()
+    return digest
+
+def source_stat(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime)
+    except OSError:
+        return None
+
+def read_cache(config, path=None):
+    '''Returns the menu_dict stored in the cache for config, or None if there isn't a usable one.
+(Given path - fragment_cache_path(config) - it's a fragment's pieces that are returned.)
+The cache is stale unless the config is the same size it was when the cache was written and either
+has the same mtime or (if it's just been touched or checked out again) the same content hash.'''
+    import cPickle as pickle
+    if path is None: path = cache_path(config)
+    if path is None: return None
+    try:
+        stat = os.stat(config)
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        try:
+            # The header is pickled separately so we can check it without loading the whole menu
+            header = pickle.load(f)
+            if header.get('version') != CACHE_VERSION or header.get('size') != stat.st_size:
+                return None
+            if header.get('mtime') != stat.st_mtime and header.get('hash') != config_hash(config):
+                return None
+            menu_dict = pickle.load(f)
+        except Exception:
+            # A corrupt or half written cache is no worse than no cache at all
+            return None
+    finally:
+        f.close()
+    if header.get('mtime') != stat.st_mtime:
+        # Same content, new mtime - refresh the header so we don't have to hash it next time
+        write_cache(config, menu_dict, path)
+    return menu_dict
+
+def write_cache(config, menu_dict, path=None, stat=None):
+    '''Stores menu_dict (or a fragment's pieces) in the cache for config, noting the config's stat
+(from before it was read, if we have it).  Returns whether it managed to.  Failing to write it
+(eg. a read-only directory) isn't an error - we'll just parse the config again next time.'''
+    import cPickle as pickle
+    if path is None: path = cache_path(config)
+    if path is None: return False
+    try:
+        if stat is None: stat = os.stat(config)
+        header = {'version': CACHE_VERSION, 'size': stat.st_size,
+                  'mtime': stat.st_mtime, 'hash': config_hash(config)}
+        # Write to a temporary file and rename it, so nobody ever reads half a cache
+        temp_path = '%s.%d' % (path, os.getpid())
+        f = open(temp_path, 'wb')
+        try:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(menu_dict, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        return False
+    return True
+
+def load_config(config, rebuild_cache=False):
+    '''Returns the menu_dict for config, from its cache if that's up to date and otherwise by
+parsing the config (and then caching the result).  A config that includes fragments (or is a
+directory of them) isn't cached as a whole: writing the whole menu out again whenever one fragment
+changed would cost more than putting it back together from the fragments' own caches does, and
+with those, only the fragments that have changed are parsed again (unless rebuild_cache is set).'''
+    if not isinstance(config, basestring) or config == '-':
+        # Nothing to cache against if we're reading from a pipe
+        return parse_config(config, True)
+    if not rebuild_cache and not os.path.isdir(config):
+        menu_dict = read_cache(config)
+        if menu_dict is not None: return menu_dict
+    menu_dict = parse_config(config, not rebuild_cache)
+    if not menu_dict.sources: write_cache(config, menu_dict)
+    return menu_dict
+
+class ConfigWatcher:
+    '''Keeps a Menu up to date with its config file as the file is edited.  check() should be called
+every so often; if the file has changed, the lines that have been added or removed are parsed and
+patched into the menu_dict, rather than re-parsing the whole file.
+
+To be able to remove a line's options from the menu, we need to know whether any other line still
+needs them, so for every position in the menu we count the lines that pass through it.
+
+A config that includes fragments (or is a directory of them) can't be patched line by line, so
+instead, whenever it or any of its fragments changes, it's loaded again - which only parses the
+fragments that have changed - and the menu is patched to match.'''
+    def __init__(self,config,menu):
+        self.config = config
+        self.menu = menu
+        self.sources = getattr(menu.menu_dict,'sources',[])
+        self.stat = self.file_stat()
+        self.lines = self.counts = None
+        if os.path.isdir(config): return
+        lines = self.read_lines()
+        if has_includes(lines.elements()): return
+        self.lines = lines
+        self.counts = {}    # position tuple -> number of lines passing through it
+        self.count_rows(strip_cache_fields(config_rows(self.lines.elements()),{}),1)
+    def file_stat(self):
+        try:
+            stat = os.stat(self.config)
+            return (stat.st_mtime, stat.st_size, tuple([ source_stat(source[0]) for source in self.sources ]))
+        except OSError:
+            return None
+    def read_lines(self):
+        f = open(self.config,'rt')
+        try:
+            return Counter(f)
+        finally:
+            f.close()
+    def count_rows(self,rows,change):
+        '''Adds change to the count of every position the rows pass through, returning the positions
+whose count has gone from zero to something or from something to zero'''
+        counts = self.counts
+        crossed = []
+        for row in rows:
+            path = ()
+            for field in row:
+                path = path + (field,)
+                count = counts.get(path,0) + change
+                if count: counts[path] = count
+                else: del(counts[path])
+                if count == change or count == 0: crossed.append(path)
+        return crossed
+
+    def check(self):
+        '''Patches the menu if the config has changed since we last looked.  Returns the keys whose
+options, or the types of whose options, changed (empty if none did), or None if the file hasn't changed.'''
+        stat = self.file_stat()
+        if stat == self.stat or stat is None: return None
+        self.stat = stat
+        if self.lines is None: return self.reload()
+        try:
+            lines = self.read_lines()
+        except IOError:
+            return None     # Probably caught it half way through being replaced - try again next time
+        added = lines - self.lines
+        removed = self.lines - lines
+        self.lines = lines
+        if has_includes(added.elements()) or has_includes(removed.elements()):
+            # From now on, the whole config is loaded each time
+            self.lines = self.counts = None
+            return self.reload()
+        if isinstance(self.menu.menu_dict, MenuTree): return self.reload()
+        menu_dict = self.menu.menu_dict
+        changed = set()
+        (added_ttls, removed_ttls) = ({}, {})
+        # Add the new lines before taking away the old ones, so an edited line doesn't take its
+        # options out of the menu only to put them straight back
+        for path in self.count_rows(strip_cache_fields(config_rows(added.elements()),added_ttls),1):
+            menu_dict.setdefault(path[:-1],[]).append(path[-1])
+            changed.add(path[:-1])
+        for path in self.count_rows(strip_cache_fields(config_rows(removed.elements()),removed_ttls),-1):
+            key = path[:-1]
+            menu_dict[key].remove(path[-1])
+            if not menu_dict[key]: del(menu_dict[key])
+            changed.add(key)
+        if hasattr(menu_dict,'cache_ttls'):
+            for text in removed_ttls:
+                if text not in added_ttls: menu_dict.cache_ttls.pop(text,None)
+            menu_dict.cache_ttls.update(added_ttls)
+        return self.menu.menu_changed(changed)
+
+    def reload(self):
+        '''Loads the whole config again and patches the menu to match it'''
+        try:
+            menu_dict = load_config(self.config)
+        except SystemExit:
+            # Probably caught a fragment half way through being replaced - try again next time
+            self.stat = None
+            return None
+        self.sources = menu_dict.sources
+        # (the fragments' stats from before they were read, so we don't miss a change made since)
+        self.stat = self.stat[:2] + (tuple([ source[1:] for source in self.sources ]),)
+        if isinstance(self.menu.menu_dict, MenuTree):
+            # A MenuTree can't be patched, so build it again
+            self.menu.menu_dict = MenuTree(menu_dict)
+            self.menu.node_types = self.menu.menu_dict.types
+            if hasattr(self.menu,'search_index'): del(self.menu.search_index)
+            if hasattr(self.menu,'fuzzy_index'): del(self.menu.fuzzy_index)
+            self.menu.fix_position()
+            return set(self.menu.menu_dict.keys())
+        old = self.menu.menu_dict
+        changed = set([ key for key in old if old[key] != menu_dict.get(key) ])
+        changed.update([ key for key in menu_dict if key not in old ])
+        for key in changed:
+            if key in menu_dict: old[key] = menu_dict[key]
+            else: del(old[key])
+        if hasattr(old,'cache_ttls'):
+            old.cache_ttls = menu_dict.cache_ttls
+            old.sources = menu_dict.sources
+        return self.menu.menu_changed(changed)
 
 def handle_sigint():
     '''Gracefully quit on receiving Ctrl + c'''
@@ -58,16 +570,419 @@ def handle_sigint():
     print 'Recieved Ctrl + c - exiting ...'
     sys.exit()
  
+# Characters that make a search string a regex rather than a plain piece of text
+REGEX_METACHARACTERS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+class SearchCancelled(Exception):
+    '''Raised when a search is abandoned part way through because it's no longer wanted'''
+    pass
+
+def chunks(items,cancelled,size=4096):
+    '''Splits items up, checking between each chunk whether the search has been cancelled'''
+    for i in range(0,len(items),size):
+        if cancelled is not None and cancelled(): raise SearchCancelled()
+        yield items[i:i+size]
+
+class PatternCache:
+    '''A small least-recently-used store of compiled regexes, so that typing the same
+search again (or backspacing to it) doesn't mean compiling it again'''
+    def __init__(self,size=128):
+        self.size = size
+        self.patterns = OrderedDict()
+    def compile(self,regex):
+        try:
+            pattern = self.patterns.pop(regex)
+        except KeyError:
+            # re.error propagates from here, which the GUI relies on to spot a half typed regex
+            pattern = re.compile(regex)
+            if len(self.patterns) >= self.size: self.patterns.popitem(last=False)
+        self.patterns[regex] = pattern
+        return pattern
+
+class SearchIndex:
+    '''Built once from the menu_dict, this holds each distinct level / option string only once,
+with back-references to the menu_dict keys it appears in (either as one of the levels in the key
+or as one of the options in the value).  A search then only has to test each distinct string,
+rather than every level and option of every entry in the menu_dict.'''
+    def __init__(self,menu_dict,cache_size=128):
+        self.menu_dict = menu_dict
+        # The keys are looked at in this order, which is the order the old search loop used
+        self.keys = menu_dict.keys()
+        self.strings = []       # string id -> string
+        self.string_ids = {}    # string -> string id
+        self.level_refs = []    # string id -> indexes into self.keys of keys with the string as a level
+        self.entry_refs = []    # string id -> indexes into self.keys of keys with the string as an option
+        self.trigrams = {}      # three character substring -> set of string ids containing it
+        for index in range(len(self.keys)):
+            key = self.keys[index]
+            for level in set(key):
+                self.level_refs[self.add_string(level)].append(index)
+            for entry in set(menu_dict[key]):
+                self.entry_refs[self.add_string(entry)].append(index)
+        self.patterns = PatternCache(cache_size)
+        # The last plain text search and the ids of the strings it matched.  If the next
+        # search contains the last one, it can only match a subset of those strings.
+        self.last_query = None
+        self.last_hits = None
+        self.key_index = None   # key -> index into self.keys, only worked out if the menu gets changed
+
+    def add_string(self,string):
+        '''Returns the id of string, adding it to the index if it's not there already'''
+        if string in self.string_ids: return self.string_ids[string]
+        string_id = len(self.strings)
+        self.strings.append(string)
+        self.string_ids[string] = string_id
+        self.level_refs.append([])
+        self.entry_refs.append([])
+        for i in range(len(string) - 2):
+            self.trigrams.setdefault(string[i:i+3],set()).add(string_id)
+        return string_id
+
+    def matching_strings(self,regex,cancelled=None):
+        '''Returns the set of ids of the strings that regex matches (in the re.search sense).
+If given, cancelled is called every so often, and the search abandoned if it returns True.'''
+        strings = self.strings
+        if REGEX_METACHARACTERS.search(regex):
+            self.last_query = self.last_hits = None
+            search = self.patterns.compile(regex).search
+            hits = set()
+            for chunk in chunks(range(len(strings)),cancelled):
+                hits.update([ string_id for string_id in chunk if search(strings[string_id]) ])
+            return hits
+        # Plain text, so a substring test is the same as re.search and much quicker.
+        # Narrow down which strings we need to test as far as we can first.
+        if self.last_query is not None and self.last_query in regex:
+            candidates = self.last_hits
+        elif len(regex) >= 3:
+            postings = [ self.trigrams.get(regex[i:i+3],set()) for i in range(len(regex) - 2) ]
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates &= posting
+        else:
+            candidates = range(len(self.strings))
+        hits = set()
+        for chunk in chunks(list(candidates),cancelled):
+            hits.update([ string_id for string_id in chunk if regex in strings[string_id] ])
+        (self.last_query, self.last_hits) = (regex, hits)
+        return hits
+
+    def update(self,changed):
+        '''Brings the index up to date after the options at the given keys of the menu_dict have changed
+(including keys that have been added or removed altogether).  Back-references to options that have
+since been removed are left in place, as matches() checks every candidate against the menu_dict anyway.'''
+        if self.key_index is None:
+            self.key_index = dict([ (self.keys[index], index) for index in range(len(self.keys)) ])
+        for key in changed:
+            index = self.key_index.get(key)
+            if key not in self.menu_dict:
+                if index is not None:
+                    self.keys[index] = None
+                    del(self.key_index[key])
+                continue
+            if index is None:
+                index = self.key_index[key] = len(self.keys)
+                self.keys.append(key)
+                for level in set(key):
+                    self.level_refs[self.add_string(level)].append(index)
+            for entry in set(self.menu_dict[key]):
+                self.entry_refs[self.add_string(entry)].append(index)
+        # New strings might match the last search, so it can't be used to narrow down the next one
+        self.last_query = self.last_hits = None
+
+    def matches(self,regex,cancelled=None):
+        '''Returns a mini-menu_dict of the entries where regex matches one of the levels in the key
+(in which case the whole entry is returned) or any of the options in the value (in which case
+only the matching options are returned)'''
+        hits = self.matching_strings(regex,cancelled)
+        candidates = set()
+        for string_id in hits:
+            candidates.update(self.level_refs[string_id])
+            candidates.update(self.entry_refs[string_id])
+        matches = {}
+        for index in sorted(candidates):
+            key = self.keys[index]
+            if key is None: continue    # removed from the menu since the index was built
+            value = self.menu_dict[key]
+            for level in key:
+                if self.string_ids[level] in hits:
+                    matches[key] = value
+                    break
+            if key not in matches:
+                for entry in value:
+                    if self.string_ids[entry] in hits:
+                        if key not in matches: matches[key] = [entry]
+                        else: matches[key].append(entry)
+        return matches
+
+def subsequence(text,letters):
+    '''Looks for letters in order in text, taking the first of each that turns up.  Returns how many
+were found, and where in text the first and last of those are (-1 if there weren't any).'''
+    (found, start, end) = (0, -1, -1)
+    for letter in letters:
+        position = text.find(letter,end + 1)
+        if position < 0: break
+        if start < 0: start = position
+        (found, end) = (found + 1, position)
+    return (found, start, end)
+
+# The start of each word in an option, other than the first
+WORD_START = re.compile(r'(?<=\W)\w')
+
+class FuzzyIndex:
+    '''For searching as you type, rather than by regex.  Matching ignores case, and the matches are
+ranked, best first, in tiers:
+    0. the option starts with the query ('have c' finds 'have coffee')
+    1. a later word of the option does ('coff' finds 'have coffee')
+    2. the query is somewhere else in the option
+    3. the characters of the query turn up in order along the whole path ('dadcof' finds
+       "Dad's options / relax / have coffee")
+Within a tier, shorter options and tighter matches come first.  The first two tiers are looked up
+in sorted lists, so they're quick, and as only the best few matches are wanted, the slower tiers
+are skipped altogether when the quicker ones have found enough.'''
+    def __init__(self,menu_dict,node_types):
+        self.positions = []     # entry id -> position tuple of a sub-menu or command you can browse to
+        self.parents = []       # the levels of each menu_dict key in lower case, joined by (and ending with) spaces
+        self.parent_entries = []    # for each of those, (entry id, lower case option) of the options there
+        by_label = {}           # lower case option -> entry ids of the options
+        # As with parse_config, there's nothing here for the cyclic garbage collector to find
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for key in menu_dict.keys():
+                types = node_types.get(key)
+                entries = []
+                for option in menu_dict[key]:
+                    if types[option] == 'actual-command': continue
+                    label = option.lower()
+                    by_label.setdefault(label,[]).append(len(self.positions))
+                    entries.append((len(self.positions),label))
+                    self.positions.append(key + (option,))
+                if entries:
+                    self.parents.append(''.join([ level.lower() + ' ' for level in key ]))
+                    self.parent_entries.append(entries)
+            self.labels = sorted(by_label)          # the distinct lower case options
+            self.label_entries = [ by_label[label] for label in self.labels ]
+            # Each option from the start of each word after the first, for looking up word prefixes
+            (suffixes, word_labels) = ([], [])
+            for label_id in range(len(self.labels)):
+                label = self.labels[label_id]
+                for match in WORD_START.finditer(label):
+                    suffixes.append(label[match.start():])
+                    word_labels.append((label_id,match.start()))
+            # (sorting the strings on their own is a lot quicker than sorting tuples of them)
+            order = sorted(range(len(suffixes)),key=suffixes.__getitem__)
+            self.word_suffixes = [ suffixes[i] for i in order ]
+            self.word_labels = [ word_labels[i] for i in order ]
+        finally:
+            if gc_was_enabled: gc.enable()
+
+    def top(self,query,limit=50,cancelled=None):
+        '''Returns the positions of the best (up to) limit matches for query, best first.
+cancelled is as for SearchIndex.matching_strings.'''
+        query = query.lower().strip()
+        if not query: return []
+        scores = {}     # entry id -> score (lower is better)
+        def add(label_id,score):
+            for entry in self.label_entries[label_id]:
+                if entry not in scores: scores[entry] = score
+        index = bisect_left(self.labels,query)
+        while index < len(self.labels) and self.labels[index].startswith(query):
+            add(index,(0,len(self.labels[index])))
+            index += 1
+        if len(scores) < limit:
+            index = bisect_left(self.word_suffixes,query)
+            while index < len(self.word_suffixes) and self.word_suffixes[index].startswith(query):
+                (label_id, offset) = self.word_labels[index]
+                add(label_id,(1,offset,len(self.labels[label_id])))
+                index += 1
+        if len(scores) < limit:
+            for chunk in chunks(range(len(self.labels)),cancelled):
+                for label_id in chunk:
+                    offset = self.labels[label_id].find(query)
+                    if offset > 0: add(label_id,(2,offset,len(self.labels[label_id])))
+        if len(scores) < limit:
+            # Everything under the same sub-menu shares the start of its path, so that part is
+            # only looked through once, and then just the rest of the letters in each option
+            letters = query.replace(' ','')
+            for chunk in chunks(range(len(self.parents)),cancelled):
+                for parent_id in chunk:
+                    parent = self.parents[parent_id]
+                    (found, start, end) = subsequence(parent,letters)
+                    rest = letters[found:]
+                    for (entry, label) in self.parent_entries[parent_id]:
+                        if entry in scores: continue
+                        if not rest: span = end - start + 1
+                        else:
+                            (label_found, label_start, label_end) = subsequence(label,rest)
+                            if label_found < len(rest): continue
+                            if start < 0: span = label_end - label_start + 1
+                            else: span = len(parent) - start + label_end + 1
+                        scores[entry] = (3,span,len(parent) + len(label))
+        best = heapq.nsmallest(limit,scores.iteritems(),key=lambda (entry, score): (score,self.positions[entry]))
+        return [ self.positions[entry] for (entry, score) in best ]
+
+def node_type_table(menu_dict):
+    '''Works out up front what type ('sub-menu', 'command' or 'actual-command') every option in the menu is.
+Returns a dictionary keyed like the menu_dict, where each value maps an option at that level to its type.'''
+    table = {}
+    for key in menu_dict.iterkeys():
+        table[key] = level_types(menu_dict,key)
+    return table
+
+def level_types(menu_dict,key):
+    '''Returns a dictionary of the type of each option at the menu_dict key'''
+    types = {}
+    for option in menu_dict[key]:
+        child = key + (option,)
+        if child not in menu_dict: types[option] = 'actual-command'
+        elif len(menu_dict[child]) == 1 and child + (menu_dict[child][0],) not in menu_dict:
+            types[option] = 'command'
+        else: types[option] = 'sub-menu'
+    return types
+
+# Node types in the order MenuTree stores them as small integers
+NODE_TYPES = ('sub-menu', 'command', 'actual-command')
+
+class MenuTree:
+    '''A compact alternative to the menu_dict for big menus.  Rather than a tuple of the full path for
+every position, each node in the menu gets an integer id, and there are parallel arrays of each
+node's parent, first child and number of children.  Labels are interned, so a label used all over
+the menu is only stored once.  Nodes are numbered breadth first with each node's children numbered
+consecutively in sorted order, so the children of a node are always a sorted slice of self.labels.
+
+It can be read like the menu_dict it was built from (menu_tree[('level1','level2')] etc.), so it
+can be handed to Menu in place of the dictionary.'''
+    def __init__(self,menu_dict):
+        self.labels = ['']                  # node id -> label.  Node 0 is the root and has no label.
+        self.parents = array('l',[-1])      # node id -> id of its parent
+        self.first_child = array('l',[0])   # node id -> id of its first child
+        self.child_count = array('l',[0])   # node id -> number of children
+        keys = [()]  # Only needed while building - node id -> menu_dict key
+        node = 0
+        while node < len(keys):
+            key = keys[node]
+            options = sorted(set(menu_dict.get(key,())))
+            self.first_child[node] = len(self.labels)
+            self.child_count[node] = len(options)
+            for option in options:
+                if type(option) is str: option = intern(option)
+                self.labels.append(option)
+                self.parents.append(node)
+                self.first_child.append(0)
+                self.child_count.append(0)
+                keys.append(key + (option,))
+            node += 1
+        del keys
+        # The ids of the nodes with children - these are the keys of the menu_dict
+        self.internal = array('l',[ node for node in range(len(self.labels)) if self.child_count[node] ])
+        # node id -> index into NODE_TYPES (the root gets a type too, but it's never asked for)
+        self.node_type = bytearray(len(self.labels))
+        for node in range(1,len(self.labels)):
+            count = self.child_count[node]
+            if count == 0: self.node_type[node] = 2
+            elif count == 1 and self.child_count[self.first_child[node]] == 0: self.node_type[node] = 1
+            else: self.node_type[node] = 0
+        self.types = MenuTreeTypes(self)
+        self.cache_ttls = getattr(menu_dict,'cache_ttls',{})
+        self.sources = getattr(menu_dict,'sources',[])
+
+    def node_id(self,key):
+        '''Returns the id of the node at the position given by key, or None if it isn't in the menu'''
+        node = 0
+        for label in key:
+            node = self.child_id(node,label)
+            if node is None: return None
+        return node
+    def child_id(self,node,label):
+        '''Returns the id of the child of node with the given label, or None if it hasn't one'''
+        first = self.first_child[node]
+        last = first + self.child_count[node]
+        child = bisect_left(self.labels,label,first,last)
+        if child == last or self.labels[child] != label: return None
+        return child
+    def categorise(self,key,option):
+        '''As Menu.categorise, but just looking up the one node rather than the types of all of its
+siblings, which for a wide sub-menu makes all the difference'''
+        node = self.node_id(key)
+        if node is None or self.child_count[node] == 0: return -1
+        child = self.child_id(node,option)
+        if child is None: return 'search'
+        return NODE_TYPES[self.node_type[child]]
+    def path(self,node):
+        '''Returns the menu_dict style key for the given node id'''
+        labels = []
+        while node > 0:
+            labels.append(self.labels[node])
+            node = self.parents[node]
+        labels.reverse()
+        return tuple(labels)
+    def children(self,node):
+        first = self.first_child[node]
+        return self.labels[first:first + self.child_count[node]]
+
+    # The rest of this is so it can be read like the menu_dict
+    def __getitem__(self,key):
+        node = self.node_id(key)
+        if node is None or self.child_count[node] == 0: raise KeyError(key)
+        return self.children(node)
+    def __contains__(self,key):
+        node = self.node_id(key)
+        return node is not None and self.child_count[node] > 0
+    def __len__(self):
+        return len(self.internal)
+    def __iter__(self):
+        return iter(self.keys())
+    def get(self,key,default=None):
+        try: return self[key]
+        except KeyError: return default
+    def keys(self):
+        return MenuTreeKeys(self)
+    def iteritems(self):
+        for node in self.internal:
+            yield (self.path(node), self.children(node))
+    def items(self):
+        return list(self.iteritems())
+
+class MenuTreeKeys:
+    '''The keys of a MenuTree, worked out as they are asked for rather than all stored'''
+    def __init__(self,tree):
+        self.tree = tree
+    def __len__(self):
+        return len(self.tree.internal)
+    def __getitem__(self,index):
+        return self.tree.path(self.tree.internal[index])
+    def __iter__(self):
+        for node in self.tree.internal: yield self.tree.path(node)
+
+class MenuTreeTypes:
+    '''Stands in for the node_type_table of a MenuTree, working out the types of the options at a
+position from the tree's node_type array as they are asked for'''
+    def __init__(self,tree):
+        self.tree = tree
+    def get(self,key,default=None):
+        tree = self.tree
+        node = tree.node_id(key)
+        if node is None or tree.child_count[node] == 0: return default
+        first = tree.first_child[node]
+        return dict([ (tree.labels[child], NODE_TYPES[tree.node_type[child]])
+                      for child in range(first, first + tree.child_count[node]) ])
+
 # So I can quickly test changes in Idle - use line below:
 #import menu; menu_dict = menu.parse_config('D:\Edmund\Python\Scripts\menu.cfg'); menu = menu.Menu(menu_dict)
 
 class Menu:
     '''The menu class needs to be instantiated with a dictionary built from a menu config file.\
 The dictionary has the property that each key is a tuple defining a particular menu level (eg. ('level1','level2')  )\
-, with the value being the list of all the options available at that level (eg. ['level3', 'command1','command2']).'''
-    def __init__(self,menu_dict):
+, with the value being the list of all the options available at that level (eg. ['level3', 'command1','command2']).\
+A MenuTree built from the dictionary can be used instead.'''
+    def __init__(self,menu_dict,runner=None):
         self.position = []  # At the base of the menu
+        if runner is None: runner = CommandRunner()
+        self.runner = runner    # What runs the commands
         self.menu_dict = menu_dict # This is the config file we're using
+        if isinstance(menu_dict, MenuTree): self.node_types = menu_dict.types
+        else: self.node_types = node_type_table(menu_dict)
     def get_options(self,position):
         '''Display the options returned from the previous search, if applicable, or those available at this point in the menu'''
         if hasattr(self,'search_dict'):
@@ -81,44 +996,70 @@ The dictionary has the property that each key is a tuple defining a particular m
             return dict([(tuple(position),sorted(self.menu_dict[tuple(position)]))])
     def choose_option(self,position,option):
         '''Move to selected level of menu / execute chosen command'''
-        if self.categorise(position,option) == -1: return -1
-        if self.categorise(position,option) == 'search':
+        category = self.categorise(position,option)
+        if category == -1: return -1
+        if category == 'search':
             self.search(option)
-        elif self.categorise(position,option) == 'sub-menu':
+        elif category == 'sub-menu':
             position.append(option)
             self.position = position
         else:
             # Not a search or a sub-menu implies this is a command which should be run,
             # so this will call the associated 'actual-command' lying under the command entry
             # Obviously, this has yet to be implemented - it just prints the line below currently.
-            self.execute_command(self.menu_dict[tuple(position + [option])][0])
+            self.execute_command(self.menu_dict[tuple(position + [option])][0],path=position + [option])
         return
+    def menu_changed(self,changed):
+        '''Patches everything worked out from the menu_dict after the options at the given keys have
+changed, and moves the current position up to the nearest place that's still in the menu'''
+        # The type of an option depends on its children and grandchildren, so the types at the
+        # changed keys, their parents and their grandparents may all be different now
+        affected = set()
+        for key in changed: affected.update([ key[:len(key) - i] for i in range(min(3,len(key) + 1)) ])
+        for key in affected:
+            if key in self.menu_dict: self.node_types[key] = level_types(self.menu_dict,key)
+            else: self.node_types.pop(key,None)
+        if hasattr(self,'search_index'): self.search_index.update(changed)
+        # The fuzzy index is just built again, the next time someone wants it
+        if hasattr(self,'fuzzy_index'): del(self.fuzzy_index)
+        self.fix_position()
+        return affected
+
+    def fix_position(self):
+        '''Moves the current position up until it's somewhere that's in the menu'''
+        while self.position and self.categorise(self.position[:-1],self.position[-1]) in (-1,'search'):
+            self.position.pop()
+
     def go_up(self):
         '''Move back up one level of the menu (unless already at base, in which case do nothing)'''
         if len(self.position) > 0:
             self.position.pop(len(self.position) - 1)
         return
+    # 'regex' searches with find, 'fuzzy' with find_fuzzy (which returns the best fuzzy_limit matches)
+    search_mode = 'regex'
+    fuzzy_limit = 50
     def search(self,regex):
         '''Returns and stores, as an object attribute, a mini-menu_dict, where regex matches \
-either the key or the value or, if value is a 'command', the 'actual-command' lying underneath'''
-        matches = {}
-        for (key, value) in self.menu_dict.items():
-            for level in key:
-                if re.search(regex,level):
-                    matches[key] = value
-                    break
-            if key not in matches:
-                for entry in value:
-                    if re.search(regex,entry):
-                        # I'm being careful here to only add the menu entries that match
-                        if key not in matches: matches[key] = [entry]
-                        else: matches[key].append(entry)
-                
+either the key or the value or, if value is a 'command', the 'actual-command' lying underneath.
+In 'fuzzy' search_mode, regex is just the text to look for instead - see find_fuzzy.'''
+        if self.search_mode == 'fuzzy': self.search_dict = self.find_fuzzy(regex)
+        else: self.search_dict = self.find(regex)
+        # I return the dictionary here, but I think I'm more likely
+        # to use the fact that I've set self.search
+        return self.search_dict
+
+    def find(self,regex,cancelled=None):
+        '''Does the work for search, but just returns the mini-menu_dict rather than also storing it.
+cancelled is as for SearchIndex.matching_strings.'''
+        # The index is only built the first time someone searches
+        if not hasattr(self,'search_index'): self.search_index = SearchIndex(self.menu_dict)
+        matches = self.search_index.matches(regex,cancelled)
+
         # Note that we may have matched the 'actual-command', as opposed to a 'sub-menu' or a 'command'
         # (which are what you see when you browse the menu).  In these cases, I only want to store the
         # command entry, not the actual command entry
         for (key,value) in matches.items():
-            if self.categorise(list(key),value[0]) == 'actual-command':
+            if self.categorise(key,value[0]) == 'actual-command':
                 del matches[key] # we know in this case the actual-command is the only entry in value
                 if tuple(list(key)[:-1]) not in matches:
                     # If key,value matches the menu position of the actual command
@@ -126,419 +1067,939 @@ either the key or the value or, if value is a 'command', the 'actual-command' ly
                     # entry for the associated command you can browse to in the menu,
                     # which is what we want
                     matches[tuple(list(key)[:-1])] = [key[-1]]
-        self.search_dict = matches
-        # I return the dictionary here, but I think I'm more likely
-        # to use the fact that I've set self.search
-        return self.search_dict     
+        return matches     
         
+    def find_fuzzy(self,query,cancelled=None,limit=None):
+        '''Returns a mini-menu_dict of the best matches for query (see FuzzyIndex), as an OrderedDict
+with the keys in the order of their best match and the options at each key best first.'''
+        if not hasattr(self,'fuzzy_index'): self.fuzzy_index = FuzzyIndex(self.menu_dict,self.node_types)
+        matches = OrderedDict()
+        for position in self.fuzzy_index.top(query,limit or self.fuzzy_limit,cancelled):
+            matches.setdefault(position[:-1],[]).append(position[-1])
+        return matches
+
     def categorise(self,position,option):
-        '''Returns 'sub-menu','command','actual-command' (as typed on the command line) depending on the option'''
-        if tuple(position) not in self.menu_dict: return -1
-        if option not in self.menu_dict[tuple(position)]: return 'search' # If someone hasn't picked a valid option, it's a search
-        if tuple(position + [option]) not in self.menu_dict: return 'actual-command'
-        elif tuple(position + [option]) in self.menu_dict \
-        and len(self.menu_dict[tuple(position + [option])]) == 1 \
-        and tuple(position + [option] + [self.menu_dict[tuple(position + [option])][0]]) not in self.menu_dict:
-            return 'command'
-        else: return 'sub-menu'
+        '''Returns 'sub-menu','command','actual-command' (as typed on the command line) depending on the option.
+position can be a list or, to save converting it, a tuple.'''
+        if isinstance(self.menu_dict, MenuTree): return self.menu_dict.categorise(position,option)
+        types = self.option_types(position)
+        if types is None: return -1
+        # If someone hasn't picked a valid option, it's a search
+        return types.get(option,'search')
+
+    def option_types(self,position):
+        '''Returns a dictionary of the type of each option at position, or None if position isn't in the menu'''
+        if type(position) is not tuple: position = tuple(position)
+        return self.node_types.get(position)
     
-    def execute_command(self,text):
-        '''Executes the given command in the shell.  Not currently working in Git Bash, but yet to test on an actual Unix box'''
-        # two possibilities.  Simple function, in which case execute as the current user.
-        # (user;command) - in which case execute the command as the user.
-        match = re.search(r'^\(([^;]+);(.*)\)',text)
-        if match:
-            # User has been specified
-            (user,command) = (match.group(1),match.group(2))
-        else:
-            # No user has been specified
-            (user,command) = (text,getpass.getuser())
-            
+    def resolve(self,path,separator='/'):
+        '''Turns a path such as "Dad's options/relax/read paper" into a position list, or returns None
+if there's no such position in the menu.  An empty path (or just the separator) is the top of the menu.'''
+        position = [ label for label in path.split(separator) if label != '' ]
+        for i in range(len(position)):
+            if self.categorise(position[:i],position[i]) in (-1,'search'): return None
+        return position
+
+    def commands_under(self,position):
+        '''Returns (position, actual-command) for the command at position, or for every command in the
+sub-menu at position (and its sub-menus, and so on)'''
+        position = tuple(position)
+        category = self.categorise(position[:-1],position[-1])
+        if category == 'command': return [(position,self.menu_dict[position][0])]
+        if category != 'sub-menu': return []
+        commands = []
+        for option in sorted(self.menu_dict[position]):
+            commands.extend(self.commands_under(position + (option,)))
+        return commands
+
+    def batch_commands(self,positions):
+        '''(position, actual-command) for each command at / under the given positions, each just the once'''
+        commands = []
+        seen = set()
+        for position in positions:
+            for (path,text) in self.commands_under(position):
+                if path not in seen:
+                    seen.add(path)
+                    commands.append((path,text))
+        return commands
+
+    def run_batch(self,positions,done=None):
+        '''Runs all the commands at / under the given positions at once as a Batch, returning the Batch.
+done, if given, is called with the Batch once every command has finished.'''
+        batch = Batch(self.batch_commands(positions),self.runner.max_jobs,done,self.runner.sessions,self.runner.audit)
+        batch.start()
+        return batch
+
+    def execute_command(self,text,refresh=False,path=None):
+        '''Starts the given command running in the background, returning its Job.  Output goes to
+wherever self.runner sends it (the terminal, unless a front end has said otherwise).  If the config
+says the command's output can be cached, a cached result is used instead, unless refresh is True.
+path, if given, is the command's position in the menu (for the audit log).'''
+        (user,command) = split_command(text)
+        cache_ttl = getattr(self.menu_dict,'cache_ttls',{}).get(text)
+        return self.runner.submit(user,command,cache_ttl=cache_ttl,refresh=refresh,path=path)
+
+    def cache_stats(self):
+        if self.runner.cache is None: return 'No result cache'
+        return self.runner.cache.stats()
+
+    def clear_cache(self):
+        if self.runner.cache is not None: self.runner.cache.clear()
+
+def split_command(text):
+    '''Returns the (user, command) an actual-command should be run as'''
+    # two possibilities.  Simple function, in which case execute as the current user.
+    # (user;command) - in which case execute the command as the user.
+    match = re.search(r'^\(([^;]+);(.*)\)',text)
+    if match:
+        # User has been specified
+        return (match.group(1),match.group(2))
+    else:
+        # No user has been specified
+        import getpass
+        return (getpass.getuser(),text)
+
+class Job:
+    '''A command submitted to a CommandRunner, and how it got on'''
+    def __init__(self,number,user,command):
+        self.number = number
+        self.user = user
+        self.command = command
+        self.state = 'queued'   # then 'running' and finally 'finished', 'failed' or 'cancelled'
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+        self.stdout = []        # the lines of output, as they arrive
+        self.stderr = []
+        self.process = None
+        self.cancel_requested = False
+        self.output = None      # if set, used instead of the runner's output for this job
+        self.cache_ttl = None   # if set, how long the output can be cached for (see ResultCache)
+        self.refresh = False    # True to run it even if there's a cached result
+        self.cached_at = None   # if the output is a cached result, when the command that produced it finished
+        self.path = None        # where it is in the menu, if we know
+        self.by = None          # who asked for it to be run, if it wasn't us (see MenuServer)
+        self.done = threading.Event()
+    def wall_time(self):
+        if self.start_time is None: return 0.0
+        return (self.end_time or time.time()) - self.start_time
+    def wait(self):
+        # (waiting with a timeout, as otherwise Ctrl + c isn't noticed until the job finishes)
+        while not self.done.wait(0.5): pass
+        return self.returncode
+    def describe(self):
+        return "%d\t%s\t%s\t%s\t%.2fs\t%s" % (self.number, self.state, self.user,
+            '-' if self.returncode is None else self.returncode, self.wall_time(), self.command)
+
+output_lock = threading.Lock()
+
+# How a command gets run as its user - the command is fed to this shell's stdin
+LOGIN_COMMAND = "sudo su - %s"
+
+def print_output(job,stream,line):
+    '''The default CommandRunner output - prints each line as it arrives, labelled with its job.
+(stream 'message' is for anything else we want to print, such as a batch summary)'''
+    if stream == 'message': text = line
+    elif stream is None: text = "[job %d] %s\n" % (job.number, job_summary(job))
+    elif stream == 'stderr': text = "[job %d stderr] %s" % (job.number, line)
+    else: text = "[job %d] %s" % (job.number, line)
+    if not text.endswith('\n'): text = text + '\n'
+    output_lock.acquire()
+    try:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    finally:
+        output_lock.release()
+
+def job_summary(job):
+    if job.cached_at is not None:
+        return 'finished with returncode %s (cached from %.0fs ago)' % (job.returncode, time.time() - job.cached_at)
+    if job.state == 'cancelled': return 'cancelled after %.2fs' % job.wall_time()
+    if job.state == 'failed': return 'failed to start: %s' % ''.join(job.stderr).strip()
+    return 'finished with returncode %s in %.2fs' % (job.returncode, job.wall_time())
+
+class ResultCache:
+    '''Remembers the output of commands whose config line says they can be cached, so that running
+one again within its time to live replays what it printed last time rather than starting another
+sudo su -.  Only commands that succeed (returncode 0) are cached.  The size most recently used
+results are kept in memory and, given a directory, in files there as well, so that our other menus
+using the same directory get them too.  The files are JSON rather than pickles - unpickling
+something another user could have written would let them run whatever they liked as us.  Even so,
+a result is replayed as the output of a command run as its user, so the directory has to be ours
+alone (see private_directory) - otherwise it isn't used - and files in it that aren't ours are ignored.'''
+    def __init__(self,size=256,directory=None):
+        self.size = size
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.results = OrderedDict()    # (user, command) -> result, least recently used first
+        self.hits = 0
+        self.disk_hits = 0  # (the hits that came from the directory)
+        self.misses = 0
+        self.refreshes = 0
+        if directory is not None and private_directory(directory) is None:
+            sys.stderr.write("Not caching results in %s - it isn't a directory only we can write to\n" % directory)
+            self.directory = None
+    def get(self,user,command,refresh=False):
+        '''Returns the unexpired result for (user, command), or None if there isn't one.  refresh
+counts as a miss whatever there is, as the command is going to be run regardless.'''
+        key = (user,command)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if refresh:
+                self.refreshes += 1
+                return None
+            result = self.results.pop(key,None)
+            if result is not None and result['expires'] > now:
+                self.results[key] = result
+                self.hits += 1
+                return result
+        finally:
+            self.lock.release()
+        result = self.read(key)
+        self.lock.acquire()
+        try:
+            if result is not None and result['expires'] > now:
+                self.store(key,result)
+                self.hits += 1
+                self.disk_hits += 1
+                return result
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+    def put(self,job):
+        result = {'expires': job.end_time + job.cache_ttl, 'finished': job.end_time, 'returncode': job.returncode,
+                  'stdout': list(job.stdout), 'stderr': list(job.stderr)}
+        self.lock.acquire()
+        try:
+            self.store((job.user,job.command),result)
+        finally:
+            self.lock.release()
+        self.write((job.user,job.command),result)
+    def store(self,key,result):
+        self.results.pop(key,None)
+        self.results[key] = result
+        while len(self.results) > self.size: self.results.popitem(last=False)
+    def clear(self):
+        '''Forgets every result, including those in the directory, so everything runs afresh'''
+        self.lock.acquire()
+        try:
+            self.results.clear()
+        finally:
+            self.lock.release()
+        if self.directory is None: return
+        for name in os.listdir(self.directory):
+            if re.match(r'^[0-9a-f]{32}\.json$',name):
+                try: os.remove(os.path.join(self.directory,name))
+                except OSError: pass
+    def stats(self):
+        return ('%d hits (%d from %s), %d misses, %d refreshes, %d results held' %
+                (self.hits, self.disk_hits, self.directory or 'no cache directory', self.misses,
+                 self.refreshes, len(self.results)))
+    def file_path(self,key):
+        import hashlib
+        return os.path.join(self.directory,hashlib.md5('%s\0%s' % key).hexdigest() + '.json')
+    def read(self,key):
+        if self.directory is None: return None
+        import json
+        try:
+            f = open(self.file_path(key))
+            try:
+                if os.fstat(f.fileno()).st_uid != os.getuid(): return None
+                result = json.load(f)
+            finally:
+                f.close()
+            # JSON gives us unicode back - see write
+            if [result['user'], result['command']] != [ text.decode('latin-1') for text in key ]: return None
+            for stream in ('stdout','stderr'): result[stream] = [ line.encode('latin-1') for line in result[stream] ]
+            return result
+        except (IOError, ValueError, KeyError):
+            return None
+    def write(self,key,result):
+        if self.directory is None: return
+        import json
+        # Output needn't be valid UTF-8, so it's stored as latin-1, which any string of bytes is
+        result = dict(result, user=key[0].decode('latin-1'), command=key[1].decode('latin-1'))
+        for stream in ('stdout','stderr'): result[stream] = [ line.decode('latin-1') for line in result[stream] ]
+        path = self.file_path(key)
+        temp_path = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            f = open(temp_path,'w')
+            try:
+                json.dump(result,f)
+            finally:
+                f.close()
+            os.rename(temp_path,path)
+        except (IOError, OSError):
+            pass    # We'll just not share this one
+
+class CommandRunner:
+    '''Runs commands in the background, as the given user (via sudo su -), without the front end having
+to wait for them.  At most max_jobs run at once, and at most max_per_user (by default, max_jobs) of
+them for any one user.  Each user has their own queue, and their commands start in the order they were
+submitted; when a slot frees up, the users take it in turns.
+
+Output is passed, a line at a time, to output(job, 'stdout' or 'stderr', line), and then
+output(job, None, None) is called once the job is over.  output gets called from the job's own
+threads, so a GUI needs to hand it over to its mainloop rather than update widgets directly.
+A different output can be given for a particular job when it's submitted.
+
+With a ResultCache, jobs submitted with a cache_ttl replay the cached output (if there is any)
+rather than being run, unless they're submitted with refresh=True.  With a SessionPool, commands are
+run in its sessions rather than each in a new LOGIN_COMMAND.  With an AuditLog (see menu_audit.py),
+every job that's run or replayed is recorded in it.'''
+    def __init__(self,max_jobs=4,output=print_output,cache=None,sessions=None,audit=None,max_per_user=None):
+        self.max_jobs = max_jobs
+        self.max_per_user = max_per_user or max_jobs
+        self.output = output
+        self.cache = cache
+        self.sessions = sessions
+        self.audit = audit
+        self.lock = threading.Lock()
+        self.jobs = []              # every job submitted, in order
+        self.queues = OrderedDict() # user -> deque of their jobs waiting to start
+        self.user_running = {}      # user -> how many of their jobs are running
+        self.running = 0
+    def submit(self,user,command,output=None,cache_ttl=None,refresh=False,path=None,by=None):
+        result = None
+        if cache_ttl and self.cache is not None: result = self.cache.get(user,command,refresh)
+        self.lock.acquire()
+        try:
+            job = Job(len(self.jobs) + 1,user,command)
+            job.output = output
+            (job.cache_ttl, job.refresh) = (cache_ttl, refresh)
+            if path is not None: job.path = tuple(path)
+            job.by = by
+            self.jobs.append(job)
+            if result is None: self.queues.setdefault(user,deque()).append(job)
+        finally:
+            self.lock.release()
+        if result is not None: self.replay(job,result)
+        else: self.schedule()
+        return job
+    def replay(self,job,result):
+        '''Finishes the job with a cached result rather than running it'''
+        job.start_time = job.end_time = time.time()
+        job.cached_at = result['finished']
+        (job.returncode, job.state) = (result['returncode'], 'finished')
+        for stream in ('stdout','stderr'):
+            for line in result[stream]:
+                getattr(job,stream).append(line)
+                self.emit(job,stream,line)
+        if self.audit is not None: self.audit.record(job)
+        self.emit(job,None,None)
+        job.done.set()
+    def schedule(self):
+        '''Starts as many waiting jobs as there are free slots for'''
+        to_start = []
+        self.lock.acquire()
+        try:
+            while self.running < self.max_jobs:
+                ready = [ user for user in self.queues
+                          if self.queues[user] and self.user_running.get(user,0) < self.max_per_user ]
+                if not ready: break
+                user = ready[0]
+                # Move this user to the back, so everyone else gets a go before them next time
+                self.queues[user] = self.queues.pop(user)
+                job = self.queues[user].popleft()
+                self.user_running[user] = self.user_running.get(user,0) + 1
+                self.running += 1
+                to_start.append(job)
+        finally:
+            self.lock.release()
+        for job in to_start:
+            thread = threading.Thread(target=self.run_job,args=(job,))
+            thread.daemon = True
+            thread.start()
+    def run_job(self,job):
+        import subprocess
+        job.start_time = time.time()
+        job.state = 'running'
+        if self.sessions is not None:
+            try:
+                self.sessions.run(job,self.emit)
+            finally:
+                self.finish_job(job)
+            return
+        try:
+            try:
+                job.process = subprocess.Popen(
+                            LOGIN_COMMAND % job.user,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            shell=True)
+            except OSError, error:
+                job.state = 'failed'
+                job.stderr.append(str(error))
+                return
+            if job.cancel_requested: job.process.terminate()
+            readers = [ threading.Thread(target=self.read_output,args=(job,job.process.stdout,'stdout',job.stdout)),
+                        threading.Thread(target=self.read_output,args=(job,job.process.stderr,'stderr',job.stderr)) ]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            try:
+                job.process.stdin.write(job.command)
+                job.process.stdin.close()
+            except IOError:
+                pass    # The shell has gone already - we'll find out why from its output and returncode
+            job.returncode = job.process.wait()
+            # Anything the command left running in the background can hold its output open, which
+            # is fine normally, but once it's been cancelled we don't want to wait for them.
+            for reader in readers: reader.join(1.0 if job.cancel_requested else None)
+            if job.cancel_requested: job.state = 'cancelled'
+            else: job.state = 'finished'
+        finally:
+            self.finish_job(job)
+    def finish_job(self,job):
+        '''Frees up the job's slot, tells whoever is interested it's over, and starts the next job'''
+        job.end_time = time.time()
+        if job.cache_ttl and self.cache is not None and job.state == 'finished' and job.returncode == 0:
+            self.cache.put(job)
+        if self.audit is not None: self.audit.record(job)
+        self.lock.acquire()
+        try:
+            self.user_running[job.user] -= 1
+            if not self.user_running[job.user]: del(self.user_running[job.user])
+            self.running -= 1
+        finally:
+            self.lock.release()
+        self.emit(job,None,None)
+        job.done.set()
+        self.schedule()
+    def emit(self,job,stream,line):
+        (job.output or self.output)(job,stream,line)
+    def read_output(self,job,pipe,stream,lines):
+        for line in iter(pipe.readline,''):
+            lines.append(line)
+            self.emit(job,stream,line)
+        pipe.close()
+    def cancel(self,job):
+        '''Stops a job - taking it off its queue if it hasn't started, or terminating it if it has'''
+        self.lock.acquire()
+        try:
+            if job.state == 'queued' and job in self.queues.get(job.user,()):
+                self.queues[job.user].remove(job)
+                job.state = 'cancelled'
+                dequeued = True
+            else: dequeued = False
+            job.cancel_requested = True
+        finally:
+            self.lock.release()
+        if dequeued:
+            self.emit(job,None,None)
+            job.done.set()
+        elif job.process is not None and job.returncode is None:
+            try: job.process.terminate()
+            except OSError: pass    # It finished in the meantime
+    def active_jobs(self):
+        return [ job for job in self.jobs if job.state in ('queued','running') ]
+
+class Batch:
+    '''Runs a batch of actual-commands in parallel, given as a list of (position, actual-command).
+Rather than a sudo su - for every command, each user's commands are sent down a shared shell (or a
+few shells, if there are fewer users than workers), with marker lines echoed around each command so
+that its output and exit status can be picked out again.  At most max_workers shells run at once.
+Given a SessionPool, the shells come from that.'''
+    def __init__(self,commands,max_workers=4,done=None,pool=None,audit=None):
+        self.max_workers = max_workers
+        self.done = done
+        self.pool = pool            # a SessionPool to use rather than starting shells of our own
+        self.audit = audit          # an AuditLog to record the jobs in
+        self.jobs = []
+        for (path,text) in commands:
+            (user,command) = split_command(text)
+            job = Job(len(self.jobs) + 1,user,command)
+            job.path = path
+            self.jobs.append(job)
+        self.start_time = self.end_time = None
+        self.finished = threading.Event()
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+    def wait(self):
+        while not self.finished.wait(0.5): pass
+    def sessions(self):
+        '''Splits the jobs up into lists of jobs for the same user, each to be run in one shell'''
+        by_user = OrderedDict()
+        for job in self.jobs: by_user.setdefault(job.user,[]).append(job)
+        per_user = max(1,self.max_workers // max(1,len(by_user)))
+        sessions = []
+        for jobs in by_user.values():
+            count = min(per_user,len(jobs))
+            sessions.extend([ jobs[i::count] for i in range(count) ])
+        return sessions
+    def run(self):
+        self.start_time = time.time()
+        sessions = Queue.Queue()
+        for session in self.sessions(): sessions.put(session)
+        workers = [ threading.Thread(target=self.worker,args=(sessions,))
+                    for i in range(min(self.max_workers,sessions.qsize())) ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers: worker.join()
+        self.end_time = time.time()
+        if self.audit is not None:
+            for job in self.jobs: self.audit.record(job)
+        self.finished.set()
+        if self.done is not None: self.done(self)
+    def worker(self,sessions):
+        while True:
+            try: jobs = sessions.get_nowait()
+            except Queue.Empty: return
+            if self.pool is None: run_in_session(jobs)
+            else:
+                for job in jobs: self.pool.run(job)
+
+    def summary(self):
+        '''A table of how each command got on, followed by their output'''
+        ok = len([ job for job in self.jobs if job.state == 'finished' and job.returncode == 0 ])
+        lines = [ "Batch of %d commands: %d ok, %d failed, %.2fs" % (len(self.jobs), ok, len(self.jobs) - ok,
+                                                                     (self.end_time or time.time()) - self.start_time),
+                  "%-4s %-10s %-5s %-9s %-12s %s" % ('#', 'status', 'rc', 'time', 'user', 'menu position') ]
+        for job in self.jobs:
+            lines.append("%-4d %-10s %-5s %-9s %-12s %s" % (job.number, job.state,
+                '-' if job.returncode is None else job.returncode, '%.2fs' % job.wall_time(), job.user, '/'.join(job.path)))
+        for job in self.jobs:
+            if job.stdout or job.stderr:
+                lines.append("\n--- %d: %s ---" % (job.number, '/'.join(job.path)))
+                lines.extend([ line.rstrip('\n') for line in job.stdout ])
+                lines.extend([ 'stderr: ' + line.rstrip('\n') for line in job.stderr ])
+        return '\n'.join(lines) + '\n'
+
+def session_script(jobs,token,first=0):
+    '''The shell script that runs each of the jobs in turn, marking where each one's output starts
+and finishes (on both stdout and stderr) and what its exit status was.  The jobs are numbered
+from first in the markers.  Each marker has a newline put before it, so that it starts a line of its
+own even when the output before it doesn't end with one (marked_output takes it off again).'''
+    lines = []
+    for i in range(len(jobs)):
+        number = first + i
+        lines.append("printf '\\n__MENU_BEGIN__ %s %d\\n'; printf '\\n__MENU_BEGIN__ %s %d\\n' >&2" % (
+                     token, number, token, number))
+        # A subshell, so a command that exits or changes directory doesn't affect the ones after it,
+        # and stdin from /dev/null, so it can't eat the commands after it either.  The command is
+        # quoted and eval'ed rather than pasted in, so that one with a syntax error (eg. an unterminated
+        # quote) fails on its own instead of swallowing the end marker and everything after it.
+        lines.append("(\neval '%s'\n) < /dev/null" % jobs[i].command.replace("'","'\\''"))
+        lines.append("printf '\\n__MENU_END__ %s %d %%d\\n' $?; printf '\\n__MENU_END__ %s %d\\n' >&2" % (
+                     token, number, token, number))
+    return '\n'.join(lines) + '\n'
+
+def marked_output(pipe,token):
+    '''Generator going through the output of session_script from pipe, giving ('begin', fields) and
+('end', fields) for the markers (fields being the job's number, then on stdout the end marker's exit
+status) and ('line', line) for everything else.  The newline put before a marker is taken off again:
+an empty line is held back until we know it isn't just that.  (Lines with something on them go straight
+out, so output isn't held up - the price being that output without a newline at the end gets one.)'''
+    begin = '__MENU_BEGIN__ %s ' % token
+    end = '__MENU_END__ %s ' % token
+    blank = False       # whether there's an empty line held back
+    for line in iter(pipe.readline,''):
+        if line.startswith(begin) or line.startswith(end):
+            blank = False
+            if line.startswith(begin): yield ('begin', line[len(begin):].split())
+            else: yield ('end', line[len(end):].split())
+            continue
+        if blank: yield ('line', '\n')
+        blank = line == '\n'
+        if not blank: yield ('line', line)
+    if blank: yield ('line', '\n')
+    pipe.close()
+
+def read_session_output(jobs,pipe,stream,token,stray):
+    '''Reads the output of session_script from pipe, sharing it out between the jobs.
+Anything output outside of any job (eg. sudo complaining) goes in the stray list.'''
+    job = None
+    for (kind, value) in marked_output(pipe,token):
+        if kind == 'begin':
+            job = jobs[int(value[0])]
+            if stream == 'stdout':
+                job.start_time = time.time()
+                job.state = 'running'
+        elif kind == 'end':
+            if stream == 'stdout':
+                job.returncode = int(value[1])
+                job.end_time = time.time()
+                job.state = 'finished'
+            job = None
+        elif job is not None:
+            getattr(job,stream).append(value)
+        else: stray.append(value)
+
+def run_in_session(jobs):
+    '''Runs all the jobs (which must be for the same user) one after the other in a single sudo su -'''
+    import subprocess, binascii
+    token = binascii.hexlify(os.urandom(8))
+    try:
         process = subprocess.Popen(
-                    "sudo su - %s" % user,
+                    LOGIN_COMMAND % jobs[0].user,
                     stdin=subprocess.PIPE,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE,
                     shell=True)
-    
-        (stdout_value,stderr_value) = process.communicate(command)
-        returncode = process.pid
-                    
-        print "stdout: \n%s" % stdout_value
-        print "stderr: \n%s" % stderr_value
-        print "returncode: %s" % returncode
-        print "\n\n------------------------------------------\n\n"
-
+    except OSError, error:
+        for job in jobs:
+            job.state = 'failed'
+            job.stderr.append(str(error))
         return
-        
-        
-        
-        
-        
-        
-def run_text_menu(menu):
-    while True:
-        print "\n****** Menu ******"
+    stray = []
+    readers = [ threading.Thread(target=read_session_output,args=(jobs,process.stdout,'stdout',token,stray)),
+                threading.Thread(target=read_session_output,args=(jobs,process.stderr,'stderr',token,stray)) ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    try:
+        process.stdin.write(session_script(jobs,token))
+        process.stdin.close()
+    except IOError:
+        pass
+    process.wait()
+    for reader in readers: reader.join()
+    # Anything that didn't finish didn't get the chance - the shell must have died
+    for job in jobs:
+        if job.state != 'finished':
+            job.state = 'failed'
+            job.stderr.extend(stray)
+            if job.start_time is not None and job.end_time is None: job.end_time = time.time()
 
+class Session:
+    '''A long lived LOGIN_COMMAND shell for one user.  Commands are sent down it one at a time, wrapped
+in the same markers as a Batch's commands so that each one's output and exit status can be picked
+out, which saves logging in all over again for every command.'''
+    def __init__(self,user):
+        import subprocess, binascii
+        self.user = user
+        self.token = binascii.hexlify(os.urandom(8))
+        self.count = 0              # commands sent so far (and so the number the next one's markers get)
+        self.last_used = time.time()
+        self.alive = True
+        self.lock = threading.Lock()
+        self.job = None             # the job running now, if any
+        self.emit = None            # what to pass its output to as it arrives, if anything
+        self.ended = set()          # the streams the job's end marker has turned up on
+        self.started = False        # whether the job's begin marker has turned up
+        self.finished = threading.Event()   # set once the job's over, or the shell has gone
+        self.stray = deque(maxlen=20)   # the last of anything output outside any command (eg. sudo complaining)
+        # (an OSError from here is for the caller)
+        self.process = subprocess.Popen(LOGIN_COMMAND % user,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        shell=True)
+        for (pipe, stream) in ((self.process.stdout,'stdout'),(self.process.stderr,'stderr')):
+            reader = threading.Thread(target=self.read,args=(pipe,stream))
+            reader.daemon = True
+            reader.start()
 
-        # Zero option is always 'go up one level' ...
-        print "%d:(%s): %s\n" % (0,'Parent-menu','Go back up one level')
+    def read(self,pipe,stream):
+        in_job = False
+        for (kind, value) in marked_output(pipe,self.token):
+            if kind == 'begin':
+                in_job = True
+                if stream == 'stdout':
+                    self.started = True
+                    self.job.start_time = time.time()
+                    self.job.state = 'running'
+            elif kind == 'end':
+                in_job = False
+                self.lock.acquire()
+                try:
+                    if stream == 'stdout':
+                        self.job.returncode = int(value[1])
+                        self.job.end_time = time.time()
+                    self.ended.add(stream)
+                    if len(self.ended) == 2: self.finished.set()
+                finally:
+                    self.lock.release()
+            elif in_job:
+                getattr(self.job,stream).append(value)
+                if self.emit is not None: self.emit(self.job,stream,value)
+            else: self.stray.append(value)
+        self.alive = False
+        self.finished.set()
 
-        # These are the current options ...
-        options = menu.get_options(menu.position)
-        
-        # A dictionary that will keep track of what the 
-        # numbered menu options actually refer to under the cover
-        index_dict = {}
-        
-        label = 0
-        # Loop through options and print them to the screen
-        for index1 in range(len(options.items())):
-            key,value = sorted(options.items())[index1]
-            
-            # Create a multi-line variable showing where you are in the menu, and print it.
-            location_text = 'Root'
-            for index in range(len(key)):
-                if index == len(key) -1: location_text = location_text + '\n' + '--' * (index + 1) + '>' + key[index]
-                else: location_text = location_text + '\n' + '--' * (index + 1) + key[index]            
-            print "%s:" % location_text
-            
-            for index2 in range(len(value)):
-                label = label + 1
-                # Make a note of the menu number label -> indexes mapping
-                index_dict[label] = (index1,index2)
-                # Is the option a command or submenu?  Work this out so we can label it.
-                category = menu.categorise(list(key),value[index2])
-                if category == -1: sys.exit("Some error has occurred")
-                
-                print "%d:(%s):\t%s" % (label,category,value[index2])
-            print "\n-------------------\n"
-        
-        # Take user input
-        choice = raw_input('\nMake your choice: ')
-        
-        # Process user input
-        if choice == '0': menu.go_up()
-        elif re.search(r'(quit|exit)',choice): sys.exit()
-        elif re.search(r'^$',choice): pass  # Do nothing if nothing has been entered
+    def run(self,job,emit=None):
+        '''Sends job down the shell, returning once it's over or the shell has gone.  Returns whether
+the job got as far as starting.'''
+        (self.job, self.emit) = (job, emit)
+        (self.ended, self.started) = (set(), False)
+        self.finished.clear()
+        job.process = self.process  # so cancelling the job kills the shell, which we'll then replace
+        try:
+            self.process.stdin.write(session_script([job],self.token,self.count))
+            self.process.stdin.flush()
+        except IOError:
+            self.alive = False
+            self.finished.set()
+        self.count += 1
+        cancelled_at = None
+        # (waiting with a timeout, as otherwise Ctrl + c isn't noticed until the job finishes)
+        while not self.finished.wait(0.5):
+            if job.cancel_requested:
+                # Anything the command left running can hold the shell's output open, so don't wait long
+                if cancelled_at is None: cancelled_at = time.time()
+                elif time.time() - cancelled_at > 1.0:
+                    self.alive = False
+                    break
+        self.lock.acquire()
+        try:
+            (self.job, self.emit) = (None, None)
+        finally:
+            self.lock.release()
+        self.last_used = time.time()
+        return self.started
+
+    def close(self):
+        '''Lets the shell finish (it exits once its stdin is closed)'''
+        self.alive = False
+        try: self.process.stdin.close()
+        except IOError: pass
+
+class SessionPool:
+    '''Keeps Sessions open to be reused, so each user only has a login shell started when they first
+need one rather than for every command.  A session left idle for idle_timeout seconds is closed, and
+one that dies is dropped - the user's next command just starts another.'''
+    def __init__(self,idle_timeout=300):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}          # user -> their idle sessions
+        self.started = 0        # how many sessions have been started altogether
+        self.reaper = None
+
+    def acquire(self,user):
+        '''Returns an idle session for user, or a new one if they haven't got one'''
+        self.lock.acquire()
+        try:
+            while self.idle.get(user):
+                session = self.idle[user].pop()
+                if session.alive: return session
+        finally:
+            self.lock.release()
+        session = Session(user)
+        self.lock.acquire()
+        try:
+            self.started += 1
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+        finally:
+            self.lock.release()
+        return session
+
+    def release(self,session):
+        if not session.alive:
+            session.close()
+            return
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(session.user,[]).append(session)
+        finally:
+            self.lock.release()
+
+    def reap(self):
+        '''Closes sessions that have been idle too long (runs in its own thread)'''
+        while True:
+            time.sleep(max(1.0,min(self.idle_timeout / 2.0,30.0)))
+            expired = []
+            self.lock.acquire()
+            try:
+                for user in self.idle.keys():
+                    keep = []
+                    for session in self.idle[user]:
+                        if session.alive and time.time() - session.last_used < self.idle_timeout: keep.append(session)
+                        else: expired.append(session)
+                    if keep: self.idle[user] = keep
+                    else: del(self.idle[user])
+            finally:
+                self.lock.release()
+            for session in expired: session.close()
+
+    def run(self,job,emit=None):
+        '''Runs job in one of its user's sessions, setting its state once it's over.  If the session turns
+out to have died before the job could begin (eg. it was killed while it was idle), the job is tried
+again in a new one.'''
+        for attempt in range(2):
+            if job.cancel_requested: break
+            try:
+                session = self.acquire(job.user)
+            except OSError, error:
+                job.stderr.append(str(error))
+                break
+            fresh = session.count == 0
+            started = session.run(job,emit)
+            self.release(session)
+            if started or fresh: break
+        if job.cancel_requested: job.state = 'cancelled'
+        elif job.returncode is not None: job.state = 'finished'
         else:
-            if re.search(r'^\d+$',choice):
-                # They've picked a menu entry as opposed to a search
-                # Using the index_dict, work out what position and option they've chosen
-                index1,index2 = index_dict[int(choice)]
-                position, entries = sorted(options.items())[index1]
-                option = entries[index2]
-            else: position, option = menu.position, choice
-            #if menu.choose_option(menu.position,menu.specify_option(menu.position,choice)) == -1:
-            if menu.choose_option(list(position),option) == -1:
-                sys.exit('Some error has occurred')
-    return
-    
-class Button:
-    def __init__(self,frame,position,GUI):
-        self.frame = frame
-        self.colour = tk.StringVar()
-        self.variable = tk.StringVar()
-        # 'executed' is used for command buttons, and is set to 'yes' when they are pressed
-        # This is because it's useful to reset the appearance of all buttons and then redo the
-        # appearance of the pressed ones as necessary.  command buttons are a bit more tricky,
-        # because if you press them twice you want the command to be executed and the button to then
-        # appear unpressed, which is what this variable helps with.
-        self.executed = tk.StringVar()
-        self.executed.set('no')
-        self.position = position
-        GUI.buttons[tuple(position)] = self
-        self.type = GUI.menu.categorise(self.position[:-1],self.position[-1])
-        if self.type == 'command':
-            self.actual_command = GUI.menu.menu_dict[tuple(self.position)][0]
-            self.default_colour = GUI.colour_scheme['command-initial']
-            self.colour_when_pressed = GUI.colour_scheme['command-final']         
+            job.state = 'failed'
+            if not job.stderr: job.stderr.extend(session.stray)
+            if not job.stderr: job.stderr.append("The shell it was running in exited\n")
+            if job.start_time is not None and job.end_time is None: job.end_time = time.time()
+
+# Exit codes for the headless modes (otherwise, --run exits with the command's own returncode)
+EXIT_NOT_FOUND = 2      # the PATH isn't in the menu (or, for --run, isn't a command)
+EXIT_BAD_REGEX = 3
+EXIT_FAILED = 125       # the command couldn't be started at all
+
+def run_headless(menu, options):
+    '''Does a single --run, --list or --search without any menu, returning the exit code'''
+    import json
+    if options.search is not None:
+        if menu.search_mode == 'fuzzy':
+            # Already in order, best first
+            matches = menu.find_fuzzy(options.search).items()
         else:
-            self.default_colour = GUI.colour_scheme['not-selected']
-            self.colour_when_pressed = GUI.colour_scheme['selected']
-        self.reset()
-        self.button = tk.Button(frame,bg=self.colour.get(),activebackground=self.colour.get(),text=self.position[-1],relief=self.relief,command = partial(GUI.button_press,self))
-
-        # Also want to make the command_display_frame show underlying command
-        # or menu position (useful when doing a search) when mouse hovers over button
-        self.button.bind("<Enter>", partial(GUI.display_command,self,True))
-        self.button.bind("<Leave>", partial(GUI.display_command,self,False))
-        
-    def reset(self):
-        # Just resetting the appearance)
-        self.relief = tk.RAISED
-        self.colour.set(self.default_colour)
-    def press(self):
-        self.relief = tk.SUNKEN
-        self.colour.set(self.colour_when_pressed)
-    def pack(self):
-        self.button.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
-
-                
-class GUI:
-    ''' The top line of the GUI will be an inert button labelled 'search' (purely used as a label)
-    alongside a text entry box, into which the user can type a regex to pull up the appropriate menu
-    buttons as opposed to navigating the menu itself.  Underneath will a field used to display the
-    actual underlying commad whenever the mouse hovers over a command button.  Under that, the actual
-    menu buttons - the main tree on the left, and each time a button is pressed the buttons on the next
-    branch will appear alongside it.  Button colours will indicate whether an option is leading to
-    a submenu or whether it will actually execute a command.'''
-    def __init__(self, master, menu):
-        self.menu = menu
-        self.master = master
-        self.colour_scheme = dict([
-        ('not-selected','white'),
-        ('selected','grey'),
-        ('command-initial','yellow'),
-        ('command-final','red'),
-        ('menu-title','white'),
-        ('bad-regex','yellow'),
-        ])
-        self.buttons = {}        # key is the position as a tuple
-        self.button_frames = {}  # key is the position as a tuple
-        # There will be three frames - one for the 'search' label and input box,
-        # one to display the underlying actual-command whenever the mouse hovers
-        # over a command button and one for all the buttons.
-        self.search_frame = tk.Frame(self.master)
-        self.search_frame.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
-        self.command_display_frame = tk.Frame(self.master)
-        self.command_display_frame.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
-        self.command_display_contents = tk.StringVar()
-        self.command_display_button = tk.Entry(self.command_display_frame,textvariable = self.command_display_contents,width=len(self.command_display_contents.get()),state=tk.DISABLED,disabledforeground='black')
-        self.command_display_button.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
-        self.button_frame = tk.Frame(self.master)
-        self.button_frame.pack(side=tk.TOP,fill=tk.X)
-        self.test = tk.Frame(self.button_frame)
-        self.test.pack(side=tk.LEFT,fill=tk.X,anchor=tk.N)
-        # Putting the 'search label' and input box into the search frame
-        self.search_label = object()
-        self.search_label.button = tk.Button(self.search_frame,text='Search',state=tk.DISABLED,disabledforeground='black')
-        self.search_label.button.pack(side=tk.LEFT,fill=tk.X,anchor=tk.N)
-        self.search_entry = object()
-        self.search_entry.input = tk.StringVar()  # Variable to keep the contents of the search
-        self.search_entry.colour = tk.StringVar()
-        self.search_entry.colour.set(self.colour_scheme['not-selected'])
-        self.search_entry.button = tk.Entry(self.search_frame,textvariable=self.search_entry.input,bg=self.search_entry.colour.get(),state=tk.NORMAL,)
-        self.search_entry.button.focus_set()
-        # The binding on the line below triggers the search event on each key press
-        self.search_entry.button.bind("<KeyRelease>", self.search)     
-        self.search_entry.button.pack(side=tk.LEFT,fill=tk.X,anchor=tk.N)
-
-        # Display buttons for current position
-        self.display_buttons([])
-
-    def display_command(self,button,true_or_false,event):
-        ''' when the mouse hovers over a command, this function displays the actual command underneath
-        in the command_display_buttons.  If it is a submenu, the position is displayed.'''
-        # For some reason, in unix, when the mouse hovers over the button, it loses it's colour.
-        if button.type == 'command': text = button.actual_command
-        else: text = str(button.position)
-        if true_or_false == True:
-            self.command_display_contents.set(text)
+            try:
+                matches = menu.find(options.search)
+            except re.error, error:
+                sys.stderr.write("Bad regex %r: %s\n" % (options.search, error))
+                return EXIT_BAD_REGEX
+            matches = [ (key, sorted(value)) for (key, value) in sorted(matches.items()) ]
+        entries = []
+        for (key, value) in matches:
+            types = menu.option_types(key)
+            for option in value:
+                entries.append({'path': list(key) + [option], 'type': types[option]})
+        if options.json: print json.dumps(entries)
         else:
-            self.command_display_contents.set('')
-        # Don't seem to need to call 'configure' to get this to update
-        # A property of bindings, perhaps?
-        return
-        
-        
-    def display_buttons(self,position):
-        # We're supposing here someone has just clicked a button, as opposed to doing a search.
-        # Position is a list defining the current position for which we want to display buttons.
-        # Think I will have to use a different function to display the results of a search.
-        # eg. ['level1','level2','level3']
-        # First thing is to remove unwanted button frames and their associated buttons
-        for frame in self.button_frames.keys()[:]:
-            if frame != tuple(position[:len(frame)]):
-                # Above if statement means we are talking about a frame we don't want displayed any more
-                # First, remove the stored references to all its buttons
-                for button in self.buttons.keys()[:]:
-                    if self.buttons[button].frame == self.button_frames[frame]:
-                        del(self.buttons[button])
-                # Now stop displaying the frame (and thus all it's buttons) and the reference to that
-                self.button_frames[frame].pack_forget()
-                #self.button_frames[frame].destroy()   # don't think I need this
-                del(self.button_frames[frame])
-        
-        # Now we create all the frames and buttons we need, starting with the base frame
-        # This would only ever be deleted when someone performs a search as opposed to clicking through the menu
-        # (the following looks complicated - it's just that get_options returns a dict, and '()' is the key
-        # for the root of the menu
-        # this is probably a mistake - it was me trying to be consistent, but things would look much
-        # simpler if it just returned a list of the options rather than a dictionary with a single entry!)
-        if () not in self.button_frames:
-            self.button_frames[()] = tk.Frame(self.button_frame)
-            self.button_frames[()].pack(side=tk.LEFT,anchor=tk.N)
-            for option in self.menu.get_options([])[()]:
-                button = Button(self.button_frames[()],[option],self)
-                button.pack()
-            
-        
-        # Now I build up the menu from left to right, one level at a time,
-        # until I've displayed the level required.
-        # If the button that has this position is an actual command, we don't want to 
-        # create a frame for it, as that would only contain the underlying 'actual-command'
-        # (the 'actual command' isn't supposed to be a button - 
-        # it's a command that's executed by clicking the parent 'command' button).
+            for entry in entries: print "%s\t%s" % (entry['type'], options.separator.join(entry['path']))
+        return 0
 
-        for i in range(len(position)):
-            
-            # A new frame for the next lot of buttons if it doesn't already exist,
-            # unless it's for a command
-            # (the 'actual command' isn't supposed to be a button - 
-            # it's a command that's executed by clicking the parent 'command' button).
-            temp_position = position[:i+1]
-            if tuple(temp_position) not in self.button_frames:
-                if self.menu.categorise(temp_position[:-1],temp_position[-1]) != 'command':
-                    # We need to create the frame and populate it with buttons
-                    self.button_frames[tuple(temp_position)] = tk.Frame(self.button_frame)
-                    self.button_frames[tuple(temp_position)].pack(side=tk.LEFT,anchor=tk.N)
-                    for option in self.menu.get_options(temp_position)[tuple(temp_position)]:
-                        frame = self.button_frames[tuple(temp_position)]
-                        button = Button(frame,temp_position + [option],self)  # This also puts an entry in self.buttons
-                        button.pack()
-        
-        # Colour and set the relief of all the buttons.
-        # Reset appearance of all buttons except the current one
-        for other_button in self.buttons.values(): 
-            other_button.reset()
-        
-        # Now ensure the correct buttons appear pressed
-        # The complication is that when you press a primed command, the command is executed and
-        # the button is then effectively un-pressed, so in this case I don't want to press it again
-        for other_button in self.buttons.values():
-            if tuple(other_button.position) == tuple(position[:len(other_button.position)]):
-                other_button.press()
-                
-        for button in self.buttons.values():
-            # If we've just executed a command, un-prime the command (set it back to its default colour)
-            if button.executed.get() == 'yes':
-                button.executed.set('')
-                button.reset()
-            button.button.configure(bg=button.colour.get(),activebackground=button.colour.get(),relief=button.relief)
+    path = options.run if options.run is not None else options.list
+    position = menu.resolve(path, options.separator)
+    if position is None:
+        sys.stderr.write("No such menu position: %s\n" % path)
+        return EXIT_NOT_FOUND
+    category = 'sub-menu' if position == [] else menu.categorise(position[:-1], position[-1])
+    if category == 'actual-command':
+        # ie. the path goes on past a command into what it runs, which isn't somewhere in the menu
+        sys.stderr.write("No such menu position: %s\n" % path)
+        return EXIT_NOT_FOUND
 
-        return
-    
-    def search(self,event):
-        # I don't want this function doing a search unless a regular ASCII 
-        # character is pressed (or backspace)
-        # We also don't want it doing a search unless we have a legitimate regex
-        # Idea is to turn the search box yellow whilst expression isn't valid
-        colour_var = self.search_entry.colour
-        if self.search_entry.input.get() == '':
-            # I want this to be the equivalent of not having done a search -
-            # effectively loading the menu for the first time.
-            # I set the base position and clear the menu.search_dict
-            self.menu.position = []
-            colour_var.set(self.colour_scheme['not-selected'])
-            self.search_entry.button.configure(bg=colour_var.get())
-            self.display_buttons(self.menu.position)
+    if options.list is not None:
+        if category == 'sub-menu':
+            types = menu.option_types(position)
+            result = {'path': position, 'type': category,
+                      'options': [ {'label': option, 'type': types[option]} for option in sorted(types) ]}
         else:
-            if event.char != '' or event.keysym == 'BackSpace':
-                try:
-                    options_dict = self.menu.search(self.search_entry.input.get())
-                    # The text menu relies on the stored search_dict.  The GUI menu does not.
-                    del(self.menu.search_dict)
-                except:
-                    # Likely user has entered a partially complete regex
-                    # Let's turn the colour yellow to let them know
-                    colour_var.set(self.colour_scheme['bad-regex'])
-                    self.search_entry.button.configure(bg=colour_var.get())
-                    options_dict = {}
-                else:
-                    # Search ran ok - string must be a valid regex
-                    # Make sure colour of text box reflects that
-                    colour_var.set(self.colour_scheme['not-selected'])
-                    self.search_entry.button.configure(bg=colour_var.get())
-
-                    # I don't seem to be able to remove individual buttons - just whole frames
-                    # Therefore, for each search we remove all buttons and frames and re-populate
-                    for button in self.buttons.keys()[:]: del(self.buttons[button])
-                    for frame in self.button_frames.keys()[:]:
-                        self.button_frames[frame].pack_forget()
-                        del(self.button_frames[frame])
-                    
-                    # Initially, when you've only pressed one character, the search function can return a LOT
-                    # of values.  There is an annoying bug in unix where the frame doesn't resize down after you've
-                    # displayed more than 70 buttons in it, but also it's unpractical, of course, because you can't
-                    # fit 70 buttons on a screen at once anyway.  I should batch them up alongside each other in sets of 20.
-                    batch_size = 20
-                    button_list = []
-                    for menu_level, options in options_dict.items():
-                        for option in options:
-                            button_list.append((menu_level,option))
-                    
-                    list_of_batches = [ button_list[i:i+batch_size] for i in range(0,len(button_list),batch_size) ]
-                    
-                    for batch in list_of_batches:
-                        self.button_frames[tuple(batch)] = tk.Frame(self.button_frame)
-                        self.button_frames[tuple(batch)].pack(side=tk.LEFT,anchor=tk.N)
-                        for (menu_level, option) in batch:
-                            button = Button(self.button_frames[tuple(batch)],list(menu_level) + [option],self)
-                            button.pack()
-                    '''
-                    self.button_frames['search'] = tk.Frame(self.button_frame)
-                    self.button_frames['search'].pack(side=tk.LEFT,anchor=tk.N)
-
-                        
-                    for menu_level, options in options_dict.items():
-                        for option in options:
-                            button = Button(self.button_frames['search'],list(menu_level) + [option],self)
-                            button.pack()
-                    '''
-        return
+            result = {'path': position, 'type': category, 'command': menu.menu_dict[tuple(position)][0]}
+        if options.json: print json.dumps(result)
+        elif category == 'sub-menu':
+            for option in result['options']: print "%s\t%s" % (option['type'], option['label'])
+        else: print result['command']
+        return 0
 
-    def button_press(self,button):
-        self.menu.position = button.position
-        
-        # If button is a primed command, execute the command
-        if button.type == 'command' and button.colour.get() == button.colour_when_pressed:
-            self.menu.execute_command(button.actual_command)
-            button.executed.set('yes')
-            # Below is a bit of a silly bit of code to make the button flash.  ooohhh!
-            button.colour.set(self.colour_scheme['command-initial'])
-            button.button.configure(activebackground=button.colour.get())
-            button.button.flash()
-            button.button.flash()
-            
-
-        self.display_buttons(self.menu.position)
-        return
-        
-class object:
-    def __init__(self):
-        pass
-        
-    
-def run_gui_menu(menu):
-    root = tk.Tk()
-    root.title('Menu')
-    GUI(root,menu)
-    root.mainloop()
-    return
+    if category != 'command':
+        sys.stderr.write("Not a command: %s\n" % path)
+        return EXIT_NOT_FOUND
+    if not options.json:
+        # Pass the output straight through as it arrives
+        menu.runner.output = lambda job, stream, line: stream in ('stdout','stderr') and \
+            (sys.stdout if stream == 'stdout' else sys.stderr).write(line)
+    else: menu.runner.output = lambda job, stream, line: None
+    job = menu.execute_command(menu.menu_dict[tuple(position)][0], options.refresh, position)
+    job.wait()
+    if options.json:
+        print json.dumps({'path': position, 'user': job.user, 'command': job.command, 'state': job.state,
+                          'returncode': job.returncode, 'wall_time': job.wall_time(), 'cached_at': job.cached_at,
+                          'stdout': ''.join(job.stdout), 'stderr': ''.join(job.stderr)})
+    if job.state == 'failed':
+        if not options.json: sys.stderr.write(''.join(job.stderr) + '\n')
+        return EXIT_FAILED
+    if job.returncode < 0: return 128 - job.returncode  # killed by a signal, as the shell would report it
+    return job.returncode
 
 def main(): 
     
     # Parse input options
     options, args = parse_args(sys.argv[0:])
-    
-    # Read in menu config file
-    menu_dict = parse_config(options.config)
 
+    profiler = None
+    if options.profile or options.profile_dump or options.trace or os.environ.get('MENU_PROFILE','0') != '0':
+        import menu_profile
+        profiler = menu_profile.install(options.trace, options.profile_dump)
     
-    # Make an instance of the menu class
-    menu = Menu(menu_dict)
+    if options.connect:
+        # The server has the menu, so there's nothing to load
+        import socket
+        from menu_server import RemoteMenu, RemoteRunner
+        if profiler is not None: profiler.instrument_remote()
+        try:
+            # (the server does any caching of results, and keeps the audit log)
+            menu = RemoteMenu(options.connect, RemoteRunner(options.connect, options.max_jobs))
+        except socket.error, error:
+            sys.exit("Couldn't connect to %s: %s" % (options.connect, error))
+    else:
+        # Read in menu config file
+        menu_dict = load_config(options.config, options.rebuild_cache)
+        if options.compact: menu_dict = MenuTree(menu_dict)
+
+        # Make an instance of the menu class
+        sessions = None
+        if not options.no_sessions: sessions = SessionPool(options.session_idle)
+        audit = None
+        if options.audit_dir:
+            import menu_audit
+            try:
+                audit = menu_audit.AuditLog(options.audit_dir, options.audit_max_kb * 1024)
+            except OSError, error:
+                sys.exit("Couldn't use %s for the audit log: %s" % (options.audit_dir, error))
+        menu = Menu(menu_dict, CommandRunner(options.max_jobs, cache=ResultCache(options.cache_size, options.cache_dir),
+                                             sessions=sessions, audit=audit, max_per_user=options.max_jobs_per_user))
+
+    menu.search_mode = options.search_mode
+
+    watcher = None
+    if options.watch:
+        if options.connect or options.config == '-': sys.exit('--watch needs a config file to watch')
+        watcher = ConfigWatcher(options.config, menu)
+
+    if options.serve:
+        import socket
+        from menu_server import MenuServer
+        try:
+            server = MenuServer(options.serve, menu)
+        except socket.error, error:
+            sys.exit("Couldn't serve the menu on %s: %s" % (options.serve, error))
+        if watcher is not None:
+            thread = threading.Thread(target=server.watch,args=(watcher,options.watch_interval))
+            thread.daemon = True
+            thread.start()
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(options.serve)
+        return
     
+    # One shot, no menu at all ...
+    if options.run is not None or options.list is not None or options.search is not None:
+        sys.exit(run_headless(menu, options))
+
     # Run the menu GUI if user so wishes ...
-    if options.text == False: run_gui_menu(menu)
+    if options.text == False:
+        from menu_gui import run_gui_menu
+        if profiler is not None: profiler.instrument_gui()
+        run_gui_menu(menu, options.search_delay, watcher, int(options.watch_interval * 1000))
     
     # ... else run the text based menu.
-    if options.text == True: run_text_menu(menu)
+    if options.text == True:
+        from menu_text import run_text_menu
+        run_text_menu(menu, watcher)
     
     return
 
 if __name__ == "__main__":
+    # Run main() from the menu module rather than from __main__ - the front ends import menu, and if we
+    # carried on here they'd get a second copy of everything (so eg. their SearchCancelled wouldn't be ours)
+    import menu
     try:
-        main()
+        menu.main()
     except KeyboardInterrupt:
         sys.exit('Quitting')
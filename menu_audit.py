@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+import sys, os, re, time, threading, atexit, json, Queue, gzip, shutil, heapq
+'''
+The audit log - a record of every command the menu runs: where in the menu it was, who ran it, the
+user it ran as, when it started and finished, how it got on and how much output it gave.  See
+menu.py --audit-dir.  Nothing here is imported unless it's wanted.
+
+Writing the log mustn't slow the commands down, so CommandRunner just hands each finished job to
+AuditLog.record, which puts an entry on a queue, and a background thread writes the entries out in
+batches.  Each menu process appends to its own file of JSON lines in the audit directory (so there's
+no locking between them), and once the file gets to --audit-max-kb it's gzipped and another started.
+
+Run as a script, this answers questions about the log, eg.
+    python menu_audit.py -d DIR --since 7d --slowest 10     # the slowest commands this week
+    python menu_audit.py -d DIR --user root --failed        # every command run as root that failed
+    python menu_audit.py -d DIR --summary                   # runs, failures and timings per command
+It reads the files a line at a time, so however big the log has got, it doesn't all end up in memory.
+'''
+
+def to_unicode(text):
+    '''Commands and menu labels needn't be valid UTF-8, and json can only write out text that is, so
+anything that isn't is taken as latin-1 (which any string of bytes is)'''
+    if text is None or isinstance(text, unicode): return text
+    try: return text.decode('utf-8')
+    except UnicodeDecodeError: return text.decode('latin-1')
+
+class AuditLog:
+    '''Writes an entry for every job it's given to a file in directory, from a background thread'''
+    def __init__(self,directory,max_bytes=10 * 1024 * 1024,queue_size=10000,batch_size=200,flush_interval=1.0):
+        import getpass, socket
+        self.directory = directory
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval    # the longest an entry waits for others to be written with
+        self.queue = Queue.Queue(queue_size)
+        self.user = getpass.getuser()
+        self.host = socket.gethostname()
+        self.dropped = 0        # entries thrown away because the queue was full
+        self.reported = 0       # how many of those the log itself has been told about
+        self.failed = False     # whether we've said we can't write the log
+        self.f = None           # the file being written to, and its path and size
+        self.path = None
+        self.size = 0
+        self.files = 0          # how many files we've started, which goes in their names to keep them apart
+        self.closed = threading.Event()
+        writer = threading.Thread(target=self.write_entries)
+        writer.daemon = True
+        writer.start()
+        atexit.register(self.close)
+
+    def record(self,job):
+        '''Queues an entry for the (finished) job.  This never waits - if the writer can't keep up, the
+entry is dropped, and the log says how many were once it catches up.'''
+        entry = {'path': [ to_unicode(label) for label in job.path ] if job.path is not None else None,
+                 'user': to_unicode(job.user), 'command': to_unicode(job.command),
+                 'by': to_unicode(job.by or self.user), 'host': self.host, 'pid': os.getpid(),
+                 'start': job.start_time, 'end': job.end_time, 'state': job.state, 'returncode': job.returncode,
+                 'stdout_bytes': sum([ len(line) for line in job.stdout ]),
+                 'stderr_bytes': sum([ len(line) for line in job.stderr ]),
+                 'cached': job.cached_at is not None}
+        try:
+            self.queue.put_nowait(entry)
+        except Queue.Full:
+            self.dropped += 1
+
+    def write_entries(self):
+        '''Writes the queued entries, a batch at a time (runs in its own thread)'''
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0: break
+                try: batch.append(self.queue.get(True,timeout))
+                except Queue.Empty: break
+            closing = batch[-1] is None     # (what close() queues)
+            if closing: batch.pop()
+            if self.dropped > self.reported:
+                dropped = self.dropped
+                batch.append({'dropped': dropped - self.reported, 'time': time.time(), 'host': self.host,
+                              'pid': os.getpid()})
+                self.reported = dropped
+            if batch: self.write(batch)
+            if closing:
+                self.finish_file()
+                self.closed.set()
+                return
+
+    def write(self,batch):
+        lines = []
+        for entry in batch:
+            try:
+                lines.append(json.dumps(entry) + '\n')
+            except (TypeError, ValueError), error:
+                # One entry we can't write mustn't stop the rest (or the writer thread) - but say so
+                sys.stderr.write("Couldn't write an audit entry for %r: %s\n" % (entry.get('command'), error))
+        data = ''.join(lines)
+        try:
+            if self.f is None:
+                self.files += 1
+                self.path = os.path.join(self.directory, 'audit-%s-%s-%d-%d.jsonl' % (
+                    time.strftime('%Y%m%d-%H%M%S'), self.host, os.getpid(), self.files))
+                self.f = open(self.path,'ab')
+                self.size = 0
+            self.f.write(data)
+            self.f.flush()
+            self.size += len(data)
+            if self.size >= self.max_bytes: self.finish_file()
+        except (IOError, OSError), error:
+            # Not being able to write the log mustn't stop the menu, but someone ought to know
+            if not self.failed: sys.stderr.write("Couldn't write the audit log: %s\n" % error)
+            self.failed = True
+            self.f = None
+
+    def finish_file(self):
+        '''Closes the file being written to and gzips it'''
+        if self.f is None: return
+        self.f.close()
+        self.f = None
+        try:
+            # Compressed under another name, so nobody reads half a .gz
+            source = open(self.path,'rb')
+            temp_path = self.path + '.gz.tmp'
+            compressed = gzip.open(temp_path,'wb')
+            try:
+                shutil.copyfileobj(source,compressed)
+            finally:
+                compressed.close()
+                source.close()
+            os.rename(temp_path,self.path + '.gz')
+            os.remove(self.path)
+        except (IOError, OSError), error:
+            # It's still there uncompressed, which is fine for reading
+            sys.stderr.write("Couldn't compress %s: %s\n" % (self.path, error))
+
+    def close(self):
+        '''Writes out whatever's queued and compresses the last file (called on exit)'''
+        if self.closed.is_set(): return
+        try:
+            self.queue.put(None,True,5)
+        except Queue.Full:
+            return
+        self.closed.wait(10)
+
+def log_files(directory,since=None):
+    '''The audit files in directory, oldest first, leaving out any that were last written before since'''
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith('audit-') or not (name.endswith('.jsonl') or name.endswith('.jsonl.gz')): continue
+        path = os.path.join(directory,name)
+        try:
+            if since is not None and os.path.getmtime(path) < since: continue
+        except OSError:
+            pass    # Just compressed - it'll be there as a .gz, if we haven't already seen it
+        else: paths.append(path)
+    return paths
+
+def read_entries(paths):
+    '''Generator giving the entries in the files, one at a time'''
+    for path in paths:
+        try:
+            if path.endswith('.gz'): f = gzip.open(path,'rb')
+            else: f = open(path,'rb')
+        except IOError:
+            continue
+        try:
+            for line in f:
+                try: yield json.loads(line)
+                except ValueError: pass     # The last line of a file that's still being written
+        finally:
+            f.close()
+
+TIME_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+def parse_time(text):
+    '''A time given as eg. 7d, 12h or 30m ago, or as a date (YYYY-MM-DD, optionally followed by HH:MM)'''
+    match = re.search(r'^(\d+(?:\.\d+)?)([mhdw])$',text)
+    if match: return time.time() - float(match.group(1)) * TIME_UNITS[match.group(2)]
+    for format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try: return time.mktime(time.strptime(text,format))
+        except ValueError: pass
+    sys.exit("Can't make sense of the time %r - try eg. 7d, 12h or 2024-01-31" % text)
+
+def duration(entry):
+    if entry['start'] is None or entry['end'] is None: return 0.0
+    return entry['end'] - entry['start']
+
+def matching_entries(entries,options):
+    '''The entries (commands, not notes of dropped entries) that the options pick out'''
+    (since, until) = (parse_time(options.since) if options.since else None, parse_time(options.until) if options.until else None)
+    # (the entries' text is unicode - see to_unicode)
+    command = re.compile(to_unicode(options.command)) if options.command else None
+    path = re.compile(to_unicode(options.path)) if options.path else None
+    (user, by) = (to_unicode(options.user), to_unicode(options.by))
+    for entry in entries:
+        if 'command' not in entry: continue
+        if since is not None and (entry['start'] or 0) < since: continue
+        if until is not None and (entry['start'] or 0) >= until: continue
+        if user and entry['user'] != user: continue
+        if by and entry['by'] != by: continue
+        if options.failed and entry['state'] == 'finished' and entry['returncode'] == 0: continue
+        if command is not None and not command.search(entry['command']): continue
+        if path is not None and not path.search('/'.join(entry['path'] or [])): continue
+        yield entry
+
+def describe(entry):
+    return "%s %9.2fs %-9s %-4s %-10s %-10s %s\t%s" % (
+        time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(entry['start'] or 0)), duration(entry),
+        entry['state'] + ('*' if entry['cached'] else ''), '-' if entry['returncode'] is None else entry['returncode'],
+        entry['by'], entry['user'], '/'.join(entry['path'] or ['?']), entry['command'])
+
+def summary(entries):
+    '''Runs, failures and timings for each (user, command), busiest first'''
+    totals = {}     # (user, command) -> [runs, failures, total seconds, max seconds, output bytes]
+    for entry in entries:
+        total = totals.setdefault((entry['user'], entry['command']), [0, 0, 0.0, 0.0, 0])
+        seconds = duration(entry)
+        total[0] += 1
+        if entry['state'] != 'finished' or entry['returncode'] != 0: total[1] += 1
+        total[2] += seconds
+        total[3] = max(total[3],seconds)
+        total[4] += entry['stdout_bytes'] + entry['stderr_bytes']
+    lines = ["%6s %6s %10s %10s %12s %-10s %s" % ('runs', 'failed', 'mean', 'max', 'output', 'user', 'command')]
+    for ((user, command), total) in sorted(totals.items(), key=lambda item: -item[1][2]):
+        lines.append("%6d %6d %9.2fs %9.2fs %12d %-10s %s" % (total[0], total[1], total[2] / total[0], total[3],
+                                                              total[4], user, command))
+    return '\n'.join(lines)
+
+def parse_args():
+    ''' Parse the given options and arguments using optparse'''
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog -d DIR [options]')
+    parser.add_option("-d", "--dir", metavar="DIR", dest="dir",
+                        help="the audit directory (menu.py's --audit-dir)")
+    parser.add_option("--since", metavar="TIME", dest="since",
+                        help="only commands started since TIME - eg. 7d, 12h, 30m (ago), or YYYY-MM-DD [HH:MM]")
+    parser.add_option("--until", metavar="TIME", dest="until",
+                        help="only commands started before TIME")
+    parser.add_option("--user", metavar="USER", dest="user", help="only commands run as USER")
+    parser.add_option("--by", metavar="USER", dest="by", help="only commands USER ran")
+    parser.add_option("--command", metavar="REGEX", dest="command", help="only commands matching REGEX")
+    parser.add_option("--path", metavar="REGEX", dest="path", help="only commands whose menu path matches REGEX")
+    parser.add_option("--failed", dest="failed", default=False, action="store_true",
+                        help="only commands that failed or had a non-zero returncode. Default: False")
+    parser.add_option("--slowest", metavar="N", dest="slowest", type="int",
+                        help="just the N slowest commands, slowest first")
+    parser.add_option("--summary", dest="summary", default=False, action="store_true",
+                        help="runs, failures and timings for each command rather than each run. Default: False")
+    parser.add_option("--json", dest="json", default=False, action="store_true",
+                        help="give each run as a line of JSON. Default: False")
+    (options, args) = parser.parse_args()
+    if not options.dir: parser.error('which audit directory? (-d DIR)')
+    return (options,args)
+
+def main():
+    options, args = parse_args()
+    if not os.path.isdir(options.dir): sys.exit('No such directory: %s' % options.dir)
+    since = parse_time(options.since) if options.since else None
+    entries = matching_entries(read_entries(log_files(options.dir,since)),options)
+    if options.summary:
+        print summary(entries).encode('utf-8')
+        return
+    # (nlargest only ever holds N of them)
+    if options.slowest: entries = heapq.nlargest(options.slowest,entries,key=duration)
+    for entry in entries:
+        if options.json: print json.dumps(entry)
+        else: print describe(entry).encode('utf-8')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+import threading, Queue, Tkinter as tk
+from functools import partial
+from collections import OrderedDict
+from menu import SearchCancelled, job_summary
+'''
+The Tkinter front end to the menu, which is what menu.py runs unless told otherwise.
+'''
+
+class SearchWorker(threading.Thread):
+    '''Runs the GUI's searches in the background so typing never waits for a search to finish.
+Each search is numbered, and submitting a new one makes any earlier one obsolete - an obsolete
+search is skipped if it hasn't started, and abandoned if it has.  Results are put on the
+results queue as (number, query, matches, error) for the GUI to pick up.  Each search is
+either a 'regex' or a 'fuzzy' one (see Menu.search_mode).'''
+    def __init__(self,menu):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.menu = menu
+        self.generation = 0
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+    def submit(self,query,mode='regex'):
+        self.generation += 1
+        self.requests.put((self.generation,query,mode))
+        return self.generation
+    def cancel(self):
+        '''Makes whatever search is queued or running obsolete'''
+        self.generation += 1
+    def run(self):
+        while True:
+            (generation, query, mode) = self.requests.get()
+            if generation != self.generation: continue
+            cancelled = lambda: generation != self.generation
+            try:
+                if mode == 'fuzzy': matches = self.menu.find_fuzzy(query,cancelled)
+                else: matches = self.menu.find(query,cancelled)
+            except SearchCancelled:
+                continue
+            except Exception, error:
+                # Most likely a partially complete regex
+                self.results.put((generation,query,None,error))
+            else:
+                self.results.put((generation,query,matches,None))
+
+class Button:
+    def __init__(self,frame,position,GUI):
+        self.frame = frame
+        self.GUI = GUI
+        self.colour = tk.StringVar()
+        self.variable = tk.StringVar()
+        # 'executed' is used for command buttons, and is set to 'yes' when they are pressed
+        # This is because it's useful to reset the appearance of all buttons and then redo the
+        # appearance of the pressed ones as necessary.  command buttons are a bit more tricky,
+        # because if you press them twice you want the command to be executed and the button to then
+        # appear unpressed, which is what this variable helps with.
+        self.executed = tk.StringVar()
+        self.applied = None  # The (colour, relief) the tk button was last configured with
+        self.button = tk.Button(frame,command = partial(GUI.button_press,self))
+
+        # Also want to make the command_display_frame show underlying command
+        # or menu position (useful when doing a search) when mouse hovers over button
+        self.button.bind("<Enter>", partial(GUI.display_command,self,True))
+        self.button.bind("<Leave>", partial(GUI.display_command,self,False))
+        self.button.bind("<Button-3>", partial(GUI.batch_select,self))
+        self.assign(position)
+
+    def assign(self,position):
+        '''Sets the button up for the given position.  Buttons get reused for different positions
+rather than being thrown away and created again.'''
+        GUI = self.GUI
+        self.unregister()
+        self.executed.set('no')
+        self.position = position
+        GUI.buttons[tuple(position)] = self
+        self.type = GUI.menu.categorise(tuple(self.position[:-1]),self.position[-1])
+        if self.type == 'command':
+            self.actual_command = GUI.menu.menu_dict[tuple(self.position)][0]
+            self.default_colour = GUI.colour_scheme['command-initial']
+            self.colour_when_pressed = GUI.colour_scheme['command-final']         
+        else:
+            self.default_colour = GUI.colour_scheme['not-selected']
+            self.colour_when_pressed = GUI.colour_scheme['selected']
+        self.reset()
+        self.button.configure(text=self.position[-1])
+        self.apply()
+
+    def unregister(self):
+        '''Removes the GUI's reference to this button, if it still refers to it'''
+        if hasattr(self,'position') and self.GUI.buttons.get(tuple(self.position)) is self:
+            del(self.GUI.buttons[tuple(self.position)])
+
+    def reset(self):
+        # Just resetting the appearance)
+        self.relief = tk.RAISED
+        if tuple(self.position) in self.GUI.batch_selection:
+            self.colour.set(self.GUI.colour_scheme['batch-selected'])
+        else: self.colour.set(self.default_colour)
+    def press(self):
+        self.relief = tk.SUNKEN
+        self.colour.set(self.colour_when_pressed)
+    def apply(self):
+        '''Makes the tk button look like reset() / press() said it should, if it doesn't already'''
+        state = (self.colour.get(), self.relief)
+        if state != self.applied:
+            self.button.configure(bg=state[0],activebackground=state[0],relief=state[1])
+            self.applied = state
+    def pack(self):
+        self.button.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
+
+class ButtonFrame:
+    '''A column of buttons.  When a column is no longer wanted, the GUI keeps it (and its buttons) to
+reuse for the next column it needs, rather than destroying it and creating new widgets.'''
+    def __init__(self,parent,GUI):
+        self.GUI = GUI
+        self.frame = tk.Frame(parent)
+        self.buttons = []   # Every Button made in this frame ...
+        self.used = 0       # ... of which the first 'used' are packed and showing
+    def fill(self,positions):
+        '''Shows a button for each of the given positions, reusing the buttons already in the frame'''
+        for i in range(len(positions)):
+            if i >= len(self.buttons):
+                self.buttons.append(Button(self.frame,positions[i],self.GUI))
+            elif i >= self.used or self.GUI.buttons.get(tuple(positions[i])) is not self.buttons[i]:
+                # (a button already showing this position is left alone, unless it's in a column that
+                # was put aside and has since been forgotten about by the GUI)
+                self.buttons[i].assign(positions[i])
+            if i >= self.used: self.buttons[i].pack()
+        for button in self.buttons[len(positions):self.used]:
+            button.unregister()
+            button.button.pack_forget()
+        self.used = len(positions)
+    def live_buttons(self):
+        return self.buttons[:self.used]
+    def show(self):
+        self.frame.pack(side=tk.LEFT,anchor=tk.N)
+    def hide(self):
+        self.frame.pack_forget()
+    def destroy(self):
+        self.frame.destroy()
+
+class ResultsPane:
+    '''Shows search results as a single scrollable column.  However many results there are, only
+enough buttons to fill the column are ever created - scrolling just relabels them with the
+results further down the list.'''
+    def __init__(self,parent,GUI,rows=25):
+        self.rows = rows
+        self.results = []   # the positions of all the results we can scroll through
+        self.offset = 0     # the index of the result shown in the top button
+        self.frame = tk.Frame(parent)
+        self.column_frame = tk.Frame(self.frame)
+        self.column_frame.pack(side=tk.TOP,anchor=tk.N)
+        self.column = ButtonFrame(self.column_frame,GUI)
+        self.column.show()
+        self.scrollbar = tk.Scrollbar(self.column_frame,orient=tk.VERTICAL,command=self.scroll)
+        self.scrollbar.pack(side=tk.LEFT,fill=tk.Y)
+        # Says how many results didn't make it into the list at all
+        self.more = tk.StringVar()
+        self.more_label = tk.Label(self.frame,textvariable=self.more)
+        self.more_label.pack(side=tk.TOP,anchor=tk.W)
+    def show(self,results,total):
+        '''Displays results (a list of positions) from the top.  total is the number of results
+there were before they were cut down to the list we were given.'''
+        self.results = results
+        self.offset = 0
+        if total > len(results): self.more.set('%d more...' % (total - len(results)))
+        else: self.more.set('')
+        self.redraw()
+        self.frame.pack(side=tk.LEFT,anchor=tk.N)
+    def hide(self):
+        self.frame.pack_forget()
+        self.column.fill([])    # so the GUI no longer thinks the result buttons are there
+    def redraw(self):
+        self.column.fill(self.results[self.offset:self.offset + self.rows])
+        if self.results:
+            self.scrollbar.set(float(self.offset) / len(self.results),
+                               float(min(self.offset + self.rows, len(self.results))) / len(self.results))
+        else: self.scrollbar.set(0.0,1.0)
+    def scroll(self,action,amount,units=None):
+        '''Called by the scrollbar (and the mouse wheel) in the same way as a widget's yview would be'''
+        if action == 'moveto': offset = int(float(amount) * len(self.results))
+        elif units == 'pages': offset = self.offset + int(amount) * self.rows
+        else: offset = self.offset + int(amount)
+        offset = max(0,min(offset,len(self.results) - self.rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.redraw()
+
+class GUI:
+    ''' The top line of the GUI will be an inert button labelled 'search' (purely used as a label)
+    alongside a text entry box, into which the user can type a regex to pull up the appropriate menu
+    buttons as opposed to navigating the menu itself.  Underneath will a field used to display the
+    actual underlying commad whenever the mouse hovers over a command button.  Under that, the actual
+    menu buttons - the main tree on the left, and each time a button is pressed the buttons on the next
+    branch will appear alongside it.  Button colours will indicate whether an option is leading to
+    a submenu or whether it will actually execute a command.'''
+    def __init__(self, master, menu, search_delay=150, watcher=None, watch_interval=1000):
+        self.menu = menu
+        self.master = master
+        # If we've got a ConfigWatcher, it gets checked every watch_interval milliseconds
+        self.watcher = watcher
+        self.watch_interval = watch_interval
+        # Searches run on a worker thread, and only once typing has paused for search_delay milliseconds
+        self.search_delay = search_delay
+        self.search_poll_interval = 20
+        self.search_after = None    # The pending after() call that will start a search
+        self.search_polling = False
+        self.search_worker = SearchWorker(menu)
+        self.search_worker.start()
+        self.colour_scheme = dict([
+        ('not-selected','white'),
+        ('selected','grey'),
+        ('command-initial','yellow'),
+        ('command-final','red'),
+        ('menu-title','white'),
+        ('bad-regex','yellow'),
+        ('batch-selected','light blue'),
+        ])
+        self.buttons = {}        # key is the position as a tuple
+        self.button_frames = {}  # key is the position as a tuple, value a ButtonFrame
+        self.spare_frames = []   # ButtonFrames not currently displayed, kept to be reused
+        self.max_spare_frames = 10
+        self.results_pane = None     # Made the first time we have search results to show
+        self.max_search_results = 1000  # Don't bother listing any more results than this
+        self.pressed = set()     # positions of the buttons currently showing as pressed
+        self.batch_selection = OrderedDict()    # positions right-clicked to run as a batch (used as an ordered set)
+        # There will be three frames - one for the 'search' label and input box,
+        # one to display the underlying actual-command whenever the mouse hovers
+        # over a command button and one for all the buttons.
+        self.search_frame = tk.Frame(self.master)
+        self.search_frame.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
+        self.command_display_frame = tk.Frame(self.master)
+        self.command_display_frame.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
+        self.command_display_contents = tk.StringVar()
+        self.command_display_button = tk.Entry(self.command_display_frame,textvariable = self.command_display_contents,width=len(self.command_display_contents.get()),state=tk.DISABLED,disabledforeground='black')
+        self.command_display_button.pack(side=tk.TOP,fill=tk.X,anchor=tk.N)
+        self.button_frame = tk.Frame(self.master)
+        self.button_frame.pack(side=tk.TOP,fill=tk.X)
+        # Commands run in the background, and their output appears in a pane along the bottom as it
+        # arrives.  The runner calls queue_output from its own threads, so poll_output is what
+        # actually puts the output on the screen.
+        self.output_queue = Queue.Queue()
+        self.output_poll_interval = 100
+        self.menu.runner.output = self.queue_output
+        self.output_frame = tk.Frame(self.master)
+        self.output_frame.pack(side=tk.BOTTOM,fill=tk.BOTH)
+        self.cancel_button = tk.Button(self.output_frame,text='Cancel last job',command=self.cancel_job)
+        self.cancel_button.pack(side=tk.LEFT,anchor=tk.N)
+        # Right-clicking buttons selects them for a batch, and this runs them
+        self.batch_button = tk.Button(self.output_frame,text='Run batch (0)',command=self.run_batch)
+        self.batch_button.pack(side=tk.LEFT,anchor=tk.N)
+        # Commands marked cache=... in the config replay their last output until this is pressed
+        self.clear_cache_button = tk.Button(self.output_frame,text='Clear cache',command=self.clear_cache)
+        self.clear_cache_button.pack(side=tk.LEFT,anchor=tk.N)
+        self.output_scrollbar = tk.Scrollbar(self.output_frame,orient=tk.VERTICAL)
+        self.output_scrollbar.pack(side=tk.RIGHT,fill=tk.Y)
+        self.output_text = tk.Text(self.output_frame,height=10,state=tk.DISABLED,yscrollcommand=self.output_scrollbar.set)
+        self.output_text.pack(side=tk.LEFT,fill=tk.BOTH,expand=True)
+        self.output_scrollbar.configure(command=self.output_text.yview)
+        self.master.after(self.output_poll_interval,self.poll_output)
+        self.test = tk.Frame(self.button_frame)
+        self.test.pack(side=tk.LEFT,fill=tk.X,anchor=tk.N)
+        # Putting the 'search label' and input box into the search frame
+        self.search_label = object()
+        self.search_label.button = tk.Button(self.search_frame,text='Search',state=tk.DISABLED,disabledforeground='black')
+        self.search_label.button.pack(side=tk.LEFT,fill=tk.X,anchor=tk.N)
+        self.search_entry = object()
+        self.search_entry.input = tk.StringVar()  # Variable to keep the contents of the search
+        self.search_entry.colour = tk.StringVar()
+        self.search_entry.colour.set(self.colour_scheme['not-selected'])
+        self.search_entry.button = tk.Entry(self.search_frame,textvariable=self.search_entry.input,bg=self.search_entry.colour.get(),state=tk.NORMAL,)
+        self.search_entry.button.focus_set()
+        # The binding on the line below triggers the search event on each key press
+        self.search_entry.button.bind("<KeyRelease>", self.search)     
+        self.search_entry.button.pack(side=tk.LEFT,fill=tk.X,anchor=tk.N)
+        # Ticked, searches find the best few fuzzy matches for what's typed rather than treating it as a regex
+        self.fuzzy = tk.IntVar()
+        self.fuzzy.set(self.menu.search_mode == 'fuzzy')
+        self.fuzzy_button = tk.Checkbutton(self.search_frame,text='Fuzzy',variable=self.fuzzy,command=self.search_mode_changed)
+        self.fuzzy_button.pack(side=tk.LEFT,anchor=tk.N)
+
+        # The mouse wheel scrolls the search results, if they're showing (Button-4/5 are how X11 sends it)
+        self.master.bind_all("<MouseWheel>", lambda event: self.scroll_search_results(-event.delta / 120))
+        self.master.bind_all("<Button-4>", lambda event: self.scroll_search_results(-1))
+        self.master.bind_all("<Button-5>", lambda event: self.scroll_search_results(1))
+
+        # Display buttons for current position
+        self.display_buttons([])
+        if self.watcher is not None: self.master.after(self.watch_interval,self.check_config)
+
+    def display_command(self,button,true_or_false,event):
+        ''' when the mouse hovers over a command, this function displays the actual command underneath
+        in the command_display_buttons.  If it is a submenu, the position is displayed.'''
+        # For some reason, in unix, when the mouse hovers over the button, it loses it's colour.
+        if button.type == 'command': text = button.actual_command
+        else: text = str(button.position)
+        if true_or_false == True:
+            self.command_display_contents.set(text)
+        else:
+            self.command_display_contents.set('')
+        # Don't seem to need to call 'configure' to get this to update
+        # A property of bindings, perhaps?
+        return
+        
+        
+    def take_frame(self,key,positions):
+        '''Displays a column of buttons for the given positions, to the right of those already displayed'''
+        if self.spare_frames: button_frame = self.spare_frames.pop()
+        else: button_frame = ButtonFrame(self.button_frame,self)
+        button_frame.fill(positions)
+        button_frame.show()
+        self.button_frames[key] = button_frame
+        return button_frame
+
+    def release_frame(self,key):
+        '''Stops displaying a column of buttons, keeping it to reuse later if we don't have enough spare already'''
+        button_frame = self.button_frames.pop(key)
+        button_frame.hide()
+        for button in button_frame.live_buttons(): button.unregister()
+        if len(self.spare_frames) < self.max_spare_frames: self.spare_frames.append(button_frame)
+        else: button_frame.destroy()
+
+    def display_buttons(self,position):
+        # We're supposing here someone has just clicked a button, as opposed to doing a search.
+        # Position is a list defining the current position for which we want to display buttons.
+        # eg. ['level1','level2','level3']
+        # Rather than rebuild everything, work out which columns of buttons we want, and only
+        # add or remove the ones that are different to what's already displayed.
+        # There's always the root column, and then one for each level of position, unless it's for a
+        # command (the 'actual command' isn't supposed to be a button - 
+        # it's a command that's executed by clicking the parent 'command' button).
+        position = list(position)
+        if self.results_pane is not None: self.results_pane.hide()
+        wanted = [()]
+        for i in range(len(position)):
+            key = tuple(position[:i+1])
+            if self.menu.categorise(key[:-1],key[-1]) != 'command': wanted.append(key)
+        
+        # Columns are only ever added on the right, and the ones we no longer want (which includes
+        # any search results) are always to the right of the ones we're keeping, so the order stays right.
+        for key in self.button_frames.keys():
+            if key not in wanted: self.release_frame(key)
+        for key in wanted:
+            if key not in self.button_frames:
+                # (get_options returns a dict with a single entry, keyed by the position)
+                options = self.menu.get_options(list(key))[key]
+                self.take_frame(key,[ list(key) + [option] for option in options ])
+        
+        # Now ensure the correct buttons appear pressed.  Only the buttons on the path to position,
+        # and those that were pressed before, can have changed.
+        # The complication is that when you press a primed command, the command is executed and
+        # the button is then effectively un-pressed, so in this case I don't want to press it again
+        pressed = set([ tuple(position[:i+1]) for i in range(len(position)) ])
+        for key in pressed | self.pressed:
+            button = self.buttons.get(key)
+            if button is None: continue
+            if key in pressed and button.executed.get() != 'yes':
+                button.press()
+            else:
+                # If we've just executed a command, un-prime the command (set it back to its default colour)
+                button.executed.set('')
+                button.reset()
+            button.apply()
+        self.pressed = pressed
+
+        return
+    
+    def search(self,event):
+        # I don't want this function doing a search unless a regular ASCII 
+        # character is pressed (or backspace)
+        # We also don't want it doing a search unless we have a legitimate regex
+        # Idea is to turn the search box yellow whilst expression isn't valid
+        if self.search_after is not None:
+            self.master.after_cancel(self.search_after)
+            self.search_after = None
+        if self.search_entry.input.get() == '':
+            # I want this to be the equivalent of not having done a search -
+            # effectively loading the menu for the first time.
+            # I set the base position and forget about any search still going
+            self.search_worker.cancel()
+            self.search_polling = False
+            self.menu.position = []
+            self.set_search_colour('not-selected')
+            self.display_buttons(self.menu.position)
+        elif event.char != '' or event.keysym == 'BackSpace':
+            # Wait until they stop typing for a moment before searching
+            self.search_after = self.master.after(self.search_delay,self.start_search)
+        return
+
+    def search_mode_changed(self):
+        self.menu.search_mode = 'fuzzy' if self.fuzzy.get() else 'regex'
+        # Do whatever search is in the box again, the new way
+        if self.search_entry.input.get() != '':
+            if self.search_after is not None: self.master.after_cancel(self.search_after)
+            self.start_search()
+        self.search_entry.button.focus_set()
+
+    def start_search(self):
+        self.search_after = None
+        self.search_worker.submit(self.search_entry.input.get(),self.menu.search_mode)
+        if not self.search_polling:
+            # (the polling carries on until the latest search's results turn up)
+            self.search_polling = True
+            self.master.after(self.search_poll_interval,self.poll_search)
+
+    def poll_search(self):
+        '''Picks up the latest search results from the worker, checking back until the current search is done'''
+        if not self.search_polling: return  # The search was cancelled
+        latest = None
+        try:
+            while True:
+                result = self.search_worker.results.get_nowait()
+                if result[0] == self.search_worker.generation: latest = result
+        except Queue.Empty:
+            pass
+        if latest is None:
+            self.master.after(self.search_poll_interval,self.poll_search)
+            return
+        self.search_polling = False
+        (generation, query, options_dict, error) = latest
+        if error is not None:
+            # Likely user has entered a partially complete regex
+            # Let's turn the colour yellow to let them know
+            self.set_search_colour('bad-regex')
+        else:
+            # Search ran ok - string must be a valid regex
+            # Make sure colour of text box reflects that
+            self.set_search_colour('not-selected')
+            self.display_search_results(options_dict)
+
+    def set_search_colour(self,colour):
+        colour_var = self.search_entry.colour
+        colour_var.set(self.colour_scheme[colour])
+        self.search_entry.button.configure(bg=colour_var.get())
+
+    def display_search_results(self,options_dict):
+        # Initially, when you've only pressed one character, the search function can return a LOT
+        # of values.  Creating a button for each of them takes ages (and there is an annoying bug in unix
+        # where the frame doesn't resize down after you've displayed more than 70 buttons in it), so the
+        # results go in a ResultsPane, which only has as many buttons as fit on the screen.
+        # I also don't list more than max_search_results of them - nobody is going to scroll that far.
+        button_list = []
+        total = 0
+        for menu_level, options in options_dict.items():
+            total += len(options)
+            for option in options[:self.max_search_results - len(button_list)]:
+                button_list.append(list(menu_level) + [option])
+        
+        for key in self.button_frames.keys(): self.release_frame(key)
+        if self.results_pane is None: self.results_pane = ResultsPane(self.button_frame,self)
+        self.results_pane.show(button_list,total)
+        return
+
+    def scroll_search_results(self,amount):
+        if self.results_pane is not None and self.results_pane.results:
+            self.results_pane.scroll('scroll',amount,'units')
+
+    def check_config(self):
+        changed = self.watcher.check()
+        if changed: self.menu_changed(changed)
+        self.master.after(self.watch_interval,self.check_config)
+
+    def menu_changed(self,changed):
+        '''Updates the columns of buttons whose options have changed (changed being the keys returned by
+ConfigWatcher.check), and the search results if there are any'''
+        for key in self.button_frames.keys():
+            if key in changed:
+                if key in self.menu.menu_dict:
+                    self.button_frames[key].fill([])    # so every button gets set up again
+                    self.button_frames[key].fill([ list(key) + [option] for option in self.menu.get_options(list(key))[key] ])
+                else: self.release_frame(key)
+        # The search results' buttons only get set up again for positions they're not showing already,
+        # and any of them could be for a command that's changed, so they all go
+        if self.results_pane is not None: self.results_pane.column.fill([])
+        if self.search_entry.input.get() != '': self.start_search()
+        else: self.display_buttons(self.menu.position)
+
+    def queue_output(self,job,stream,line):
+        self.output_queue.put((job,stream,line))
+
+    def poll_output(self):
+        '''Adds any command output that has arrived to the output pane'''
+        lines = []
+        try:
+            while True:
+                (job,stream,line) = self.output_queue.get_nowait()
+                if stream == 'message': lines.append(line)
+                elif stream is None: lines.append("[job %d] %s\n" % (job.number, job_summary(job)))
+                elif stream == 'stderr': lines.append("[job %d stderr] %s" % (job.number, line))
+                else: lines.append("[job %d] %s" % (job.number, line))
+        except Queue.Empty:
+            pass
+        if lines:
+            self.output_text.configure(state=tk.NORMAL)
+            self.output_text.insert(tk.END,''.join(lines))
+            self.output_text.configure(state=tk.DISABLED)
+            self.output_text.see(tk.END)
+        self.master.after(self.output_poll_interval,self.poll_output)
+
+    def batch_select(self,button,event):
+        '''Adds / removes the right-clicked button (a command or a whole sub-menu) to / from the batch'''
+        key = tuple(button.position)
+        if key in self.batch_selection: del(self.batch_selection[key])
+        else: self.batch_selection[key] = True
+        if key in self.pressed: button.press()
+        else: button.reset()
+        button.apply()
+        self.batch_button.configure(text='Run batch (%d)' % len(self.batch_selection))
+
+    def run_batch(self):
+        if not self.batch_selection: return
+        batch = self.menu.run_batch(self.batch_selection.keys(),
+                                    lambda batch: self.output_queue.put((None,'message',batch.summary())))
+        self.output_queue.put((None,'message','Running a batch of %d commands\n' % len(batch.jobs)))
+        # Clear the selection, and the colour of the selected buttons that are showing
+        selected = self.batch_selection.keys()
+        self.batch_selection.clear()
+        for key in selected:
+            button = self.buttons.get(key)
+            if button is None: continue
+            if key in self.pressed: button.press()
+            else: button.reset()
+            button.apply()
+        self.batch_button.configure(text='Run batch (0)')
+
+    def clear_cache(self):
+        '''Empties the result cache, saying how it had been getting on'''
+        self.queue_output(None,'message','Cache cleared - %s\n' % self.menu.cache_stats())
+        self.menu.clear_cache()
+
+    def cancel_job(self):
+        '''Cancels the most recently started job that's still running or waiting to run'''
+        jobs = self.menu.runner.active_jobs()
+        if jobs: self.menu.runner.cancel(jobs[-1])
+
+    def button_press(self,button):
+        self.menu.position = button.position
+        
+        # If button is a primed command, execute the command
+        if button.type == 'command' and button.colour.get() == button.colour_when_pressed:
+            self.menu.execute_command(button.actual_command,path=button.position)
+            button.executed.set('yes')
+            # Below is a bit of a silly bit of code to make the button flash.  ooohhh!
+            button.colour.set(self.colour_scheme['command-initial'])
+            button.button.configure(activebackground=button.colour.get())
+            button.button.flash()
+            button.button.flash()
+            
+
+        self.display_buttons(self.menu.position)
+        return
+        
+class object:
+    def __init__(self):
+        pass
+        
+    
+def run_gui_menu(menu, search_delay=150, watcher=None, watch_interval=1000):
+    root = tk.Tk()
+    root.title('Menu')
+    GUI(root,menu,search_delay,watcher,watch_interval)
+    root.mainloop()
+    return
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import sys, os, time, threading, atexit, json
+import menu
+'''
+Timings and counters for when the menu is slow and we want to know why - see menu.py --profile
+(or set MENU_PROFILE=1).  Nothing here is imported unless it's wanted: install() wraps the functions
+it times, so when profiling is off the menu runs exactly the code it always did.
+'''
+
+# Upper bounds (in seconds) of the histogram buckets - anything slower goes in the last one
+BUCKETS = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0]
+
+class Timer:
+    '''Count, total, max and a histogram of the timings of one operation'''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+    def add(self,seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max,seconds)
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds > BUCKETS[bucket]: bucket += 1
+        self.histogram[bucket] += 1
+    def percentile(self,fraction):
+        '''The upper bound of the bucket the given fraction of timings fall within (so an over-estimate)'''
+        needed = fraction * self.count
+        seen = 0
+        for bucket in range(len(self.histogram)):
+            seen += self.histogram[bucket]
+            if seen >= needed: return min(BUCKETS[bucket],self.max) if bucket < len(BUCKETS) else self.max
+        return self.max
+
+class Profiler:
+    '''Collects the timings and counters, optionally writing each timing to a JSON lines trace as it
+happens, and prints a summary when the menu exits'''
+    def __init__(self,trace=None,dump=None):
+        self.lock = threading.Lock()    # searches and commands report in from other threads
+        self.timers = {}
+        self.counters = {}
+        self.trace = None
+        if trace is not None: self.trace = open(trace,'a')
+        self.cprofile = None
+        self.dump = dump
+        if dump is not None:
+            # This only sees the main thread, so GUI searches (which run in the SearchWorker) won't show up
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        atexit.register(self.finish)
+
+    def time(self,name,seconds):
+        self.lock.acquire()
+        try:
+            if name not in self.timers: self.timers[name] = Timer()
+            self.timers[name].add(seconds)
+            if self.trace is not None:
+                self.trace.write(json.dumps({'time': time.time(), 'pid': os.getpid(), 'name': name,
+                                             'seconds': seconds}) + '\n')
+                self.trace.flush()
+        finally:
+            self.lock.release()
+
+    def count(self,name,amount=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name,0) + amount
+        finally:
+            self.lock.release()
+
+    def wrap(self,owner,attribute,name):
+        '''Replaces the function owner.attribute (owner being a module or a class) with one that times it'''
+        function = vars(owner)[attribute]
+        def timed(*args,**kwargs):
+            start = time.time()
+            try:
+                return function(*args,**kwargs)
+            finally:
+                self.time(name,time.time() - start)
+        timed.__name__ = function.__name__
+        timed.__doc__ = function.__doc__
+        setattr(owner,attribute,timed)
+
+    def instrument(self):
+        '''Wraps the parts of the menu core worth knowing about'''
+        self.wrap(menu,'parse_config','parse_config')
+        self.wrap(menu.Menu,'find','search')
+        self.wrap(menu.Menu,'find_fuzzy','search fuzzy')
+        self.wrap(menu.Menu,'execute_command','execute_command')
+        profiler = self
+        compile = menu.PatternCache.compile.im_func
+        def counted_compile(cache,regex):
+            if regex not in cache.patterns: profiler.count('regexes compiled')
+            return compile(cache,regex)
+        menu.PatternCache.compile = counted_compile
+        finish_job = menu.CommandRunner.finish_job.im_func
+        def timed_finish_job(runner,job):
+            finish_job(runner,job)
+            profiler.time('command run',job.wall_time())
+        menu.CommandRunner.finish_job = timed_finish_job
+
+    def instrument_remote(self):
+        '''Wraps RemoteMenu's searches, which are the server's rather than Menu's - only done once
+menu_server has been imported'''
+        import menu_server
+        self.wrap(menu_server.RemoteMenu,'find','search')
+        self.wrap(menu_server.RemoteMenu,'find_fuzzy','search fuzzy')
+
+    def instrument_gui(self):
+        '''Wraps the GUI too - only done once menu_gui has been imported'''
+        import menu_gui, Tkinter as tk
+        self.wrap(menu_gui.GUI,'display_buttons','display_buttons')
+        profiler = self
+        widget_init = tk.BaseWidget.__init__.im_func
+        def counted_init(widget,*args,**kwargs):
+            profiler.count('widgets created')
+            widget_init(widget,*args,**kwargs)
+        tk.BaseWidget.__init__ = counted_init
+        widget_destroy = tk.BaseWidget.destroy.im_func
+        def counted_destroy(widget):
+            profiler.count('widgets destroyed')
+            widget_destroy(widget)
+        tk.BaseWidget.destroy = counted_destroy
+        # From a key being pressed to its search results (or the bad regex colour) going up.  Only the
+        # last key before the search counts - the others' searches never happened.
+        search = menu_gui.GUI.search.im_func
+        def timed_search(gui,event):
+            start = time.time()
+            search(gui,event)
+            if not gui.search_entry.input.get():
+                # Cleared the search box, which puts the menu straight back
+                profiler.time('GUI keystroke to paint',time.time() - start)
+                gui.keystroke_time = None
+            elif gui.search_after is not None: gui.keystroke_time = start
+        menu_gui.GUI.search = timed_search
+        poll_search = menu_gui.GUI.poll_search.im_func
+        def timed_poll_search(gui):
+            poll_search(gui)
+            if not gui.search_polling and getattr(gui,'keystroke_time',None) is not None:
+                profiler.time('GUI keystroke to paint',time.time() - gui.keystroke_time)
+                gui.keystroke_time = None
+        menu_gui.GUI.poll_search = timed_poll_search
+
+    def finish(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump)
+        if self.trace is not None: self.trace.close()
+        self.summary(sys.stderr)
+
+    def summary(self,f):
+        f.write("\n%-24s %8s %10s %10s %10s %10s %10s\n" % ('(milliseconds)', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+        for name in sorted(self.timers):
+            timer = self.timers[name]
+            f.write("%-24s %8d %10.2f %10.2f %10.2f %10.2f %10.2f\n" % (name, timer.count, timer.total / timer.count * 1000,
+                timer.percentile(0.5) * 1000, timer.percentile(0.9) * 1000, timer.percentile(0.99) * 1000, timer.max * 1000))
+        for name in sorted(self.counters):
+            f.write("%-24s %8d\n" % (name, self.counters[name]))
+        f.write("(percentiles are the top of the histogram bucket they fall in)\n")
+
+def install(trace=None,dump=None):
+    '''Starts profiling, returning the Profiler'''
+    profiler = Profiler(trace,dump)
+    profiler.instrument()
+    return profiler
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+import sys, os, re, stat, errno, threading, Queue, time, json, socket, SocketServer
+from collections import OrderedDict
+from menu import Menu, CommandRunner, Batch, print_output, split_command
+'''
+Lets a single menu be shared by any number of front ends - see menu.py --serve and --connect.
+'''
+
+def to_str(obj):
+    '''json gives us unicode strings, whereas the rest of the menu deals in plain (utf-8) ones'''
+    if isinstance(obj, unicode): return obj.encode('utf-8')
+    if isinstance(obj, list): return [ to_str(item) for item in obj ]
+    if isinstance(obj, dict): return dict([ (to_str(key), to_str(value)) for (key, value) in obj.items() ])
+    return obj
+
+def send_message(connection_file,message):
+    connection_file.write(json.dumps(message) + '\n')
+    connection_file.flush()
+
+def receive_message(connection_file):
+    line = connection_file.readline()
+    if not line: raise EOFError('The menu server closed the connection')
+    return to_str(json.loads(line))
+
+def remove_stale_socket(path):
+    '''Removes what's at path if it's a socket nobody is listening on any more (left behind by a server
+that died), raising socket.error if there's anything else there - we mustn't delete someone's file,
+or take over from a server that's still running'''
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return      # Nothing there
+    if not stat.S_ISSOCK(mode): raise socket.error(errno.EEXIST, "%s exists and isn't a socket" % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            probe.connect(path)
+        except socket.error, error:
+            if error.errno != errno.ECONNREFUSED: raise
+            os.remove(path)
+            return
+    finally:
+        probe.close()
+    raise socket.error(errno.EADDRINUSE, "There's a menu server on %s already" % path)
+
+class MenuServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Serves a single Menu to any number of clients over a unix domain socket, so the config only
+gets parsed once, and only one copy of the menu is held in memory, however many menus are open.
+
+Each request is a line of json, {"op": ..., "args": [...]}, answered by a line {"ok": true, "result": ...}
+or {"ok": false, "error": ..., "kind": ...}.  An execute request first gets {"event": "started", "job": N},
+then an {"event": "output", "stream": ..., "line": ...} for each line of output, before the answer.'''
+    daemon_threads = True
+    def __init__(self,path,menu,mode=0600):
+        remove_stale_socket(path)
+        # Whoever can connect can run the menu's commands as us, so by default that's only us - and
+        # the socket is made with those permissions, rather than changed to them once anyone could connect
+        umask = os.umask(0777 & ~mode)
+        try:
+            SocketServer.UnixStreamServer.__init__(self,path,MenuRequestHandler)
+        finally:
+            os.umask(umask)
+        self.menu = menu
+        # A search updates the search index's idea of the last search, so only one can run at a time
+        self.search_lock = threading.Lock()
+        self.actual_commands = None     # worked out the first time someone wants to run something
+        self.cache_ttls = None          # (user, command) -> cache_ttl, likewise
+
+    def can_execute(self,user,command):
+        '''We only run the commands that are in the menu'''
+        self.search_lock.acquire()
+        try:
+            if self.actual_commands is None:
+                self.actual_commands = set([ split_command(text) for (key, value) in self.menu.menu_dict.iteritems()
+                                             for text in value if self.menu.categorise(key,text) == 'actual-command' ])
+            return (user,command) in self.actual_commands
+        finally:
+            self.search_lock.release()
+
+    def cache_ttl(self,user,command):
+        '''How long the output of (user, command) can be cached for, if the config says it can be'''
+        self.search_lock.acquire()
+        try:
+            if self.cache_ttls is None:
+                self.cache_ttls = dict([ (split_command(text), ttl) for (text, ttl) in
+                                         getattr(self.menu.menu_dict,'cache_ttls',{}).items() ])
+            return self.cache_ttls.get((user,command))
+        finally:
+            self.search_lock.release()
+
+    def peer_user(self,connection):
+        '''The user at the other end of a connection, for the audit log - if Linux is here to tell us'''
+        if not sys.platform.startswith('linux'): return None
+        import struct, pwd
+        try:
+            # (SO_PEERCRED - the socket module only has a name for it from Python 3.3)
+            credentials = connection.getsockopt(socket.SOL_SOCKET,getattr(socket,'SO_PEERCRED',17),struct.calcsize('3i'))
+            return pwd.getpwuid(struct.unpack('3i',credentials)[1]).pw_name
+        except (socket.error, KeyError):
+            return None
+
+    def watch(self,watcher,interval):
+        '''Keeps the menu up to date with the config (call in its own thread)'''
+        while True:
+            time.sleep(interval)
+            self.search_lock.acquire()
+            try:
+                if watcher.check() is not None: self.actual_commands = self.cache_ttls = None
+            finally:
+                self.search_lock.release()
+
+class MenuRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.rfile)
+            except (EOFError, ValueError, socket.error):
+                return
+            try:
+                op = request.get('op')
+                args = request.get('args',[])
+                if op == 'execute': self.execute(*args)
+                elif op in self.ops: send_message(self.wfile,{'ok': True, 'result': self.ops[op](self,*args)})
+                else: send_message(self.wfile,{'ok': False, 'error': 'Unknown op %s' % op, 'kind': 'request'})
+            except re.error, error:
+                send_message(self.wfile,{'ok': False, 'error': str(error), 'kind': 'regex'})
+            except (socket.error, IOError):
+                return  # The client has gone
+            except Exception, error:
+                send_message(self.wfile,{'ok': False, 'error': str(error), 'kind': 'request'})
+
+    def lookup(self,key):
+        return self.server.menu.menu_dict.get(tuple(key))
+    def types(self,key):
+        return self.server.menu.option_types(tuple(key))
+    def find(self,regex):
+        self.server.search_lock.acquire()
+        try:
+            return [ [list(key), value] for (key, value) in self.server.menu.find(regex).items() ]
+        finally:
+            self.server.search_lock.release()
+    def find_fuzzy(self,query,limit=None):
+        self.server.search_lock.acquire()
+        try:
+            # A list rather than a JSON object, to keep them in order
+            return [ [list(key), value] for (key, value) in self.server.menu.find_fuzzy(query,limit=limit).items() ]
+        finally:
+            self.server.search_lock.release()
+    def commands_under(self,position):
+        return [ [list(path), text] for (path, text) in self.server.menu.commands_under(position) ]
+    def cancel(self,number):
+        runner = self.server.menu.runner
+        if 0 < number <= len(runner.jobs): runner.cancel(runner.jobs[number - 1])
+    def cache_stats(self):
+        return self.server.menu.cache_stats()
+    def clear_cache(self):
+        self.server.menu.clear_cache()
+    ops = {'lookup': lookup, 'types': types, 'find': find, 'find_fuzzy': find_fuzzy,
+           'commands_under': commands_under, 'cancel': cancel, 'cache_stats': cache_stats, 'clear_cache': clear_cache}
+
+    def execute(self,user,command,refresh=False,path=None):
+        if not self.server.can_execute(user,command):
+            send_message(self.wfile,{'ok': False, 'error': 'Not a command in the menu', 'kind': 'request'})
+            return
+        events = Queue.Queue()
+        runner = self.server.menu.runner
+        job = runner.submit(user,command,lambda job, stream, line: events.put((stream,line)),
+                            self.server.cache_ttl(user,command),refresh,path,self.server.peer_user(self.request))
+        try:
+            send_message(self.wfile,{'event': 'started', 'job': job.number})
+            while True:
+                (stream,line) = events.get()
+                if stream is None: break
+                send_message(self.wfile,{'event': 'output', 'stream': stream, 'line': line})
+        except (socket.error, IOError):
+            runner.cancel(job)  # Nobody to give the output to any more
+            raise
+        send_message(self.wfile,{'ok': True, 'result': {'state': job.state, 'returncode': job.returncode,
+                                                         'wall_time': job.wall_time(), 'cached_at': job.cached_at}})
+
+class MenuClient:
+    '''A connection to a MenuServer.  Safe to use from several threads (eg. the GUI and its search worker).'''
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = self.connect()
+        self.file = self.connection.makefile('rw')
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        connection.connect(self.path)
+        return connection
+    def call(self,op,*args):
+        self.lock.acquire()
+        try:
+            send_message(self.file,{'op': op, 'args': list(args)})
+            answer = receive_message(self.file)
+        finally:
+            self.lock.release()
+        if answer['ok']: return answer['result']
+        if answer.get('kind') == 'regex': raise re.error(answer['error'])
+        raise RuntimeError(answer['error'])
+
+class RemoteMenuDict:
+    '''Stands in for the menu_dict of a RemoteMenu, looking entries up on the server'''
+    def __init__(self,client):
+        self.client = client
+    def __getitem__(self,key):
+        value = self.client.call('lookup',list(key))
+        if value is None: raise KeyError(key)
+        return value
+    def __contains__(self,key):
+        return self.client.call('lookup',list(key)) is not None
+    def get(self,key,default=None):
+        value = self.client.call('lookup',list(key))
+        if value is None: return default
+        return value
+
+class RemoteTypes:
+    '''Stands in for the node_type_table of a RemoteMenu'''
+    def __init__(self,client):
+        self.client = client
+    def get(self,key,default=None):
+        types = self.client.call('types',list(key))
+        if types is None: return default
+        return types
+
+class RemoteRunner(CommandRunner):
+    '''A CommandRunner that has the MenuServer run the commands, rather than running them itself'''
+    def __init__(self,path,max_jobs=4,output=print_output):
+        CommandRunner.__init__(self,max_jobs,output)
+        self.path = path
+    def run_job(self,job):
+        try:
+            self.run_remotely(job)
+        finally:
+            self.finish_job(job)
+    def run_remotely(self,job):
+        '''Has the server run the job, returning once it's over'''
+        job.start_time = time.time()
+        job.state = 'running'
+        try:
+            client = MenuClient(self.path)
+            job.client = client
+            send_message(client.file,{'op': 'execute', 'args': [job.user, job.command, job.refresh,
+                                                                job.path and list(job.path)]})
+            while True:
+                message = receive_message(client.file)
+                if message.get('event') == 'started':
+                    job.server_number = message['job']
+                    if job.cancel_requested: self.cancel(job)
+                elif message.get('event') == 'output':
+                    getattr(job,message['stream']).append(message['line'])
+                    self.emit(job,message['stream'],message['line'])
+                elif message['ok']:
+                    job.state = message['result']['state']
+                    job.returncode = message['result']['returncode']
+                    job.cached_at = message['result'].get('cached_at')
+                    break
+                else:
+                    job.state = 'failed'
+                    job.stderr.append(message['error'])
+                    break
+            client.connection.close()
+        except (socket.error, EOFError), error:
+            job.state = 'failed'
+            job.stderr.append(str(error))
+        job.end_time = time.time()
+    def cancel(self,job):
+        CommandRunner.cancel(self,job)
+        if getattr(job,'server_number',None) is not None and job.returncode is None:
+            try: MenuClient(self.path).call('cancel',job.server_number)
+            except (socket.error, EOFError): pass
+
+def ignore_output(job,stream,line):
+    pass
+
+class RemoteBatch(Batch):
+    '''A Batch whose commands are run by the MenuServer, one at a time per worker, so that they get
+the same checks, caching and auditing there as any other command run through it'''
+    def __init__(self,commands,runner,done=None):
+        Batch.__init__(self,commands,runner.max_jobs,done)
+        self.runner = runner
+        for job in self.jobs: job.output = ignore_output    # (it's all in the summary)
+    def worker(self,sessions):
+        while True:
+            try: jobs = sessions.get_nowait()
+            except Queue.Empty: return
+            for job in jobs: self.runner.run_remotely(job)
+
+class RemoteMenu(Menu):
+    '''A Menu whose menu lives in a MenuServer.  The position and any search results are still kept
+here, as they belong to whoever is using the menu, but everything else is asked of the server.'''
+    def __init__(self,path,runner=None):
+        self.position = []
+        self.client = MenuClient(path)
+        if runner is None: runner = RemoteRunner(path)
+        self.runner = runner
+        self.menu_dict = RemoteMenuDict(self.client)
+        self.node_types = RemoteTypes(self.client)
+    def find(self,regex,cancelled=None):
+        return dict([ (tuple(key), value) for (key, value) in self.client.call('find',regex) ])
+    def find_fuzzy(self,query,cancelled=None,limit=None):
+        return OrderedDict([ (tuple(key), value) for (key, value) in
+                             self.client.call('find_fuzzy',query,limit or self.fuzzy_limit) ])
+    def commands_under(self,position):
+        return [ (tuple(path), text) for (path, text) in self.client.call('commands_under',list(position)) ]
+    def run_batch(self,positions,done=None):
+        batch = RemoteBatch(self.batch_commands(positions),self.runner,done)
+        batch.start()
+        return batch
+    def cache_stats(self):
+        return self.client.call('cache_stats')
+    def clear_cache(self):
+        self.client.call('clear_cache')
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import sys, re
+from collections import OrderedDict
+from menu import print_output
+'''
+The text based front end to the menu - see menu.py --text.
+'''
+
+def run_text_menu(menu, watcher=None):
+    while True:
+        if watcher is not None and watcher.check() is not None:
+            print "\n(%s has changed - menu reloaded)" % watcher.config
+        print "\n****** Menu ******"
+
+
+        # Zero option is always 'go up one level' ...
+        print "%d:(%s): %s" % (0,'Parent-menu','Go back up one level')
+        print "('jobs' lists the commands you've run, 'cancel N' stops job N,"
+        print " 'batch N M ...' runs all the commands at / under options N, M ... at once,"
+        print " 'mode fuzzy' / 'mode regex' changes how searches work - they're %s searches now," % menu.search_mode
+        print " 'refresh N' runs command N even if its output is cached, 'cache' / 'cache clear' shows / empties the cache)\n"
+
+        # These are the current options ...
+        options = menu.get_options(menu.position)
+        
+        # A dictionary that will keep track of what the 
+        # numbered menu options actually refer to under the cover
+        index_dict = {}
+        
+        label = 0
+        # Fuzzy search results come best first, so they stay in that order
+        if isinstance(options,OrderedDict): sorted_options = options.items()
+        else: sorted_options = sorted(options.items())
+        # Loop through options and print them to the screen
+        for index1 in range(len(sorted_options)):
+            key,value = sorted_options[index1]
+            types = menu.option_types(key)
+            if types is None: sys.exit("Some error has occurred")
+            
+            # Create a multi-line variable showing where you are in the menu, and print it.
+            location_text = 'Root'
+            for index in range(len(key)):
+                if index == len(key) -1: location_text = location_text + '\n' + '--' * (index + 1) + '>' + key[index]
+                else: location_text = location_text + '\n' + '--' * (index + 1) + key[index]            
+            print "%s:" % location_text
+            
+            for index2 in range(len(value)):
+                label = label + 1
+                # Make a note of the menu number label -> indexes mapping
+                index_dict[label] = (index1,index2)
+                # Is the option a command or submenu?  Work this out so we can label it.
+                category = types[value[index2]]
+                print "%d:(%s):\t%s" % (label,category,value[index2])
+            print "\n-------------------\n"
+        
+        # Take user input
+        choice = raw_input('\nMake your choice: ')
+        
+        # Process user input
+        if choice == '0': menu.go_up()
+        elif re.search(r'(quit|exit)',choice): sys.exit()
+        elif re.search(r'^$',choice): pass  # Do nothing if nothing has been entered
+        elif choice in ('mode fuzzy','mode regex'): menu.search_mode = choice.split()[1]
+        elif choice == 'cache': print menu.cache_stats()
+        elif choice == 'cache clear': menu.clear_cache()
+        elif re.search(r'^refresh \d+$',choice):
+            number = int(choice.split()[1])
+            if number not in index_dict: print "No option %s" % number
+            else:
+                index1,index2 = index_dict[number]
+                key, entries = sorted_options[index1]
+                position = tuple(key) + (entries[index2],)
+                if menu.categorise(key,entries[index2]) != 'command': print "%s isn't a command" % entries[index2]
+                else: menu.execute_command(menu.menu_dict[position][0],refresh=True,path=position)
+        elif choice == 'jobs':
+            # Commands run in the background, so this is how you see what they're up to
+            for job in menu.runner.jobs: print job.describe()
+        elif re.search(r'^batch( \d+)+$',choice):
+            # Run several commands at once - each number can be a command or a whole sub-menu
+            positions = []
+            for number in choice.split()[1:]:
+                if int(number) not in index_dict:
+                    print "No option %s" % number
+                    break
+                index1,index2 = index_dict[int(number)]
+                key, entries = sorted_options[index1]
+                positions.append(list(key) + [entries[index2]])
+            else:
+                batch = menu.run_batch(positions,lambda batch: print_output(None,'message',batch.summary()))
+                print "Running %d commands" % len(batch.jobs)
+        elif re.search(r'^cancel \d+$',choice):
+            number = int(choice.split()[1])
+            if 0 < number <= len(menu.runner.jobs): menu.runner.cancel(menu.runner.jobs[number - 1])
+            else: print "No job %d" % number
+        else:
+            if re.search(r'^\d+$',choice):
+                # They've picked a menu entry as opposed to a search
+                # Using the index_dict, work out what position and option they've chosen
+                index1,index2 = index_dict[int(choice)]
+                position, entries = sorted_options[index1]
+                option = entries[index2]
+            else: position, option = menu.position, choice
+            #if menu.choose_option(menu.position,menu.specify_option(menu.position,choice)) == -1:
+            if menu.choose_option(list(position),option) == -1:
+                sys.exit('Some error has occurred')
+    return
+    
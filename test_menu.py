@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+import sys, os, re, csv, time, tempfile, shutil, socket, unittest
+import menu, menu_audit, menu_server, bench
+'''
+Regression tests for the menu.  Run with python test_menu.py (or python -m unittest test_menu).
+
+Parsing and searching have been rewritten for speed, so they're checked against the original
+straightforward versions (baseline_parse and baseline_search, below), which are the definition of
+what the answers should be.
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def baseline_parse(lines):
+    '''The original parse_config, from the time before it was rewritten'''
+    processed_lines = [ line.split('#')[0].rstrip('\n').rstrip(' ').rstrip(',') for line in lines ]
+    menu_opts = {}
+    for line in csv.reader(processed_lines,skipinitialspace = True):
+        line = tuple(line)
+        for i in range(len(line)):
+            if line[:i] not in menu_opts: menu_opts[line[:i]] = [line[i]]
+            elif line[i] not in menu_opts[line[:i]]: menu_opts[line[:i]].append(line[i])
+    return menu_opts
+
+def baseline_matches(menu_dict,regex):
+    '''The original search, up to where it folds actual-commands into their commands'''
+    matches = {}
+    for (key, value) in menu_dict.items():
+        for level in key:
+            if re.search(regex,level):
+                matches[key] = value
+                break
+        if key not in matches:
+            for entry in value:
+                if re.search(regex,entry):
+                    if key not in matches: matches[key] = [entry]
+                    else: matches[key].append(entry)
+    return matches
+
+def baseline_search(menu_dict,regex):
+    '''The original search.  Which of two commands in the same sub-menu survives the folding of
+their actual-commands depends on dictionary order, so the tests only fold where that can't happen.'''
+    matches = baseline_matches(menu_dict,regex)
+    categorise = menu.Menu(menu_dict).categorise
+    for (key,value) in matches.items():
+        if categorise(list(key),value[0]) == 'actual-command':
+            del matches[key]
+            if key[:-1] not in matches: matches[key[:-1]] = [key[-1]]
+    return matches
+
+def config_lines():
+    '''The example config and a synthetic one, with repeated labels and actual-commands'''
+    f = open(os.path.join(HERE,'menu.cfg'))
+    lines = f.readlines()
+    f.close()
+    return [('menu.cfg', lines),
+            ('synthetic', bench.synthetic_config(3000, depth=2, fan_out=8, seed=1, duplicate_rate=0.1))]
+
+class ParseTest(unittest.TestCase):
+    def test_same_as_baseline(self):
+        for (name, lines) in config_lines():
+            self.assertEqual(menu.parse_config(lines), baseline_parse(lines), name)
+
+    def test_tree_same_as_dict(self):
+        for (name, lines) in config_lines():
+            menu_dict = menu.parse_config(lines)
+            tree = menu.MenuTree(menu_dict)
+            self.assertEqual(sorted(tree.keys()), sorted(menu_dict.keys()), name)
+            for key in menu_dict: self.assertEqual(sorted(tree[key]), sorted(menu_dict[key]), name)
+
+    def test_tree_categorises_as_dict(self):
+        for (name, lines) in config_lines():
+            menu_dict = menu.parse_config(lines)
+            (plain, compact) = (menu.Menu(menu_dict), menu.Menu(menu.MenuTree(menu_dict)))
+            for (key, value) in menu_dict.items():
+                for option in value + ['no such option']:
+                    self.assertEqual(compact.categorise(key,option), plain.categorise(key,option), (name, key, option))
+                    self.assertEqual(compact.categorise(list(key),option), plain.categorise(key,option))
+                self.assertEqual(compact.option_types(key), plain.option_types(key))
+            self.assertEqual(compact.categorise(('no such menu',),'x'), -1)
+
+    def test_wide_tree_categorises_quickly(self):
+        menu_dict = menu.parse_config([ 'Wide, option %d, echo %d\n' % (i, i) for i in range(5000) ])
+        compact = menu.Menu(menu.MenuTree(menu_dict))
+        start = time.time()
+        for option in menu_dict[('Wide',)]: compact.categorise(('Wide',),option)
+        self.assertTrue(time.time() - start < 1.0)
+
+class SearchTest(unittest.TestCase):
+    REGEXES = ['coffee', '^level 1', 'command 1$', 'level 0-3', 'command 2[0-9]', 'actual_command_1',
+               'function', '^$', 'no such thing', '.']
+
+    def test_matches_same_as_baseline(self):
+        for (name, lines) in config_lines():
+            menu_dict = menu.parse_config(lines)
+            index = menu.SearchIndex(menu_dict)
+            for regex in self.REGEXES:
+                self.assertEqual(index.matches(regex), baseline_matches(menu_dict,regex), (name, regex))
+
+    def test_folding_same_as_baseline(self):
+        # Each of these matches at most one actual-command in any sub-menu
+        for (name, lines) in config_lines():
+            menu_dict = menu.parse_config(lines)
+            m = menu.Menu(menu_dict)
+            for regex in ['coffee_command', 'read paper function', 'actual_command_17$', 'actual_command_2999$',
+                          'user 3 sub-command 2', '^level 0-1$', 'command 5$']:
+                self.assertEqual(m.find(regex), baseline_search(menu_dict,regex), (name, regex))
+
+    def test_actual_command_folds_into_command(self):
+        m = menu.Menu(baseline_parse(["Mum's options, have coffee, coffee_command\n",
+                                      "Mum's options, go for walk, walk_command\n"]))
+        self.assertEqual(m.find('coffee_'), {("Mum's options",): ['have coffee']})
+
+def quiet(job,stream,line):
+    pass
+
+class WatcherTest(unittest.TestCase):
+    # Every edit is checked against parsing the edited config afresh
+    REGEXES = ['coffee', '^relax$', 'command', 'echo', 'new', '.']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_home = bench.set_cache_home(os.path.join(self.directory,'cache'))
+        self.config = os.path.join(self.directory,'menu.cfg')
+        self.lines = config_lines()[0][1] + ["Status, disk, echo disk, cache=1h\n", "Status, load, uptime\n"]
+        self.write()
+        self.menu = menu.Menu(menu.load_config(self.config))
+        self.menu.find('.')     # so there's a search index to be kept up to date
+        self.watcher = menu.ConfigWatcher(self.config,self.menu)
+    def tearDown(self):
+        bench.set_cache_home(self.cache_home)
+        shutil.rmtree(self.directory)
+
+    def write(self,lines=None,path=None):
+        '''Writes the config (or, given path, a fragment) with lines'''
+        if path is None: (path, self.lines) = (self.config, lines or self.lines)
+        f = open(path,'w')
+        f.writelines(lines or self.lines)
+        f.close()
+        # (an edit within the same second, to a file of the same size, would otherwise go unnoticed)
+        self.mtime = getattr(self,'mtime',time.time()) + 10
+        os.utime(path,(self.mtime, self.mtime))
+
+    def assert_same_as_fresh(self):
+        self.assertNotEqual(self.watcher.check(), None)
+        fresh = menu.load_config(self.config,True)
+        menu_dict = self.menu.menu_dict
+        self.assertEqual(sorted(menu_dict.keys()), sorted(fresh.keys()))
+        for key in fresh: self.assertEqual(sorted(menu_dict[key]), sorted(fresh[key]), key)
+        self.assertEqual(menu_dict.cache_ttls, fresh.cache_ttls)
+        self.assertEqual(self.menu.node_types, menu.node_type_table(fresh))
+        index = menu.SearchIndex(fresh)
+        for regex in self.REGEXES:
+            self.assertEqual(dict([ (key, sorted(value)) for (key, value) in self.menu.search_index.matches(regex).items() ]),
+                             dict([ (key, sorted(value)) for (key, value) in index.matches(regex).items() ]), regex)
+
+    def test_unchanged(self):
+        self.assertEqual(self.watcher.check(), None)
+
+    def test_add_lines(self):
+        self.write(self.lines + ["New, sub, command, echo new\n", "Status, disk, again, echo again\n"])
+        self.assert_same_as_fresh()
+
+    def test_remove_lines(self):
+        self.write([ line for line in self.lines if 'coffee' not in line and 'Status, load' not in line ])
+        self.assert_same_as_fresh()
+        self.write([ line for line in self.lines if not line.startswith("Dad's") ])
+        self.assert_same_as_fresh()
+
+    def test_duplicate_lines(self):
+        # Taking away one of two copies of a line leaves its options where they are
+        self.write(self.lines + ["Status, load, uptime\n"])
+        self.assert_same_as_fresh()
+        self.write(self.lines[:-1])
+        self.assert_same_as_fresh()
+        self.write([ line for line in self.lines if 'Status, load' not in line ])
+        self.assert_same_as_fresh()
+        self.assertFalse(('Status', 'load') in self.menu.menu_dict)
+
+    def test_change_a_command(self):
+        # A command that becomes a sub-menu, and a sub-menu that becomes a command, change their
+        # parents' and grandparents' types
+        self.write([ line.replace('echo disk, cache=1h', 'more, echo more') for line in self.lines ] +
+                   ["Status, load, uptime, more\n"])
+        self.assert_same_as_fresh()
+
+    def test_change_cache_field(self):
+        self.write([ line.replace('cache=1h', 'cache=5m') for line in self.lines ])
+        self.assert_same_as_fresh()
+        self.assertEqual(self.menu.menu_dict.cache_ttls, {'echo disk': 300.0})
+        self.write([ line.replace(', cache=5m', '') for line in self.lines ])
+        self.assert_same_as_fresh()
+        self.assertEqual(self.menu.menu_dict.cache_ttls, {})
+
+    def test_add_include(self):
+        self.write(["Included, thing, echo thing, cache=10\n"],os.path.join(self.directory,'extra.cfg'))
+        self.write(self.lines + ["include extra.cfg\n"])
+        self.assert_same_as_fresh()
+        # From then on, an edit to the fragment is picked up too
+        self.write(["Included, other thing, echo other\n"],os.path.join(self.directory,'extra.cfg'))
+        self.assert_same_as_fresh()
+        self.assertFalse(('Included', 'thing') in self.menu.menu_dict)
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.results = os.path.join(self.directory,'results')
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def finished_job(self,command,ttl=60,output='output\n'):
+        job = menu.Job(1,'someone',command)
+        (job.state, job.returncode, job.cache_ttl, job.end_time) = ('finished', 0, ttl, time.time())
+        job.stdout = [output]
+        return job
+
+    def test_expiry(self):
+        cache = menu.ResultCache()
+        cache.put(self.finished_job('echo short',0.2))
+        cache.put(self.finished_job('echo long'))
+        self.assertEqual(cache.get('someone','echo short')['stdout'], ['output\n'])
+        time.sleep(0.3)
+        self.assertEqual(cache.get('someone','echo short'), None)
+        self.assertNotEqual(cache.get('someone','echo long'), None)
+        self.assertEqual(cache.get('someone else','echo long'), None)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_least_recently_used_go(self):
+        cache = menu.ResultCache(size=2)
+        for command in ['echo 1', 'echo 2']: cache.put(self.finished_job(command))
+        cache.get('someone','echo 1')
+        cache.put(self.finished_job('echo 3'))
+        self.assertEqual([ cache.get('someone',command) is not None for command in ['echo 1', 'echo 2', 'echo 3'] ],
+                         [True, False, True])
+
+    def test_refresh(self):
+        cache = menu.ResultCache()
+        cache.put(self.finished_job('echo 1'))
+        self.assertEqual(cache.get('someone','echo 1',refresh=True), None)
+        self.assertNotEqual(cache.get('someone','echo 1'), None)
+        self.assertEqual((cache.hits, cache.misses, cache.refreshes), (1, 0, 1))
+
+    def test_shared_through_directory(self):
+        menu.ResultCache(directory=self.results).put(self.finished_job('echo caf\xe9',output='caf\xe9\n'))
+        self.assertEqual(os.stat(self.results).st_mode & 0777, 0700)
+        other = menu.ResultCache(directory=self.results)
+        self.assertEqual(other.get('someone','echo caf\xe9')['stdout'], ['caf\xe9\n'])
+        self.assertEqual(other.disk_hits, 1)
+
+    def test_files_not_ours_ignored(self):
+        cache = menu.ResultCache(directory=self.results)
+        cache.put(self.finished_job('echo 1'))
+        if os.getuid() == 0:
+            os.chown(cache.file_path(('someone','echo 1')),os.getuid() + 1,-1)
+            self.assertEqual(menu.ResultCache(directory=self.results).get('someone','echo 1'), None)
+
+    def test_shared_directory_not_used(self):
+        os.mkdir(self.results)
+        os.chmod(self.results,0777)
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull,'w')
+        try:
+            cache = menu.ResultCache(directory=self.results)
+        finally:
+            sys.stderr = stderr
+        cache.put(self.finished_job('echo 1'))
+        self.assertEqual((cache.directory, os.listdir(self.results)), (None, []))
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_home = bench.set_cache_home(os.path.join(self.directory,'cache'))
+        self.config = os.path.join(self.directory,'menu.cfg')
+        f = open(self.config,'w')
+        f.writelines(config_lines()[0][1])
+        f.close()
+    def tearDown(self):
+        bench.set_cache_home(self.cache_home)
+        shutil.rmtree(self.directory)
+
+    def test_cached_in_cache_directory(self):
+        menu_dict = menu.load_config(self.config)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['cache', 'menu.cfg'])
+        self.assertEqual(len(os.listdir(menu.cache_directory())), 1)
+        self.assertEqual(menu.read_cache(self.config), menu_dict)
+
+    def test_shared_cache_directory_not_used(self):
+        os.makedirs(os.path.join(self.directory,'cache','menu'))
+        os.chmod(os.path.join(self.directory,'cache','menu'),0777)
+        self.assertEqual(menu.cache_directory(), None)
+        menu_dict = menu.load_config(self.config)
+        self.assertEqual(menu_dict, baseline_parse(config_lines()[0][1]))
+        self.assertEqual(os.listdir(os.path.join(self.directory,'cache','menu')), [])
+        self.assertEqual(menu.read_cache(self.config), None)
+
+class AuditTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = menu_audit.AuditLog(self.directory,flush_interval=0.05)
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def finished_job(self,command,path):
+        job = menu.Job(1,'someone',command)
+        (job.path, job.state, job.returncode) = (path, 'finished', 0)
+        job.start_time = job.end_time = time.time()
+        job.stdout = ['output\n']
+        return job
+
+    def test_entries(self):
+        self.log.record(self.finished_job('echo one',('Status','one')))
+        # Neither of these is valid UTF-8, but that mustn't cost us them or any entries after them
+        self.log.record(self.finished_job('echo caf\xe9',('Status','caf\xe9')))
+        self.log.record(self.finished_job('echo caf\xc3\xa9',('Status','caf\xc3\xa9')))
+        self.log.record(self.finished_job('echo two',('Status','two')))
+        start = time.time()
+        self.log.close()
+        self.assertTrue(time.time() - start < 5)
+        entries = list(menu_audit.read_entries(menu_audit.log_files(self.directory)))
+        self.assertEqual([ entry['command'] for entry in entries ],
+                         [u'echo one', u'echo caf\xe9', u'echo caf\xe9', u'echo two'])
+        self.assertEqual(entries[1]['path'], [u'Status', u'caf\xe9'])
+        self.assertEqual((entries[0]['user'], entries[0]['state'], entries[0]['stdout_bytes']), (u'someone', u'finished', 7))
+
+class ServerSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'menu.sock')
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def listen(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(1)
+        return listener
+
+    def test_not_a_socket(self):
+        open(self.path,'w').close()
+        self.assertRaises(socket.error, menu_server.remove_stale_socket, self.path)
+        self.assertTrue(os.path.isfile(self.path))
+
+    def test_live_socket(self):
+        listener = self.listen()
+        try:
+            self.assertRaises(socket.error, menu_server.remove_stale_socket, self.path)
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            listener.close()
+
+    def test_stale_socket(self):
+        self.listen().close()
+        menu_server.remove_stale_socket(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        menu_server.remove_stale_socket(self.path)     # (and nothing there is fine too)
+
+class Options:
+    def __init__(self,**options):
+        (self.search, self.run, self.list, self.separator, self.json, self.refresh) = (None, None, None, '/', False, False)
+        self.__dict__.update(options)
+
+class FuzzyTest(unittest.TestCase):
+    def fuzzy(self,lines):
+        m = menu.Menu(menu.parse_config(lines))
+        m.find_fuzzy('x')
+        return m.fuzzy_index
+
+    def test_menu_cfg(self):
+        index = self.fuzzy(config_lines()[0][1])
+        coffees = [("Dad's options", 'relax', 'have coffee'), ("Mum's options", 'have coffee')]
+        self.assertEqual(index.top('have c'), coffees)
+        self.assertEqual(index.top('HAVE C'), coffees)
+        self.assertEqual(index.top('coff'), coffees)
+        self.assertEqual(index.top('dadcof'), coffees[:1])
+        self.assertEqual(index.top('walk'), [("Mum's options", 'go for walk')])
+        # Actual-commands aren't matched themselves - they're found through their commands
+        self.assertEqual(index.top('coffee_command'), [])
+        self.assertEqual(index.top('  '), [])
+
+    def test_tiers(self):
+        index = self.fuzzy(['Drinks, coffee, make coffee\n',
+                            'Drinks, have coffee, make coffee\n',
+                            'Drinks, decoffeinated, make decaf\n',
+                            'Drinks, cola with froth, open can\n',
+                            'Cold, fizzy, open can\n'])
+        self.assertEqual(index.top('cof'), [('Drinks', 'coffee'),               # 0. starts with it
+                                            ('Drinks', 'have coffee'),          # 1. a later word does
+                                            ('Drinks', 'decoffeinated'),        # 2. somewhere in it
+                                            ('Cold', 'fizzy'),                  # 3. c-o-f along the path,
+                                            ('Drinks', 'cola with froth')])     #    the tighter first
+
+    def test_subsequence_split_between_path_and_label(self):
+        index = self.fuzzy(config_lines()[0][1])
+        # All of the letters in the path, some in the path and the rest in the option, and in the wrong order
+        relax = [("Dad's options", 'relax'), ("Dad's options", 'relax', 'have coffee'),
+                 ("Dad's options", 'relax', 'read paper')]
+        self.assertEqual(sorted(index.top('dadrlx')), relax)
+        self.assertEqual(index.top('dadrlxppr'), relax[2:])
+        self.assertEqual(index.top('paperdad'), [])
+
+    def test_limit(self):
+        index = self.fuzzy(config_lines()[0][1])
+        everything = index.top('o',1000)
+        for limit in (1, 3, len(everything)):
+            self.assertEqual(index.top('o',limit), everything[:limit])
+        # Once the quick tiers have found enough, the slower ones aren't looked through at all
+        looked = []
+        def cancelled():
+            looked.append(True)
+            return False
+        index.top('have c',2,cancelled)
+        self.assertEqual(looked, [])
+        index.top('have c',3,cancelled)
+        self.assertNotEqual(looked, [])
+
+class HeadlessTest(unittest.TestCase):
+    def setUp(self):
+        self.menu = menu.Menu(menu.parse_config(config_lines()[0][1]))
+
+    def test_actual_command_not_found(self):
+        path = "Dad's options/relax/read paper/read paper function"
+        self.assertEqual(menu.run_headless(self.menu,Options(list=path)), menu.EXIT_NOT_FOUND)
+        self.assertEqual(menu.run_headless(self.menu,Options(run=path)), menu.EXIT_NOT_FOUND)
+
+class RunnerTest(unittest.TestCase):
+    # There's no sudo here, so commands are run in a plain shell
+    def setUp(self):
+        self.login_command = menu.LOGIN_COMMAND
+        menu.LOGIN_COMMAND = "exec sh # %s"
+    def tearDown(self):
+        menu.LOGIN_COMMAND = self.login_command
+
+    def test_jobs_for_one_user_run_at_once(self):
+        runner = menu.CommandRunner(3,output=quiet)
+        start = time.time()
+        jobs = [ runner.submit('someone','sleep 1') for i in range(3) ]
+        for job in jobs: job.wait()
+        self.assertTrue(time.time() - start < 2.5)
+
+    def test_max_per_user(self):
+        runner = menu.CommandRunner(4,output=quiet,max_per_user=1)
+        jobs = [ runner.submit('someone','sleep 0.5') for i in range(2) ]
+        other = runner.submit('someone else','sleep 0.5')
+        for job in jobs + [other]: job.wait()
+        self.assertTrue(jobs[1].start_time >= jobs[0].end_time)
+        self.assertTrue(other.start_time < jobs[0].end_time)
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.login_command = menu.LOGIN_COMMAND
+        menu.LOGIN_COMMAND = "exec sh # %s"
+    def tearDown(self):
+        menu.LOGIN_COMMAND = self.login_command
+
+    def run_batch(self,commands):
+        batch = menu.Batch([ (('batch', str(i)), '(someone;%s)' % commands[i]) for i in range(len(commands)) ], 1)
+        batch.run()
+        return batch.jobs
+
+    def test_output(self):
+        jobs = self.run_batch(['echo one; echo two', 'echo oops >&2; exit 3', 'true', 'echo; echo'])
+        self.assertEqual([ (job.state, job.returncode) for job in jobs ],
+                         [('finished', 0), ('finished', 3), ('finished', 0), ('finished', 0)])
+        self.assertEqual([ job.stdout for job in jobs ], [['one\n', 'two\n'], [], [], ['\n', '\n']])
+        self.assertEqual(jobs[1].stderr, ['oops\n'])
+
+    def test_no_trailing_newline(self):
+        jobs = self.run_batch(['printf foo', 'printf bar >&2', 'printf "foo\\nbar"'])
+        self.assertEqual([ (job.state, job.returncode) for job in jobs ], [('finished', 0)] * 3)
+        self.assertEqual([ job.stdout for job in jobs ], [['foo\n'], [], ['foo\n', 'bar\n']])
+        self.assertEqual(jobs[1].stderr, ['bar\n'])
+
+    def test_bad_command_before_good_one(self):
+        jobs = self.run_batch(['echo "unterminated', 'echo ok', "echo 'quoted'"])
+        self.assertEqual([ (job.state, job.returncode != 0) for job in jobs ],
+                         [('finished', True), ('finished', False), ('finished', False)])
+        self.assertEqual([ job.stdout for job in jobs ], [[], ['ok\n'], ['quoted\n']])
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.login_command = menu.LOGIN_COMMAND
+        menu.LOGIN_COMMAND = "exec sh # %s"
+        self.session = menu.Session('someone')
+    def tearDown(self):
+        self.session.close()
+        menu.LOGIN_COMMAND = self.login_command
+
+    def run_command(self,command,emit=None):
+        job = menu.Job(1,'someone',command)
+        self.assertTrue(self.session.run(job,emit))
+        return job
+
+    def test_no_trailing_newline(self):
+        for command in ['printf foo', 'printf foo >&2', 'true', 'echo; echo']:
+            job = self.run_command(command)
+            self.assertEqual(job.returncode, 0, command)
+        job = self.run_command('printf foo; printf bar >&2; exit 2')
+        self.assertEqual((job.returncode, job.stdout, job.stderr), (2, ['foo\n'], ['bar\n']))
+        self.assertEqual(self.run_command('echo; echo').stdout, ['\n', '\n'])
+        self.assertEqual(list(self.session.stray), [])
+
+    def test_syntax_error(self):
+        for command in ['echo "unterminated', 'echo (', 'cat <<EOF']:
+            job = self.run_command(command)
+            self.assertEqual(job.stdout, [], command)
+        self.assertNotEqual(self.run_command('echo "unterminated').returncode, 0)
+        job = self.run_command("echo 'single quotes' \"it's\"")
+        self.assertEqual((job.returncode, job.stdout), (0, ["single quotes it's\n"]))
+
+    def test_output_not_held_up(self):
+        arrived = []
+        job = self.run_command('echo one; sleep 1; echo two',
+                               lambda job, stream, line: arrived.append((time.time(), line)))
+        self.assertEqual([ line for (when, line) in arrived ], ['one\n', 'two\n'])
+        self.assertTrue(arrived[0][0] < job.start_time + 0.5)
+
+if __name__ == "__main__":
+    unittest.main()